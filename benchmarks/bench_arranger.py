@@ -0,0 +1,217 @@
+########################################
+#
+# Picture Arranger - throughput benchmark
+#
+# Builds a synthetic JPEG corpus, then times each stage and a full main() run over it.
+#
+#   python benchmarks/bench_arranger.py --files 2000 --json-out new.json --compare old.json
+#
+########################################
+
+import os
+import io
+import sys
+import json
+import time
+import struct
+import random
+import shutil
+import logging
+import tempfile
+import datetime
+import argparse
+import platform
+import subprocess
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), '..' ) )
+import picture_arranger
+
+def parse_options():
+    '''Setup and parse the options for this script'''
+    parser = argparse.ArgumentParser(description='Benchmark the picture arranger on a synthetic corpus.')
+    parser.add_argument('-n', '--files',
+                        type=int,
+                        default=1000,
+                        help="Images in the corpus")
+    parser.add_argument('--size',
+                        type=int,
+                        default=256,
+                        help="Size of each image in KB")
+    parser.add_argument('--exif-ratio',
+                        type=float,
+                        default=0.9,
+                        help="Fraction of images with an EXIF DateTimeOriginal - the rest fall back to mtime")
+    parser.add_argument('--days',
+                        type=int,
+                        default=30,
+                        help="Number of days the capture dates are spread over")
+    parser.add_argument('--clash-ratio',
+                        type=float,
+                        default=0.1,
+                        help="Fraction of images reusing the name (and date) of an earlier one - as from a second card")
+    parser.add_argument('--cards',
+                        type=int,
+                        default=4,
+                        help="Input subdirectories the corpus is spread over")
+    parser.add_argument('--seed',
+                        type=int,
+                        default=1,
+                        help="Random seed for the corpus")
+    parser.add_argument('-j', '--jobs',
+                        type=int,
+                        default=1,
+                        help="--jobs for the main() run")
+    parser.add_argument('--io-jobs',
+                        type=int,
+                        default=1,
+                        help="--io-jobs for the main() run")
+    parser.add_argument('--workdir',
+                        default=None,
+                        help="Where to build the corpus and outputs - defaults to a temporary directory, removed afterwards")
+    parser.add_argument('--json-out',
+                        default=None,
+                        help="Save the results here as JSON")
+    parser.add_argument('--compare',
+                        default=None,
+                        help="Results JSON from an earlier run to compare against")
+    return parser.parse_args()
+
+def base_jpeg():
+    '''A small real JPEG with no EXIF, for the synthetic images to be built around'''
+    from PIL import Image
+    data = io.BytesIO()
+    Image.new( 'RGB', (64, 48), (90, 120, 200) ).save( data, 'JPEG' )
+    return data.getvalue()
+
+def exif_segment( date ):
+    '''APP1 segment holding IFD0 -> Exif IFD -> DateTimeOriginal in a big-endian TIFF block'''
+    value = date.strftime( '%Y:%m:%d %H:%M:%S' ).encode( 'ascii' ) + b'\x00'
+    tiff = b'MM\x00*' + struct.pack( '>I', 8 )
+    # IFD0 at 8: one entry pointing at the Exif IFD, which starts at 8 + 18
+    tiff += struct.pack( '>HHHII', 1, 0x8769, 4, 1, 26 ) + struct.pack( '>I', 0 )
+    # Exif IFD at 26: one ASCII entry whose value follows at 26 + 18
+    tiff += struct.pack( '>HHHII', 1, 0x9003, 2, len( value ), 44 ) + struct.pack( '>I', 0 )
+    payload = b'Exif\x00\x00' + tiff + value
+    return b'\xff\xe1' + struct.pack( '>H', len( payload ) + 2 ) + payload
+
+def padding_segments( rng, size ):
+    '''COM segments of random bytes - makes each image unique and the requested size'''
+    segments = []
+    while size > 4:
+        chunk = min( size - 4, 65533 )
+        segments.append( b'\xff\xfe' + struct.pack( '>H', chunk + 2 ) + rng.getrandbits( chunk * 8 ).to_bytes( chunk, 'big' ) )
+        size -= chunk + 4
+    return b''.join( segments )
+
+def make_corpus( root, args ):
+    '''Write the synthetic corpus under root. Returns (number of files, total bytes)'''
+    rng = random.Random( args.seed )
+    jpeg = base_jpeg()
+    start = datetime.datetime( 2015, 1, 1 )
+    originals = [] # (name, date) of images a clash can reuse
+    occurrences = {}
+    total = 0
+    padding = padding_segments( rng, max( 0, args.size * 1024 - len( jpeg ) ) )
+    for i in range( args.files ):
+        if originals and rng.random() < args.clash_ratio:
+            name, date = rng.choice( originals )
+        else:
+            name = "IMG_{0:06d}.jpg".format( i )
+            date = start + datetime.timedelta( seconds=rng.randrange( args.days * 86400 ) )
+            originals.append( (name, date) )
+        occurrence = occurrences.get( name, 0 )
+        occurrences[name] = occurrence + 1
+        directory = os.path.join( root, "card{0:02d}".format( i % args.cards ) )
+        if occurrence:
+            directory = os.path.join( directory, "copy{0}".format( occurrence ) )
+        if not os.path.isdir( directory ):
+            os.makedirs( directory )
+        path = os.path.join( directory, name )
+        exif = exif_segment( date ) if rng.random() < args.exif_ratio else b''
+        # a fresh 8 bytes up front keeps every image distinct without regenerating the padding
+        unique = b'\xff\xfe\x00\x0a' + struct.pack( '>Q', i )
+        with open( path, 'wb' ) as f:
+            f.write( jpeg[:2] + exif + unique + padding + jpeg[2:] )
+        timestamp = time.mktime( date.timetuple() )
+        os.utime( path, (timestamp, timestamp) )
+        total += os.path.getsize( path )
+    return args.files, total
+
+def timed( func ):
+    '''(seconds, result) for one call of func'''
+    start = time.perf_counter()
+    result = func()
+    return time.perf_counter() - start, result
+
+def run_main( argv ):
+    '''Call picture_arranger.main() as if from the command line'''
+    saved = sys.argv[1:]
+    sys.argv[1:] = argv
+    try:
+        picture_arranger.main()
+    finally:
+        sys.argv[1:] = saved
+
+def bench( corpus, workdir, files, args ):
+    '''Time each stage, then main(), over the corpus. Returns {stage: seconds}'''
+    seconds = {}
+    seconds['get_image_list'], images = timed( lambda: list( picture_arranger.get_image_list( corpus, recursive=True ) ) )
+    assert len( images ) == files, "found {0} of {1} images".format( len( images ), files )
+    seconds['get_image_creation_date'], dates = timed( lambda: [ picture_arranger.get_image_creation_date( image ) for image in images ] )
+    outdir = os.path.join( workdir, 'stages' )
+    index = picture_arranger.TargetIndex()
+    seconds['create_target_path'], paths = timed( lambda: [ picture_arranger.create_target_path( outdir, date, dryrun=False, index=index ) 
+                                                            for date in dates ] )
+    seconds['create_target_file'], names = timed( lambda: [ picture_arranger.create_target_file( path, image, index=index ) 
+                                                            for path, image in zip( paths, images ) ] )
+    targets = [ os.path.join( path, name ) for path, name in zip( paths, names ) ]
+    seconds['move_file'], _ = timed( lambda: [ picture_arranger.move_file( image, target, copy=True ) 
+                                               for image, target in zip( images, targets ) ] )
+    seconds['main'], _ = timed( lambda: run_main( [ '-i', corpus, '-o', os.path.join( workdir, 'main' ), '-c', '-r', '--no-cache', 
+                                                    '--jobs', str( args.jobs ), '--io-jobs', str( args.io_jobs ) ] ) )
+    return seconds
+
+# stages that read or write image data - MB/sec is only reported for these
+DATA_STAGES = ('get_image_creation_date', 'move_file', 'main')
+
+def git_revision():
+    try:
+        return subprocess.check_output( ['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                        cwd=os.path.dirname( os.path.abspath( __file__ ) ) ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    args = parse_options()
+    logging.basicConfig( level=logging.WARNING ) # keep the per-file INFO lines out of the timings
+    workdir = args.workdir or tempfile.mkdtemp( prefix='bench_arranger' )
+    try:
+        corpus = os.path.join( workdir, 'corpus' )
+        files, total = make_corpus( corpus, args )
+        seconds = bench( corpus, workdir, files, args )
+    finally:
+        if args.workdir is None:
+            shutil.rmtree( workdir )
+    results = {}
+    print( "{0} files, {1:.1f} MB".format( files, total / 1e6 ))
+    for stage, elapsed in seconds.items():
+        results[stage] = { 'seconds': elapsed, 'files_per_sec': files / elapsed }
+        if stage in DATA_STAGES:
+            results[stage]['mb_per_sec'] = total / 1e6 / elapsed
+        print( "{0:25} {1:10.1f} files/s {2}".format( stage, results[stage]['files_per_sec'], 
+               "{0:8.1f} MB/s".format( results[stage]['mb_per_sec'] ) if stage in DATA_STAGES else "" ))
+    report = { 'revision': git_revision(), 'python': platform.python_version(), 'platform': platform.platform(),
+               'params': vars( args ), 'files': files, 'bytes': total, 'results': results }
+    if args.json_out:
+        with open( args.json_out, 'w' ) as f:
+            json.dump( report, f, indent=2 )
+    if args.compare:
+        with open( args.compare ) as f:
+            old = json.load( f )
+        print( "\nvs {0} ({1}):".format( args.compare, old.get( 'revision' ) ))
+        for stage, result in results.items():
+            if stage in old['results']:
+                print( "{0:25} {1:8.2f}x".format( stage, result['files_per_sec'] / old['results'][stage]['files_per_sec'] ))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+########################################
+#
+# Picture Arranger - EXIF date micro-benchmark
+#
+# Compares the header-only reader with the PIL path on the images under tests/
+#
+#   python benchmarks/bench_exif.py [-n 200] [dir ...]
+#
+########################################
+
+import os
+import sys
+import timeit
+import argparse
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), '..' ) )
+import picture_arranger
+
+def parse_options():
+    '''Setup and parse the options for this script'''
+    default_dir = os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), '..', 'tests' )
+    parser = argparse.ArgumentParser(description='Benchmark EXIF date extraction.')
+    parser.add_argument('dirs',
+                        nargs='*',
+                        default=[default_dir],
+                        help='Directories to search (recursively) for JPEGs - defaults to tests/')
+    parser.add_argument('-n', '--number',
+                        type=int,
+                        default=200,
+                        help="Passes over the image set per reader")
+    return parser.parse_args()
+
+def find_jpegs( dirs ):
+    '''All .jpg/.jpeg files under dirs, any case'''
+    images = []
+    for top in dirs:
+        for root, _, files in os.walk( top ):
+            images.extend( os.path.join( root, f ) for f in files 
+                           if os.path.splitext( f )[1].lower() in ('.jpg', '.jpeg') )
+    return sorted( images )
+
+def bench( reader, images, number ):
+    '''Seconds per file for reader over images, best of 3'''
+    timer = timeit.Timer( lambda: [ reader( image ) for image in images ] )
+    return min( timer.repeat( repeat=3, number=number ) ) / ( number * len( images ) )
+
+def main():
+    args = parse_options()
+    images = find_jpegs( args.dirs )
+    if not images:
+        sys.exit( "No JPEGs found in {0}".format( args.dirs ))
+    for image in images:
+        if picture_arranger.read_exif_date( image ) != picture_arranger.read_exif_date_pil( image ):
+            sys.exit( "Readers disagree on {0}".format( image ))
+    header = bench( picture_arranger.read_exif_date, images, args.number )
+    pil = bench( picture_arranger.read_exif_date_pil, images, args.number )
+    print( "{0} images, {1} passes".format( len( images ), args.number ))
+    print( "header reader: {0:8.1f} us/file".format( header * 1e6 ))
+    print( "PIL reader:    {0:8.1f} us/file".format( pil * 1e6 ))
+    print( "speedup:       {0:8.1f}x".format( pil / header ))
+
+if __name__ == '__main__':
+    main()
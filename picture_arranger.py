@@ -8,26 +8,52 @@ import os
 import datetime
 import sys
 import shutil
-import glob
+import fnmatch
 import filecmp
 import argparse
 import logging
-from PIL import Image
-from PIL.ExifTags import TAGS
+import logging.handlers
+import queue
+import contextlib
+import copy
+import collections
+import errno
+import concurrent.futures
+import functools
+import hashlib
+import itertools
+import json
+import struct
+import select
+import threading
+import time
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None
+# PIL, sqlite3, numpy and the profiler are imported where they are used, so runs that don't 
+# need them (--apply, --no-cache, or a library caller) don't pay for loading them
 
 class FileSameException(Exception):
     '''
     Custom exception for the file compare
     '''
 
-def parse_options():
-    '''Setup and parse the options for this script'''
+def parse_options( argv=None ):
+    '''Setup and parse the options for this script - argv defaults to sys.argv[1:]. Returns a Config'''
+    parser = build_parser()
+    args = parser.parse_args( argv, namespace=Config() )
+    problem = check_options( args )
+    if problem:
+        parser.error( problem )
+    return args
+
+def build_parser():
+    '''The command line options - each is also the Config setting of the same (long) name'''
     parser = argparse.ArgumentParser(description='Process some images.')
     parser.add_argument('-o', '--outputdir', 
-                        required=True, 
                         help='Output directory')
     parser.add_argument('-i', '--inputdir', 
-                        required=True, 
                         help='Input directory')
     parser.add_argument('-d', '--dryrun', 
                         action='store_true', 
@@ -38,53 +64,1440 @@ def parse_options():
     parser.add_argument('-c', '--copy',
                         action='store_true',
                         help="Copy images - don't move them")
+    parser.add_argument('-t', '--transfer',
+                        choices=TRANSFER_MODES,
+                        default="auto",
+                        help="How files get to the output directory - see move_file. Defaults to auto")
     parser.add_argument('-s', '--skipsame',
                         action='store_true',
-                        help="Skip image if the copy/move target is the same according to filestat")
+                        help="Skip image if an identical file (by content hash) is already anywhere in the output directory")
+    parser.add_argument('--dedup-index',
+                        default=None,
+                        help="Content hash index of the output directory used by --skipsame - defaults to " + DedupIndex.DEFAULT_NAME + " in the output directory")
+    parser.add_argument('--dedup-rescan',
+                        action='store_true',
+                        help="Walk the output directory again to pick up files placed there by other means (for --skipsame and --near-dupes)")
+    parser.add_argument('--near-dupes',
+                        choices=('report', 'skip'),
+                        default=None,
+                        help="Look for pictures that look the same as one already in the output directory (resized, recompressed, ...) and report them, or skip them")
+    parser.add_argument('--near-dupe-distance',
+                        type=int,
+                        default=6,
+                        help="How many of the 64 bits of the image hashes may differ for --near-dupes to count a match - 0 to {0}, defaults to 6".format( NearDupIndex.MAX_DISTANCE ))
+    parser.add_argument('--near-dupe-index',
+                        default=None,
+                        help="Image hash index of the output directory used by --near-dupes - defaults to " + NearDupIndex.DEFAULT_NAME + " in the output directory")
+    parser.add_argument('--catalog',
+                        dest='catalog',
+                        action='store_true',
+                        default=True,
+                        help="Keep a catalog of the files placed in the output directory (default)")
+    parser.add_argument('--no-catalog',
+                        dest='catalog',
+                        action='store_false',
+                        help="Don't read or write the catalog")
+    parser.add_argument('--catalog-file',
+                        default=None,
+                        help="Catalog of the output directory - defaults to " + Catalog.DEFAULT_NAME + " in the output directory")
+    parser.add_argument('--catalog-hash',
+                        action='store_true',
+                        help="Store a content hash of each file in the catalog, for --verify to check - costs a read of every file placed")
+    parser.add_argument('--find-dates',
+                        nargs='+',
+                        metavar='DATE',
+                        default=None,
+                        help="List the catalogued files created on a day, month or year (YYYY[-MM[-DD]]) - or give two, FROM TO")
+    parser.add_argument('--verify',
+                        action='store_true',
+                        help="Check the catalog against the output directory and report missing, changed and untracked files")
+    parser.add_argument('--rebuild-catalog',
+                        action='store_true',
+                        help="Walk the output directory and catalog what is there - needed once for files placed before there was a catalog, or by other means")
     parser.add_argument('--debug',
                         action='store_true',
                         help="enable DEBUG (akin to verbose)")
-    args = parser.parse_args()
-    return args
+    parser.add_argument('-j', '--jobs',
+                        type=int,
+                        default=1,
+                        help="Number of workers reading image creation dates - defaults to 1")
+    parser.add_argument('--io-jobs',
+                        type=int,
+                        default=1,
+                        help="Number of concurrent copy/move transfers - defaults to 1")
+    parser.add_argument('--device-jobs',
+                        type=int,
+                        default=None,
+                        help="Transfers at once reading from or writing to any one device - defaults to 1 for spinning disks, no limit beyond --io-jobs otherwise")
+    parser.add_argument('--bwlimit',
+                        type=parse_rate,
+                        default=None,
+                        help="Cap on bytes per second copied, over all transfers - K, M and G suffixes are powers of 1024 (e.g. 40M)")
+    parser.add_argument('--cache',
+                        dest='cache',
+                        action='store_true',
+                        default=True,
+                        help="Cache creation dates between runs (default)")
+    parser.add_argument('--no-cache',
+                        dest='cache',
+                        action='store_false',
+                        help="Don't read or write the creation date cache")
+    parser.add_argument('--cache-file',
+                        default=None,
+                        help="Creation date cache - defaults to <logfile>.cache, or ~/.cache/picture_arranger/dates.sqlite when logging to STDERR")
+    parser.add_argument('--cache-size',
+                        type=int,
+                        default=DateCache.DEFAULT_MAX_ENTRIES,
+                        help="Most entries kept in the creation date cache - least recently used go first")
+    parser.add_argument('-r', '--recursive',
+                        action='store_true',
+                        help="Look for images in subdirectories of the input directory too")
+    parser.add_argument('-e', '--ext',
+                        dest='extensions',
+                        action='append',
+                        default=None,
+                        help="Image extension to pick up, any case - repeat for more. Defaults to every type there is a date reader for: " + " ".join( IMAGE_EXTENSIONS ))
+    parser.add_argument('--include',
+                        action='append',
+                        default=None,
+                        help="Only pick up files whose name matches this glob pattern - repeat for more")
+    parser.add_argument('--exclude',
+                        action='append',
+                        default=None,
+                        help="Skip files and directories whose name matches this glob pattern - repeat for more")
+    parser.add_argument('--plan-out',
+                        default=None,
+                        help="Work out every move/copy first and write the plan here as JSON lines, then carry it out (unless --dryrun)")
+    parser.add_argument('--apply',
+                        default=None,
+                        help="Carry out a plan written by --plan-out - no image is scanned or parsed")
+    parser.add_argument('--journal',
+                        default=None,
+                        help="Journal of finished transfers - defaults to .picture_arranger.<input dir hash>.journal in the output directory, or <plan>.journal with --apply")
+    parser.add_argument('--resume',
+                        action='store_true',
+                        help="Pick up an interrupted run from its journal - images it finished are skipped without being parsed")
+    parser.add_argument('-w', '--watch',
+                        action='store_true',
+                        help="Keep running: arrange the images already in the input directory, then new ones as they arrive")
+    parser.add_argument('--watch-backend',
+                        choices=('auto', 'inotify', 'poll'),
+                        default='auto',
+                        help="How --watch notices new files - auto uses inotify where there is one, else polling")
+    parser.add_argument('--watch-interval',
+                        type=float,
+                        default=2.0,
+                        help="Seconds between scans for the poll backend")
+    parser.add_argument('--watch-debounce',
+                        type=float,
+                        default=2.0,
+                        help="A batch of new files is arranged once none has arrived for this many seconds")
+    parser.add_argument('--watch-batch',
+                        type=int,
+                        default=1000,
+                        help="... or once it holds this many files")
+    parser.add_argument('--stats',
+                        default=None,
+                        help="Write a JSON summary of per-stage timings, latency histograms and counters here - '-' for STDOUT")
+    parser.add_argument('--profile',
+                        default=None,
+                        help="Run under cProfile and write the stats here (for pstats/snakeviz)")
+    return parser
 
-def get_image_list( input_dir ):
-    '''Get the list of images in the input directory specified on the command line'''
-    files = glob.glob( os.path.join( input_dir, "*.jpg") )
-    logging.info( "List of " + str(len(files)) + " images found in: " + input_dir)
-    return files
+def check_options( args, need_input=True ):
+    '''What is wrong with a set of options, as a message - None if nothing. need_input - the 
+    images will come from args.inputdir (not --apply, or images the caller hands over)'''
+    if args.outputdir is None and not args.apply:
+        return "-o/--outputdir is required unless --apply is given"
+    if need_input and args.inputdir is None and not ( args.apply or catalog_command( args )):
+        return "-i/--inputdir is required unless --apply, --find-dates, --verify or --rebuild-catalog is given"
+    if catalog_command( args ) and not args.catalog:
+        return "--find-dates, --verify and --rebuild-catalog can't be used with --no-catalog"
+    if args.find_dates is not None:
+        if len( args.find_dates ) > 2:
+            return "--find-dates takes a date, or FROM and TO dates"
+        try:
+            date_bounds( *args.find_dates )
+        except ValueError as e:
+            return "--find-dates: {0}".format( e )
+    if args.jobs < 1 or args.io_jobs < 1:
+        return "--jobs and --io-jobs must be at least 1"
+    if args.device_jobs is not None and args.device_jobs < 1:
+        return "--device-jobs must be at least 1"
+    if args.bwlimit is not None and args.bwlimit <= 0:
+        return "--bwlimit must be more than 0"
+    if not 0 <= args.near_dupe_distance <= NearDupIndex.MAX_DISTANCE:
+        return "--near-dupe-distance must be between 0 and {0}".format( NearDupIndex.MAX_DISTANCE )
+    if args.watch and ( args.apply or args.plan_out ):
+        return "--watch can't be used with --apply or --plan-out"
+    if args.copy and args.transfer == "rename":
+        return "--transfer rename can't be used with --copy"
+    return None
 
-def get_image_creation_date( path_to_image ):
-    '''Get the creation date - 'when it was taken' for the image - if this fails, 
-    use the last "modification" time from the statinfo on the file'''
-    exifname2tag = exif_num_dict()
-    exiftags = Image.open( path_to_image )._getexif() #gets exif dict (tag no -> tag value)
+def catalog_command( args ):
+    '''True if args ask for something done with the catalog alone'''
+    return bool( args.find_dates or args.verify or args.rebuild_catalog )
+
+def parse_rate( text ):
+    '''Bytes per second from "40M" and the like - argparse type for --bwlimit'''
+    units = { 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3 }
+    text = text.strip().upper().rstrip( 'B' )
+    scale = units.get( text[-1:], 1 )
     try:
-        date = exiftags[exifname2tag['DateTimeOriginal']]
-    except KeyError:
-        logging.debug("EXIF Tag DateTimeOriginal not found or blank - using last modified time from file info")
-        date = datetime.datetime.fromtimestamp( os.path.getmtime( path_to_image ) ).strftime('%Y:%m:%d %H:%M:%S')
+        return float( text[:-1] if scale > 1 else text ) * scale
+    except ValueError:
+        raise argparse.ArgumentTypeError( "not a rate: {0!r}".format( text ))
+
+@functools.lru_cache( maxsize=None )
+def _option_defaults():
+    return vars( build_parser().parse_args( [], namespace=argparse.Namespace() ))
+
+class Config(argparse.Namespace):
+    '''
+    Settings for an Arranger - an attribute for every command line option, named after its long 
+    form (inputdir, outputdir, copy, skipsame, jobs, ...) and with the same default:
+
+        Config( inputdir="/media/card", outputdir="/archive", copy=True, jobs=4 )
+
+    parse_options returns one of these too.
+    '''
+    def __init__( self, **settings ):
+        unknown = set( settings ) - set( _option_defaults() )
+        if unknown:
+            raise TypeError( "Unknown settings: {0}".format( ", ".join( sorted( unknown ))))
+        super().__init__( **dict( _option_defaults(), **settings ))
+
+# by the header reader that gets their dates - see DATE_READERS
+JPEG_EXTENSIONS = ('.jpg', '.jpeg')
+TIFF_EXTENSIONS = ('.tif', '.tiff', '.dng', '.cr2', '.nef', '.nrw', '.arw', '.orf', '.rw2', '.pef', '.srw')
+PNG_EXTENSIONS = ('.png',)
+BMFF_EXTENSIONS = ('.heic', '.heif', '.avif', '.cr3', '.mp4', '.m4v', '.mov', '.3gp')
+IMAGE_EXTENSIONS = JPEG_EXTENSIONS + TIFF_EXTENSIONS + PNG_EXTENSIONS + BMFF_EXTENSIONS
+HASHABLE_EXTENSIONS = frozenset( JPEG_EXTENSIONS + PNG_EXTENSIONS + ('.tif', '.tiff') ) # ones PIL decodes, for dhash
+
+def get_image_list( input_dir, **kwargs ):
+    '''Get the images in the input directory specified on the command line. A generator of paths - 
+    see scan_images for the options'''
+    for entry in scan_images( input_dir, **kwargs ):
+        yield entry.path
+
+def scan_images( input_dir, recursive=False, extensions=IMAGE_EXTENSIONS, include=None, exclude=None, skip_dirs=() ):
+    '''
+    Stream os.DirEntry objects for the images under input_dir as they are found, rather than 
+    listing everything first - memory stays flat however big the tree is. The entries cache 
+    their stat() so later stages don't have to go back to the disk for it.
+
+    extensions - file extensions to pick up, compared case-insensitively
+    include - if given, only file names matching one of these glob patterns are picked up
+    exclude - file and directory names matching any of these glob patterns are skipped
+    skip_dirs - directories never descended into (e.g. the output directory)'''
+    extensions = normalise_extensions( extensions )
+    skip_dirs = frozenset( os.path.abspath( d ) for d in skip_dirs )
+    logging.info( "Scanning for images in: " + input_dir )
+    todo = [ input_dir ]
+    while todo:
+        directory = todo.pop()
+        try:
+            entries = os.scandir( directory )
+        except OSError as e:
+            logging.warning( "Cannot scan directory [{0}]: {1}".format( directory, e ))
+            continue
+        with entries:
+            for entry in entries:
+                if exclude and any( fnmatch.fnmatch( entry.name, pattern ) for pattern in exclude ):
+                    continue
+                try:
+                    if entry.is_dir( follow_symlinks=False ):
+                        if recursive and os.path.abspath( entry.path ) not in skip_dirs:
+                            todo.append( entry.path )
+                        continue
+                    if not entry.is_file():
+                        continue
+                except OSError:
+                    continue
+                if wanted_image( entry.name, extensions, include=include ):
+                    yield entry
+
+def normalise_extensions( extensions ):
+    '''Extensions as a set of lower case ".ext" strings'''
+    return frozenset( ext.lower() if ext.startswith('.') else '.' + ext.lower() for ext in extensions )
+
+def wanted_image( name, extensions, include=None, exclude=None ):
+    '''Should a file called name be picked up? extensions as from normalise_extensions, include 
+    and exclude as for scan_images'''
+    if os.path.splitext( name )[1].lower() not in extensions:
+        return False
+    if exclude and any( fnmatch.fnmatch( name, pattern ) for pattern in exclude ):
+        return False
+    return not include or any( fnmatch.fnmatch( name, pattern ) for pattern in include )
+
+EXIF_IFD_POINTER = 0x8769
+EXIF_DATETIME_ORIGINAL = 0x9003
+TIFF_MAX_IFD_ENTRIES = 1024 # sanity limit so a corrupt count can't make us read megabytes
+# TIFF and the RAW formats built on it (Olympus and Panasonic change the magic number)
+TIFF_MAGIC = ( b'II*\x00', b'MM\x00*', b'IIRO', b'IIRS', b'IIU\x00' )
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PNG_MAX_CHUNKS = 100000
+BMFF_MAX_BOXES = 4096 # per level - sanity limits for corrupt files
+BMFF_MAX_PAYLOAD = 1024 * 1024 # largest box (iinf, iloc, mvhd, ...) read whole
+BMFF_EPOCH_OFFSET = 2082844800 # seconds from 1904-01-01 (ISO-BMFF/QuickTime times) to 1970-01-01
+
+def get_image_creation_date( path_to_image, cache=None, stats=None ):
+    '''Get the creation date - 'when it was taken' for the image - if this fails, 
+    use the last "modification" time from the statinfo on the file. The EXIF date is read 
+    straight from the file header, PIL is only used if the header reader can't make sense 
+    of the file. If a DateCache is given it is checked first and updated afterwards. 
+    path_to_image can also be an os.DirEntry, in which case its cached stat is used. Where the 
+    date came from is counted in stats, if given'''
+    statinfo = image_stat( path_to_image ) if cache is not None else None
+    path_to_image = os.fspath( path_to_image )
+    if cache is not None:
+        cached = cache.get( statinfo )
+        if cached is not None:
+            date, source = cached
+            logging.debug( "Creation date cache hit (%s) for [%s]", source, path_to_image )
+            logging.info( "Creation date is: %s", date )
+            if stats is not None:
+                stats.count( "date_cache_hits" )
+                stats.count( "date_from_" + source )
+            return date
+    date, source = read_image_creation_date( path_to_image, statinfo=statinfo )
+    if cache is not None:
+        cache.put( statinfo, date, source )
+    if stats is not None:
+        stats.count( "date_from_" + source )
     
-    logging.info("Creation date is: " + str(date))
+    logging.info( "Creation date is: %s", date )
     return date
 
-def exif_num_dict():
-    '''Create a dictionary of EXIF tag name => number to index the EXIF tags in an image. 
-    Basically allows you to ask for EXIF["DateTimeOriginal"] instead of some arbitary number. 
-    See https://sno.phy.queensu.ca/~phil/exiftool/TagNames/EXIF.html for names '''
-    return dict((name, num) for num, name in TAGS.iteritems()) 
+def image_stat( image ):
+    '''stat for a path or an os.DirEntry - a DirEntry only goes to the disk the first time. On 
+    Windows a DirEntry's stat has st_ino and st_dev of 0, no use for telling files apart (as the 
+    DateCache key does), so then the file is stat'ed for real'''
+    if not isinstance( image, os.DirEntry ):
+        return os.stat( image )
+    statinfo = image.stat()
+    return statinfo if statinfo.st_ino else os.stat( image.path )
+
+def read_image_creation_date( path_to_image, statinfo=None ):
+    '''Do the real work for get_image_creation_date. Returns (date, source) where source is 
+    "exif" (the file's own metadata - EXIF, or for a video the movie header) or "mtime" 
+    depending on where the date came from'''
+    try:
+        date = read_header_date( path_to_image )
+    except ValueError as e:
+        with open( path_to_image, 'rb' ) as f:
+            reader = content_date_reader( f.read( 16 ) )
+        if reader is not None and reader.pil_fallback: # a real JPEG, not just a .jpg name
+            logging.debug( "Header reader failed on [%s]: %s - falling back to PIL", path_to_image, e )
+            try:
+                date = read_exif_date_pil( path_to_image )
+            except (OSError, SyntaxError, ValueError) as e: # PIL's errors for a file it can't make out
+                logging.warning( "Cannot read EXIF from [%s]: %s", path_to_image, e )
+                date = None
+        else:
+            logging.debug( "Header reader failed on [%s]: %s", path_to_image, e )
+            date = None
+    if date:
+        return date, "exif"
+    logging.debug("EXIF Tag DateTimeOriginal not found or blank - using last modified time from file info")
+    mtime = statinfo.st_mtime if statinfo is not None else os.path.getmtime( path_to_image )
+    date = datetime.datetime.fromtimestamp( mtime ).strftime('%Y:%m:%d %H:%M:%S')
+    return date, "mtime"
+
+def read_header_date( path_to_image ):
+    '''Date the picture (or video) was taken, from its metadata, by the DATE_READERS entry for 
+    the file - picked by its first bytes, or failing that its extension. Only headers are read, 
+    a few small bounded reads each however big the file. Returns None if the file has no 
+    date, raises ValueError if it isn't a format we understand'''
+    with open( path_to_image, 'rb' ) as f:
+        reader = date_reader( path_to_image, f.read( 16 ) )
+        if reader is None:
+            raise ValueError( "no date reader for this type of file" )
+        f.seek( 0 )
+        return reader.read( f )
+
+def date_reader( path, header=None ):
+    '''The DATE_READERS entry for the file at path whose first bytes are header. The content 
+    wins over the extension - phones happily save HEIC files as .jpg. With no header, or no 
+    match on it, the extension decides (None if it is one we don't know)'''
+    reader = content_date_reader( header ) if header else None
+    return reader or DATE_READERS_BY_EXTENSION.get( os.path.splitext( path )[1].lower() )
+
+def content_date_reader( header ):
+    '''The DATE_READERS entry whose magic matches the first bytes of a file, None if none does'''
+    for reader in DATE_READERS:
+        if any( header[offset:offset + len( magic )] == magic for offset, magic in reader.magic ):
+            return reader
+    return None
+
+def read_exif_date( path_to_image ):
+    '''Read DateTimeOriginal from a JPEG without decoding anything - see read_jpeg_date. 
+    Returns None if the file has no such tag, raises ValueError if it isn't a JPEG we understand'''
+    with open( path_to_image, 'rb' ) as f:
+        return read_jpeg_date( f )
+
+def read_jpeg_date( f ):
+    '''Walk the JPEG markers of the open file f to the APP1 Exif segment, then IFD0 -> Exif IFD 
+    -> tag 0x9003, reading only the bytes on that path'''
+    if f.read( 2 ) != b'\xff\xd8':
+        raise ValueError( "not a JPEG file" )
+    while True:
+        marker = f.read( 2 )
+        while marker[:1] == b'\xff' and marker[1:] == b'\xff': # fill bytes
+            marker = marker[1:] + f.read( 1 )
+        if len( marker ) < 2 or marker[:1] != b'\xff':
+            raise ValueError( "corrupt JPEG marker" )
+        if marker[1:] in (b'\xd9', b'\xda'): # EOI / start of scan - no EXIF from here on
+            return None
+        length_field = f.read( 2 )
+        if len( length_field ) < 2:
+            raise ValueError( "JPEG truncated in a segment header" )
+        length = struct.unpack( '>H', length_field )[0]
+        if length < 2:
+            raise ValueError( "corrupt JPEG segment length" )
+        start = f.tell()
+        if marker[1:] == b'\xe1' and f.read( 6 ) == b'Exif\x00\x00':
+            return read_tiff_date( f, start + 6 )
+        f.seek( start + length - 2 )
+
+def read_tiff_file_date( f ):
+    '''TIFF and TIFF based RAW files (DNG, CR2, NEF, ARW, ...) are a TIFF structure from byte 0'''
+    return read_tiff_date( f, 0 )
+
+def read_png_date( f ):
+    '''Skip from chunk header to chunk header of a PNG to the eXIf chunk, which holds a TIFF 
+    structure. Chunk data other than eXIf is never read'''
+    if f.read( 8 ) != PNG_SIGNATURE:
+        raise ValueError( "not a PNG file" )
+    for _ in range( PNG_MAX_CHUNKS ):
+        header = f.read( 8 )
+        if len( header ) < 8:
+            return None
+        length, chunk_type = struct.unpack( '>I4s', header )
+        start = f.tell()
+        if chunk_type == b'eXIf':
+            if f.read( 6 ) == b'Exif\x00\x00': # not in the spec, but some writers keep it
+                start += 6
+            return read_tiff_date( f, start )
+        if chunk_type == b'IEND':
+            return None
+        f.seek( start + length + 4 ) # data and CRC
+    raise ValueError( "too many PNG chunks" )
+
+def bmff_boxes( f, start, end ):
+    '''The ISO-BMFF boxes between offsets start and end of the open file f - (type, payload 
+    start, payload end) for each, from its header alone. Box contents (a video's mdat, say) 
+    are skipped, not read'''
+    offset = start
+    for _ in range( BMFF_MAX_BOXES ):
+        if offset + 8 > end:
+            return
+        f.seek( offset )
+        size, box_type = struct.unpack( '>I4s', f.read( 8 ) )
+        header_size = 8
+        if size == 1: # 64 bit size follows
+            large = f.read( 8 )
+            if len( large ) < 8:
+                return
+            size = struct.unpack( '>Q', large )[0]
+            header_size = 16
+        elif size == 0: # runs to the end
+            size = end - offset
+        if size < header_size:
+            raise ValueError( "corrupt box size" )
+        yield box_type, offset + header_size, min( offset + size, end )
+        offset += size
+    raise ValueError( "too many boxes" )
+
+def find_box( f, start, end, wanted ):
+    '''(payload start, payload end) of the first box of type wanted between start and end, or None'''
+    for box_type, payload_start, payload_end in bmff_boxes( f, start, end ):
+        if box_type == wanted:
+            return payload_start, payload_end
+    return None
+
+def read_box( f, box ):
+    '''The payload of a (small) box'''
+    start, end = box
+    if end - start > BMFF_MAX_PAYLOAD:
+        raise ValueError( "box too large" )
+    f.seek( start )
+    return f.read( end - start )
+
+def read_bmff_date( f ):
+    '''Date from an ISO-BMFF file: the Exif item of a HEIF/HEIC/AVIF image, else the creation 
+    time in the movie header (moov/mvhd) of an MP4/MOV. Only box headers and the few boxes on 
+    the way are read - a moov after gigabytes of mdat costs a seek'''
+    end = os.fstat( f.fileno() ).st_size
+    try:
+        meta = find_box( f, 0, end, b'meta' )
+        if meta is not None:
+            date = read_heif_exif_date( f, meta )
+            if date:
+                return date
+        moov = find_box( f, 0, end, b'moov' )
+        if moov is None:
+            return None
+        mvhd = find_box( f, moov[0], moov[1], b'mvhd' )
+        return None if mvhd is None else read_mvhd_date( read_box( f, mvhd ))
+    except (struct.error, IndexError, OverflowError) as e:
+        raise ValueError( "corrupt ISO-BMFF file: {0}".format( e ))
+
+def read_mvhd_date( payload ):
+    '''Creation time from a movie header box, in local time like EXIF dates. None if not set'''
+    if payload[0] == 1:
+        created = struct.unpack( '>Q', payload[4:12] )[0]
+    else:
+        created = struct.unpack( '>I', payload[4:8] )[0]
+    if not created:
+        return None
+    try:
+        return datetime.datetime.fromtimestamp( created - BMFF_EPOCH_OFFSET ).strftime( '%Y:%m:%d %H:%M:%S' )
+    except (OSError, OverflowError, ValueError) as e: # a 64 bit time far outside what the platform handles
+        raise ValueError( "bad movie header time {0}: {1}".format( created, e ))
+
+def read_heif_exif_date( f, meta ):
+    '''Find the Exif item in a HEIF meta box: its ID from the item info (iinf) box, where it 
+    is from the item location (iloc) box. The item is a 4 byte offset then a TIFF structure'''
+    children = ( meta[0] + 4, meta[1] ) # meta is a full box - skip version and flags
+    iinf = find_box( f, children[0], children[1], b'iinf' )
+    iloc = find_box( f, children[0], children[1], b'iloc' )
+    if iinf is None or iloc is None:
+        return None
+    item_id = heif_exif_item( f, iinf )
+    if item_id is None:
+        return None
+    extent = heif_item_offset( read_box( f, iloc ), item_id )
+    if extent is None:
+        return None
+    f.seek( extent )
+    base = extent + 4 + struct.unpack( '>I', f.read( 4 ) )[0]
+    f.seek( base )
+    if f.read( 6 ) == b'Exif\x00\x00':
+        base += 6
+    return read_tiff_date( f, base )
+
+def heif_exif_item( f, iinf ):
+    '''ID of the item of type Exif in an iinf box, or None'''
+    version = read_box( f, ( iinf[0], iinf[0] + 1 ))[0]
+    entries_start = iinf[0] + ( 6 if version == 0 else 8 )
+    for box_type, start, end in bmff_boxes( f, entries_start, iinf[1] ):
+        if box_type != b'infe':
+            continue
+        infe = read_box( f, ( start, min( end, start + 16 )))
+        if infe[0] == 2 and infe[8:12] == b'Exif':
+            return struct.unpack( '>H', infe[4:6] )[0]
+        if infe[0] == 3 and infe[10:14] == b'Exif':
+            return struct.unpack( '>I', infe[4:8] )[0]
+    return None
+
+def heif_item_offset( iloc, item_id ):
+    '''File offset of item_id from an iloc box payload, or None'''
+    version = iloc[0]
+    offset_size, length_size = iloc[4] >> 4, iloc[4] & 0xf
+    base_offset_size = iloc[5] >> 4
+    index_size = iloc[5] & 0xf if version in (1, 2) else 0
+    id_size = 4 if version == 2 else 2
+    pos = 6
+    item_count = int.from_bytes( iloc[pos:pos + id_size], 'big' )
+    pos += id_size
+    for _ in range( item_count ):
+        this_id = int.from_bytes( iloc[pos:pos + id_size], 'big' )
+        pos += id_size
+        construction_method = 0
+        if version in (1, 2):
+            construction_method = iloc[pos + 1] & 0xf
+            pos += 2
+        pos += 2 # data reference index
+        base_offset = int.from_bytes( iloc[pos:pos + base_offset_size], 'big' )
+        pos += base_offset_size
+        extent_count = struct.unpack( '>H', iloc[pos:pos + 2] )[0]
+        pos += 2
+        first_offset = None
+        for extent in range( extent_count ):
+            pos += index_size
+            if extent == 0:
+                first_offset = int.from_bytes( iloc[pos:pos + offset_size], 'big' )
+            pos += offset_size + length_size
+        if this_id == item_id:
+            if construction_method != 0 or first_offset is None:
+                return None # in the idat box, or by reference - not seen in Exif items
+            return base_offset + first_offset
+    return None
+
+def read_tiff_date( f, base ):
+    '''Follow a TIFF structure starting at offset base in the open file f: IFD0 -> Exif IFD -> 
+    DateTimeOriginal. Returns the date string or None'''
+    f.seek( base )
+    header = f.read( 8 )
+    if len( header ) < 8 or header[:4] not in TIFF_MAGIC:
+        raise ValueError( "bad TIFF header" )
+    endian = '<' if header[:2] == b'II' else '>'
+    ifd0 = struct.unpack( endian + 'I', header[4:8] )[0]
+    entry = find_ifd_entry( f, base, ifd0, endian, EXIF_IFD_POINTER )
+    if entry is None:
+        return None
+    exif_ifd = struct.unpack( endian + 'I', entry[2] )[0]
+    entry = find_ifd_entry( f, base, exif_ifd, endian, EXIF_DATETIME_ORIGINAL )
+    if entry is None:
+        return None
+    return read_ifd_ascii( f, base, endian, entry )
+
+def find_ifd_entry( f, base, offset, endian, tag ):
+    '''Scan the IFD at offset (relative to base) for tag. Returns (type, count, value field) 
+    or None'''
+    f.seek( base + offset )
+    count_field = f.read( 2 )
+    if len( count_field ) < 2:
+        raise ValueError( "IFD offset past end of file" )
+    count = struct.unpack( endian + 'H', count_field )[0]
+    if count > TIFF_MAX_IFD_ENTRIES:
+        raise ValueError( "IFD entry count {0} too large".format( count ))
+    entries = f.read( count * 12 )
+    for i in range( 0, len( entries ) - 11, 12 ):
+        entry_tag, entry_type, entry_count = struct.unpack( endian + 'HHI', entries[i:i + 8] )
+        if entry_tag == tag:
+            return entry_type, entry_count, entries[i + 8:i + 12]
+    return None
+
+def read_ifd_ascii( f, base, endian, entry ):
+    '''Decode an ASCII IFD entry - short values live in the entry itself, longer ones at an offset'''
+    entry_type, count, value = entry
+    if entry_type != 2 or count > 256:
+        return None
+    if count > 4:
+        f.seek( base + struct.unpack( endian + 'I', value )[0] )
+        value = f.read( count )
+    return value[:count].split( b'\x00' )[0].decode( 'ascii', 'replace' ).strip() or None
+
+def read_exif_date_pil( path_to_image ):
+    '''Slow path - let PIL decode the whole EXIF block and pick DateTimeOriginal out of it'''
+    from PIL import Image
+    with Image.open( path_to_image ) as img:
+        exiftags = img._getexif() or {} #gets exif dict (tag no -> tag value)
+    date = exiftags.get( EXIF_DATETIME_ORIGINAL )
+    return date.strip() if date else None
+
+DateReader = collections.namedtuple( 'DateReader', 'name extensions magic read pil_fallback' )
+# Header readers by format: magic is (offset, bytes) pairs any of which identifies the format. 
+# pil_fallback - PIL can get the date where the header reader fails
+DATE_READERS = (
+    DateReader( "jpeg", JPEG_EXTENSIONS, ( (0, b'\xff\xd8'), ), read_jpeg_date, True ),
+    DateReader( "tiff", TIFF_EXTENSIONS, tuple( (0, magic) for magic in TIFF_MAGIC ), read_tiff_file_date, False ),
+    DateReader( "png", PNG_EXTENSIONS, ( (0, PNG_SIGNATURE), ), read_png_date, False ),
+    DateReader( "bmff", BMFF_EXTENSIONS, tuple( (4, box) for box in ( b'ftyp', b'moov', b'mdat', b'wide', b'free' )), 
+                read_bmff_date, False ),
+)
+DATE_READERS_BY_EXTENSION = dict( ( ext, reader ) for reader in DATE_READERS for ext in reader.extensions )
+
+# seconds to wait for another run (sharing a cache or dedup index) to finish writing
+SQLITE_LOCK_TIMEOUT = 60.0
+
+class IndexWrites(object):
+    '''
+    Writes to one of the output directory's indexes, held back and made together in one short 
+    transaction once there are FLUSH_EVERY of them or the oldest is FLUSH_INTERVAL seconds old 
+    (checked as writes come in) - a few fsyncs a second at most, however fast files are placed, 
+    and no lock held between batches, so runs sharing the output directory don't wait on each 
+    other for long. Reads through the connection don't see writes still held back.
+    '''
+    FLUSH_EVERY = 100
+    FLUSH_INTERVAL = 0.5
+
+    def __init__( self, db ):
+        self.db = db
+        self.writes = [] # (statement, parameters)
+        self.oldest = None
+
+    def add( self, statement, parameters ):
+        if not self.writes:
+            self.oldest = time.time()
+        self.writes.append( ( statement, parameters ) )
+        if len( self.writes ) >= self.FLUSH_EVERY or time.time() - self.oldest >= self.FLUSH_INTERVAL:
+            self.flush()
+
+    def flush( self ):
+        for statement, parameters in self.writes:
+            self.db.execute( statement, parameters )
+        self.db.commit()
+        self.writes = []
+
+class DateCache(object):
+    '''
+    On-disk (SQLite) cache of resolved creation dates, so a dryrun followed by the real run - or a 
+    rerun after an interrupted job - doesn't parse every image twice.
+
+    Entries are keyed on (device, inode, size, mtime_ns): a file that is rewritten or touched 
+    misses and gets parsed again. Each entry records where the date came from ("exif" or "mtime") 
+    and when it was last used, and the least recently used entries are evicted on close() once 
+    there are more than max_entries. Safe to share between the date reader threads.
+    '''
+    DEFAULT_MAX_ENTRIES = 1000000
+    FLUSH_EVERY = 1000
+
+    def __init__( self, path, max_entries=DEFAULT_MAX_ENTRIES ):
+        self.path = path
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.writes = []
+        self.touches = []
+        cache_dir = os.path.dirname( os.path.abspath( path ) )
+        if not os.path.isdir( cache_dir ):
+            os.makedirs( cache_dir )
+        import sqlite3
+        self.db = sqlite3.connect( path, timeout=SQLITE_LOCK_TIMEOUT, check_same_thread=False )
+        self.db.execute( "CREATE TABLE IF NOT EXISTS dates ("
+                         " dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER,"
+                         " date TEXT, source TEXT, used REAL,"
+                         " PRIMARY KEY (dev, ino, size, mtime_ns))" )
+        self.db.execute( "CREATE INDEX IF NOT EXISTS dates_used ON dates (used)" )
+        self.db.commit()
+
+    @staticmethod
+    def key( statinfo ):
+        return ( statinfo.st_dev, statinfo.st_ino, statinfo.st_size, statinfo.st_mtime_ns )
+
+    def get( self, statinfo ):
+        '''(date, source) for the file described by statinfo, or None on a miss'''
+        key = self.key( statinfo )
+        with self.lock:
+            row = self.db.execute( "SELECT date, source FROM dates"
+                                   " WHERE dev=? AND ino=? AND size=? AND mtime_ns=?", key ).fetchone()
+            if row is not None:
+                self.touches.append( (time.time(),) + key )
+                self._maybe_flush()
+        return row
+
+    def put( self, statinfo, date, source ):
+        with self.lock:
+            self.writes.append( self.key( statinfo ) + ( date, source, time.time() ) )
+            self._maybe_flush()
+
+    def _maybe_flush( self ):
+        if len( self.writes ) + len( self.touches ) >= self.FLUSH_EVERY:
+            self._flush()
+
+    def _flush( self ):
+        self.db.executemany( "INSERT OR REPLACE INTO dates VALUES (?, ?, ?, ?, ?, ?, ?)", self.writes )
+        self.db.executemany( "UPDATE dates SET used=?"
+                             " WHERE dev=? AND ino=? AND size=? AND mtime_ns=?", self.touches )
+        self.db.commit()
+        self.writes = []
+        self.touches = []
+
+    def close( self ):
+        '''Write out anything pending and evict down to max_entries'''
+        with self.lock:
+            self._flush()
+            count = self.db.execute( "SELECT COUNT(*) FROM dates" ).fetchone()[0]
+            if count > self.max_entries:
+                logging.debug( "Evicting {0} entries from date cache [{1}]".format( count - self.max_entries, self.path ))
+                self.db.execute( "DELETE FROM dates WHERE rowid IN"
+                                 " (SELECT rowid FROM dates ORDER BY used, rowid LIMIT ?)", ( count - self.max_entries, ))
+                self.db.commit()
+            self.db.close()
+
+def default_cache_file( logfile ):
+    '''Keep the cache next to the log - or in the user cache directory when logging to STDERR'''
+    if logfile != "STDERR":
+        return logfile + ".cache"
+    cache_home = os.environ.get( "XDG_CACHE_HOME" ) or os.path.join( os.path.expanduser( "~" ), ".cache" )
+    return os.path.join( cache_home, "picture_arranger", "dates.sqlite" )
+
+class TargetIndex(object):
+    '''
+    Per-run picture of the output tree, so choosing a target doesn't go back to the filesystem 
+    for every image. Each target directory is listed once, the first time an image heads there; 
+    after that clash checks are set lookups. The next (n) suffix that might be free is remembered 
+    per file name, so a burst of thousands of same-named images doesn't re-probe (1), (2), ... 
+    every time. Directories known to exist (or that we created) are remembered as well.
+
+    Names handed out by create_target_file are claimed here straight away, so they count as 
+    taken even before the copy/move has written them. With placeholders on, a claim also 
+    creates an empty file under the name (O_CREAT|O_EXCL), so it holds against other runs 
+    filling the same output directory - from this host or another on a shared mount. The 
+    transfer then renames over the placeholder. Each claim goes in the journal, if given, 
+    before its placeholder is made - see claim_placeholder.
+
+    Given a complete Catalog, a directory's names come from that instead of a listing. A name 
+    taken by a file the catalog doesn't know of is still safe with placeholders on: the claim 
+    fails and the next name is tried.
+    '''
+    def __init__( self, placeholders=False, catalog=None, journal=None ):
+        self.dirs = set() # directories known to exist - or, on a dryrun, that would
+        self.names = {} # directory => set of file names taken
+        self.next_free = {} # (directory, file name) => every (n) below this is taken
+        self.placeholders = placeholders
+        self.journal = journal
+        self.catalog = catalog if catalog is not None and catalog.complete else None
+
+    def taken( self, directory ):
+        '''The set of names taken in directory - listed from disk (or the catalog) on first use'''
+        names = self.names.get( directory )
+        if names is None and self.catalog is not None:
+            names = self.names[directory] = self.catalog.names( directory )
+        elif names is None:
+            try:
+                names = set( os.listdir( directory ) )
+            except FileNotFoundError:
+                names = set()
+            self.names[directory] = names
+        return names
+
+    def claim( self, directory, name ):
+        '''Take name in directory - False if another run got there first'''
+        self.taken( directory ).add( name )
+        return not self.placeholders or claim_placeholder( os.path.join( directory, name ), self.journal )
+
+def claim_placeholder( path, journal=None ):
+    '''create_placeholder, journalled first: if the run dies before the transfer, recovery finds 
+    the empty file in the journal and removes it (see Journal). False if path is taken'''
+    if journal is not None:
+        journal.record( "claim", { "target": path } )
+    if create_placeholder( path ):
+        return True
+    if journal is not None:
+        journal.record( "release", { "target": path } )
+    return False
+
+def create_placeholder( path ):
+    '''Atomically create an empty file at path. False if something is there already'''
+    try:
+        os.close( os.open( path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666 ) )
+    except FileExistsError:
+        return False
+    return True
+
+def remove_placeholder( path ):
+    '''Remove the placeholder left at path by a transfer that failed - if it is still empty'''
+    try:
+        if os.lstat( path ).st_size == 0:
+            os.unlink( path )
+    except FileNotFoundError:
+        pass
+
+HASH_BLOCK_SIZE = 64 * 1024
+
+def partial_hash( path, size ):
+    '''Hash of the first and last blocks of a file - cheap, and enough to tell most same-sized 
+    files apart'''
+    digest = hashlib.blake2b( digest_size=16 )
+    with open( path, 'rb' ) as f:
+        digest.update( f.read( HASH_BLOCK_SIZE ) )
+        if size > 2 * HASH_BLOCK_SIZE:
+            f.seek( size - HASH_BLOCK_SIZE )
+            digest.update( f.read( HASH_BLOCK_SIZE ) )
+    return digest.digest()
+
+def full_hash( path ):
+    '''Hash of the whole file'''
+    digest = hashlib.blake2b( digest_size=16 )
+    with open( path, 'rb' ) as f:
+        for block in iter( functools.partial( f.read, 16 * HASH_BLOCK_SIZE ), b'' ):
+            digest.update( block )
+    return digest.digest()
+
+def connect_index( path, dryrun=False ):
+    '''SQLite connection to an index kept in the output directory. On a dryrun it is to an 
+    in-memory copy of the index (empty if there is none yet), so nothing reaches the disk'''
+    import sqlite3
+    if not dryrun:
+        if not os.path.isdir( os.path.dirname( os.path.abspath( path ) ) ):
+            os.makedirs( os.path.dirname( os.path.abspath( path ) ) )
+        return sqlite3.connect( path, timeout=SQLITE_LOCK_TIMEOUT )
+    db = sqlite3.connect( ":memory:" )
+    if os.path.exists( path ):
+        existing = sqlite3.connect( path, timeout=SQLITE_LOCK_TIMEOUT )
+        try:
+            existing.backup( db )
+        finally:
+            existing.close()
+    return db
+
+class DedupIndex(object):
+    '''
+    Persistent (SQLite) index of the files in the output tree, used by --skipsame to find an 
+    identical file anywhere in the archive, under any name or date.
+
+    Files are bucketed by size, which comes from a stat. Only when an incoming image shares a 
+    size with something in the archive are the first and last blocks hashed, and only when 
+    those match too is the whole file hashed. Hashes are stored as they are computed, so 
+    each archive file is read at most once over the life of the index. Entries are checked 
+    against a fresh stat before use and dropped or re-hashed if the file has gone or changed.
+
+    The tree is walked once to build the index (or again with rescan=True) - or, given a 
+    complete Catalog, the files are listed from that instead. After that add() notes each 
+    file as it is planned, in memory only, and done() stores it once its transfer has 
+    finished - a transfer that fails or is skipped leaves nothing behind. Files planned in 
+    this run are read from their source until the target is written - so duplicates within 
+    one run are caught on a dryrun, or while planning, too. A dryrun works on an in-memory copy of the 
+    index, so nothing it builds, refreshes or places is stored.
+
+    Runs filling one output directory share the index, so what is learnt - hashes, refreshed 
+    and placed entries - is written out in short batches (see IndexWrites), and the write lock 
+    is never held while transfers or date reads go on. Entries this run has looked at are kept 
+    in memory as it last saw them, so writes still held back don't cost a second hashing.
+    '''
+    DEFAULT_NAME = ".picture_arranger.dedup"
+
+    def __init__( self, path, root, extensions=IMAGE_EXTENSIONS, rescan=False, dryrun=False, catalog=None ):
+        self.root = os.path.abspath( root )
+        self.dryrun = dryrun
+        self.source = None # [image, partial hash, full hash] from the last lookup
+        self.placed = {} # target => (image, [partial hash, full hash]) for files planned this run
+        self.placed_sizes = collections.defaultdict( list ) # size => targets placed this run
+        self.seen = {} # relpath => [size, mtime_ns, [partial hash, full hash]] as last seen, None if gone
+        self.db = connect_index( path, dryrun )
+        self.writes = IndexWrites( self.db )
+        self.db.execute( "CREATE TABLE IF NOT EXISTS files ("
+                         " path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, partial BLOB, full BLOB)" )
+        self.db.execute( "CREATE INDEX IF NOT EXISTS files_size ON files (size)" )
+        self.db.execute( "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)" )
+        built = self.db.execute( "SELECT value FROM meta WHERE key='built'" ).fetchone()
+        if rescan or built is None:
+            self.build( extensions, catalog )
+
+    def build( self, extensions, catalog=None ):
+        '''Walk the output tree - or go through a complete catalog of it - and record the size 
+        of every image in it'''
+        logging.info( "Building dedup index of [{0}]".format( self.root ))
+        known = dict( self.db.execute( "SELECT path, mtime_ns FROM files" ) )
+        found = set()
+        changed = []
+        if catalog is not None and catalog.complete:
+            files = catalog.files()
+        else:
+            files = ( ( os.path.relpath( entry.path, self.root ), entry.stat().st_size, entry.stat().st_mtime_ns ) 
+                      for entry in scan_images( self.root, recursive=True, extensions=extensions ))
+        for relpath, size, mtime_ns in files:
+            found.add( relpath )
+            if known.get( relpath ) != mtime_ns:
+                changed.append( ( relpath, size, mtime_ns ))
+        # written in one go once the walk is done, not holding the lock through it
+        self.db.executemany( "INSERT OR REPLACE INTO files VALUES (?, ?, ?, NULL, NULL)", changed )
+        self.db.executemany( "DELETE FROM files WHERE path=?", [ (p,) for p in set( known ) - found ] )
+        self.db.execute( "INSERT OR REPLACE INTO meta VALUES ('built', ?)", ( str( time.time() ), ))
+        self.db.commit()
+
+    def refresh( self, relpath, entry ):
+        '''Check an entry - a seen value - against the disk, updating it. Returns its [partial, 
+        full] hashes - None where not known (yet) - or None if the entry is gone'''
+        try:
+            statinfo = os.stat( os.path.join( self.root, relpath ) )
+        except FileNotFoundError:
+            self.seen[relpath] = None
+            self.writes.add( "DELETE FROM files WHERE path=?", ( relpath, ))
+            return None
+        # no mtime - stored before its transfer by an older version, so the hashes may not be of 
+        # what is there: hash it again
+        if entry[1] is None or statinfo.st_mtime_ns != entry[1] or statinfo.st_size != entry[0]:
+            entry[:] = [ statinfo.st_size, statinfo.st_mtime_ns, [ None, None ] ]
+            self.writes.add( "UPDATE files SET size=?, mtime_ns=?, partial=NULL, full=NULL WHERE path=?", 
+                             ( statinfo.st_size, statinfo.st_mtime_ns, relpath ))
+        return entry[2]
+
+    def find_duplicate( self, image, size, pending=None ):
+        '''Path of a file in the output tree - or placed there earlier in this run - with the same 
+        content as image, or None. pending - dict of target path => Future, waited on before a 
+        target is read'''
+        self.source = [ image, None, None ]
+        candidates = self.db.execute( "SELECT path, size, mtime_ns, partial, full FROM files WHERE size=?", ( size, )).fetchall()
+        for relpath, row_size, mtime_ns, partial, full in candidates:
+            target = os.path.join( self.root, relpath )
+            if target in self.placed:
+                continue # checked below
+            entry = self.seen.setdefault( relpath, [ row_size, mtime_ns, [ partial, full ] ] )
+            if entry is None or entry[0] != size:
+                continue # gone or changed, as far as this run knows
+            hashes = self.refresh( relpath, entry )
+            if hashes is not None and entry[0] == size and self.same_content( target, size, hashes, relpath ):
+                return target
+        for target in self.placed_sizes.get( size, () ):
+            placed_image, hashes = self.placed[target]
+            if pending and target in pending:
+                pending[target].result()
+            # not written yet (a dryrun, or a plan not carried out yet) - read the source instead
+            path = target if os.path.exists( target ) else placed_image
+            relpath = None if self.dryrun else os.path.relpath( target, self.root )
+            if self.same_content( path, size, hashes, relpath ):
+                return target
+        return None
+
+    def same_content( self, path, size, hashes, relpath=None ):
+        '''Compare the file at path with the image from the last find_duplicate, filling in hashes 
+        (a [partial, full] list for path) only as far as needed. New hashes are stored under relpath'''
+        if hashes[0] is None:
+            hashes[0] = partial_hash( path, size )
+            self.store( relpath, "partial", hashes[0] )
+        if self.source[1] is None:
+            self.source[1] = partial_hash( self.source[0], size )
+        if hashes[0] != self.source[1]:
+            return False
+        if hashes[1] is None:
+            hashes[1] = full_hash( path )
+            self.store( relpath, "full", hashes[1] )
+        if self.source[2] is None:
+            self.source[2] = full_hash( self.source[0] )
+        return hashes[1] == self.source[2]
+
+    def store( self, relpath, column, value ):
+        if relpath is not None:
+            self.writes.add( "UPDATE files SET {0}=? WHERE path=?".format( column ), ( value, relpath ))
+
+    def add( self, target, image, size ):
+        '''Note image as planned for target - reusing any hashes the last lookup made of it'''
+        hashes = self.source[1:] if self.source and self.source[0] == image else [ None, None ]
+        self.placed[target] = ( image, hashes )
+        self.placed_sizes[size].append( target )
+
+    def done( self, target ):
+        '''Store the file just written at target, with the hashes of the image planned for it 
+        (if it was planned by this run)'''
+        if self.dryrun:
+            return
+        hashes = self.placed[target][1] if target in self.placed else [ None, None ]
+        statinfo = os.stat( target )
+        self.writes.add( "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)", 
+                         ( os.path.relpath( target, self.root ), statinfo.st_size, statinfo.st_mtime_ns, hashes[0], hashes[1] ))
+
+    def close( self ):
+        self.writes.flush()
+        self.db.close()
+
+DHASH_SIZE = 8 # dhash is DHASH_SIZE x DHASH_SIZE bits
+HASH_BITS = DHASH_SIZE * DHASH_SIZE
+
+def dhash( path ):
+    '''64 bit difference hash of an image: shrink it to 9x8 grey pixels and set a bit wherever a 
+    pixel is brighter than its right hand neighbour. Survives resizing, recompression and small 
+    edits. JPEGs are decoded at reduced scale (down to 1/8) with draft(), so this costs a 
+    fraction of a full decode. Raises OSError for files PIL can't read'''
+    from PIL import Image, ImageOps
+    with Image.open( path ) as img:
+        img.draft( 'L', ( DHASH_SIZE + 1, DHASH_SIZE ))
+        img = ImageOps.exif_transpose( img ) # compare the picture as it is shown
+        pixels = img.convert( 'L' ).resize( ( DHASH_SIZE + 1, DHASH_SIZE ), Image.BILINEAR ).tobytes()
+    value = 0
+    for row in range( DHASH_SIZE ):
+        for col in range( DHASH_SIZE ):
+            i = row * ( DHASH_SIZE + 1 ) + col
+            value = ( value << 1 ) | ( pixels[i] > pixels[i + 1] )
+    return value
+
+def hamming_distances( value, hashes ):
+    '''Bits that differ between value and each of hashes - with numpy, done in one vectorised 
+    pass over the batch'''
+    numpy = optional_numpy()
+    if numpy is None:
+        return [ bin( value ^ h ).count( '1' ) for h in hashes ]
+    xor = numpy.array( hashes, dtype=numpy.uint64 ) ^ numpy.uint64( value )
+    if hasattr( numpy, 'bitwise_count' ):
+        return numpy.bitwise_count( xor ).tolist()
+    return numpy.unpackbits( xor.view( numpy.uint8 )).reshape( -1, HASH_BITS ).sum( axis=1 ).tolist()
+
+@functools.lru_cache( maxsize=None )
+def optional_numpy():
+    '''numpy if it is installed, else None - it only speeds up --near-dupes'''
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+@functools.lru_cache( maxsize=None )
+def bit_flips( bits, radius ):
+    '''Every mask of bits bits with at most radius bits set'''
+    return tuple( sum( 1 << bit for bit in combo ) 
+                  for r in range( radius + 1 ) for combo in itertools.combinations( range( bits ), r ) )
+
+def signed64( value ):
+    '''value (0 - 2**64-1) as the signed 64 bit integer SQLite can store'''
+    return value - ( 1 << 64 ) if value >= 1 << 63 else value
+
+class NearDupIndex(object):
+    '''
+    Persistent (SQLite) index of the dhash of every image in the output tree, used by 
+    --near-dupes to find pictures that look the same as an incoming one - a resized, 
+    recompressed or re-exported copy - anywhere in the archive.
+
+    Lookups don't compare against every hash. It is a multi-index hash table: each 64 bit hash 
+    is split into BANDS bands of 16 bits, each band column indexed. If two hashes are within 
+    distance d, at least one band is within d // BANDS of the other's (pigeonhole), so a lookup 
+    is a handful of indexed IN queries over the band values that close - a few hundred rows 
+    at most out of millions. Only those candidates have their full distance worked out, in 
+    one batch (see hamming_distances).
+
+    The tree is walked once to build the index (or again with rescan=True), hashing on jobs 
+    threads; after that add() records each image as it is placed. Entries are checked against 
+    a fresh stat before they are reported and dropped or re-hashed if the file has gone or 
+    changed. A dryrun works on an in-memory copy of the index - what it places is seen by this 
+    run's lookups, but nothing is stored. As with DedupIndex, writes are made in short batches 
+    (see IndexWrites), so runs sharing the index don't wait on each other - images placed while 
+    their rows are held back are matched from memory, as are entries this run has refreshed.
+    '''
+    DEFAULT_NAME = ".picture_arranger.neardup"
+    BANDS = 4
+    BAND_BITS = HASH_BITS // BANDS
+    MAX_DISTANCE = 15 # keeps each band lookup to under 700 values
+
+    def __init__( self, path, root, distance, extensions=IMAGE_EXTENSIONS, rescan=False, dryrun=False, jobs=1 ):
+        self.root = os.path.abspath( root )
+        self.distance = distance
+        self.dryrun = dryrun
+        self.placed = set() # relpaths placed this run - maybe not written yet
+        self.held = {} # relpath => (None, hash) placed while the write is held back
+        self.seen = {} # relpath => (mtime_ns, hash) as refreshed by this run, None if gone
+        self.db = connect_index( path, dryrun )
+        self.writes = IndexWrites( self.db )
+        self.db.execute( "CREATE TABLE IF NOT EXISTS hashes (path TEXT PRIMARY KEY, mtime_ns INTEGER, hash INTEGER, {0})".format( 
+                         ", ".join( "b{0} INTEGER".format( band ) for band in range( self.BANDS ) )))
+        for band in range( self.BANDS ):
+            self.db.execute( "CREATE INDEX IF NOT EXISTS hashes_b{0} ON hashes (b{0})".format( band ) )
+        self.db.execute( "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)" )
+        built = self.db.execute( "SELECT value FROM meta WHERE key='built'" ).fetchone()
+        if rescan or built is None:
+            self.build( extensions, jobs )
+        
+    def bands( self, value ):
+        mask = ( 1 << self.BAND_BITS ) - 1
+        return [ ( value >> ( band * self.BAND_BITS )) & mask for band in range( self.BANDS ) ]
+
+    def row( self, relpath, mtime_ns, value ):
+        return [ relpath, mtime_ns, signed64( value ) ] + self.bands( value )
+
+    def build( self, extensions, jobs=1 ):
+        '''Walk the output tree and hash every image not already indexed as it is now'''
+        logging.info( "Building near duplicate index of [{0}]".format( self.root ))
+        known = dict( self.db.execute( "SELECT path, mtime_ns FROM hashes" ) )
+        found = set()
+        changed = []
+        for entry in scan_images( self.root, recursive=True, extensions=extensions ):
+            relpath = os.path.relpath( entry.path, self.root )
+            found.add( relpath )
+            mtime_ns = entry.stat().st_mtime_ns
+            if known.get( relpath ) != mtime_ns:
+                changed.append( ( relpath, mtime_ns ) )
+        rows = []
+        with worker_pool( jobs ) as hashers:
+            for ( relpath, mtime_ns ), value in ordered_map( hashers, self.hash_file, changed, jobs * 2 ):
+                if value is not None:
+                    rows.append( self.row( relpath, mtime_ns, value ))
+        # written once the hashing is done, not holding the lock through it
+        self.db.executemany( "INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?)", rows )
+        self.db.executemany( "DELETE FROM hashes WHERE path=?", [ (p,) for p in set( known ) - found ] )
+        self.db.execute( "INSERT OR REPLACE INTO meta VALUES ('built', ?)", ( str( time.time() ), ))
+        self.db.commit()
+
+    def hash_file( self, item ):
+        '''dhash of the (relpath, mtime_ns) item - None if it can't be read as an image'''
+        if os.path.splitext( item[0] )[1].lower() not in HASHABLE_EXTENSIONS:
+            return None
+        try:
+            return dhash( os.path.join( self.root, item[0] ) )
+        except (OSError, ValueError) as e:
+            logging.debug( "Cannot hash [%s]: %s", item[0], e )
+            return None
+
+    def find( self, value ):
+        '''(path, distance) of the closest image in the output tree - or placed there earlier in 
+        this run - within distance of the dhash value, or None'''
+        radius = self.distance // self.BANDS
+        candidates = {}
+        for band, band_value in enumerate( self.bands( value ) ):
+            values = [ band_value ^ flip for flip in bit_flips( self.BAND_BITS, radius ) ]
+            query = "SELECT path, mtime_ns, hash FROM hashes WHERE b{0} IN ({1})".format( band, ",".join( "?" * len( values ) ))
+            for relpath, mtime_ns, stored in self.db.execute( query, values ):
+                candidates[relpath] = self.seen.get( relpath, ( mtime_ns, stored & ( ( 1 << HASH_BITS ) - 1 )))
+        if not self.writes.writes:
+            self.held.clear() # all written - the query found them
+        candidates.update( self.held )
+        candidates = dict( ( relpath, known ) for relpath, known in candidates.items() if known is not None )
+        if not candidates:
+            return None
+        paths = list( candidates )
+        distances = hamming_distances( value, [ candidates[p][1] for p in paths ] )
+        for distance, relpath in sorted( zip( distances, paths )):
+            if distance > self.distance:
+                break
+            if self.still_there( relpath, candidates[relpath], value ):
+                return os.path.join( self.root, relpath ), distance
+        return None
+
+    def still_there( self, relpath, known, value ):
+        '''Check a matching entry - its (mtime_ns, hash) - against the disk, re-hashing it if it 
+        has changed'''
+        if relpath in self.placed:
+            return True
+        mtime_ns, stored = known
+        try:
+            statinfo = os.stat( os.path.join( self.root, relpath ) )
+        except FileNotFoundError:
+            self.seen[relpath] = None
+            self.writes.add( "DELETE FROM hashes WHERE path=?", ( relpath, ))
+            return False
+        if mtime_ns is None: # placed by an earlier run - the hash came from the source
+            self.seen[relpath] = ( statinfo.st_mtime_ns, stored )
+            self.writes.add( "UPDATE hashes SET mtime_ns=? WHERE path=?", ( statinfo.st_mtime_ns, relpath ))
+        elif statinfo.st_mtime_ns != mtime_ns:
+            new_value = self.hash_file( ( relpath, statinfo.st_mtime_ns ))
+            if new_value is None:
+                self.seen[relpath] = None
+                self.writes.add( "DELETE FROM hashes WHERE path=?", ( relpath, ))
+                return False
+            self.seen[relpath] = ( statinfo.st_mtime_ns, new_value )
+            self.writes.add( "INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?)", 
+                             self.row( relpath, statinfo.st_mtime_ns, new_value ))
+            return hamming_distances( value, [ new_value ] )[0] <= self.distance
+        return True
+
+    def add( self, target, value ):
+        '''Record the image with dhash value as placed at target'''
+        relpath = os.path.relpath( target, self.root )
+        self.placed.add( relpath )
+        self.held[relpath] = ( None, value )
+        self.writes.add( "INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?)", self.row( relpath, None, value ))
+
+    def close( self ):
+        self.writes.flush()
+        self.db.close()
+
+def date_bounds( start, end=None ):
+    '''(low, high) creation dates (2015:03:29 12:45:50 form) for Catalog.find - from the start of 
+    the year, month or day start names ("2015", "2015-03", "2015-03-29") to the end of end's, or 
+    of start's if no end is given. Raises ValueError for anything else'''
+    bounds = []
+    for text in ( start, end or start ):
+        parts = text.replace( '-', ':' ).replace( '/', ':' ).split( ':' )
+        if not ( len( parts ) <= 3 and len( parts[0] ) == 4 and all( len( part ) == 2 for part in parts[1:] ) 
+                 and all( part.isdigit() for part in parts )):
+            raise ValueError( "not a date: {0!r} - give YYYY, YYYY-MM or YYYY-MM-DD".format( text ))
+        bounds.append( ":".join( parts ))
+    return bounds[0], bounds[1] + "~" # sorts after any time on that day, month or year
+
+class Catalog(object):
+    '''
+    Persistent (SQLite) catalog of the output tree: a row per file placed there with its path, 
+    size, mtime, creation date, the source it came from and - with hashes=True - a content 
+    hash. It tells what is in the archive without walking the YYYY/MM/DD tree: find() by 
+    creation date, names() in a directory for TargetIndex's clash checks, files() to build a 
+    DedupIndex from. verify() checks it against the disk, rebuild() makes it afresh.
+
+    Rows are added as files are placed, written out in short batches (see IndexWrites), and 
+    reads go a page at a time - so runs sharing the output directory never wait on each other 
+    for long.
+
+    The catalog is complete - consulted in place of the filesystem - once rebuild() has been 
+    run (or it was started on an empty tree) and as long as every run writing to it since has 
+    finished cleanly. A run opens it with writing=True, which registers the run until close( 
+    finished=True ); one that dies or fails leaves its registration behind, and a run with 
+    --no-catalog marks it incomplete outright. An incomplete catalog is still kept up to date, 
+    but not trusted until the next rebuild(). A catalog opened while another run is writing to 
+    it doesn't count as complete either, as it can't tell that run from one that died.
+    '''
+    DEFAULT_NAME = ".picture_arranger.catalog"
+    PAGE = 1000
+
+    def __init__( self, path, root, extensions=IMAGE_EXTENSIONS, hashes=False, writing=False ):
+        self.path = path
+        self.root = os.path.abspath( root )
+        self.extensions = extensions
+        self.hashes = hashes
+        self.token = None
+        self.db = connect_index( path )
+        self.writes = IndexWrites( self.db )
+        self.db.execute( "CREATE TABLE IF NOT EXISTS files ("
+                         " path TEXT PRIMARY KEY, dir TEXT, name TEXT, size INTEGER, mtime_ns INTEGER,"
+                         " date TEXT, source TEXT, hash BLOB)" )
+        self.db.execute( "CREATE INDEX IF NOT EXISTS files_date ON files (date, path)" )
+        self.db.execute( "CREATE INDEX IF NOT EXISTS files_dir ON files (dir)" )
+        self.db.execute( "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)" )
+        self.db.execute( "CREATE TABLE IF NOT EXISTS writers (token TEXT PRIMARY KEY, started REAL)" )
+        built = self.db.execute( "SELECT value FROM meta WHERE key='built'" ).fetchone() is not None
+        if not built and self.db.execute( "SELECT COUNT(*) FROM files" ).fetchone()[0] == 0:
+            if not os.path.isdir( self.root ) or next( iter( scan_images( self.root, recursive=True, extensions=extensions )), None ) is None:
+                self.mark_built() # nothing there to miss
+                built = True
+        writers = self.db.execute( "SELECT COUNT(*) FROM writers" ).fetchone()[0]
+        self.complete = built and not writers
+        # not worth a warning on every run - find() warns when the gaps matter
+        if not built:
+            logging.info( "Catalog [%s] doesn't cover all the files in [%s] - run --rebuild-catalog", path, self.root )
+        elif writers:
+            logging.info( "Catalog [%s] is being written by another run, or one that didn't finish - "
+                          "run --rebuild-catalog if none is going", path )
+        if writing:
+            self.token = "{0}-{1}".format( os.getpid(), os.urandom( 8 ).hex() )
+            self.db.execute( "INSERT INTO writers VALUES (?, ?)", ( self.token, time.time() ))
+            self.db.commit()
+
+    def mark_built( self ):
+        self.db.execute( "INSERT OR REPLACE INTO meta VALUES ('built', ?)", ( str( time.time() ), ))
+        self.db.commit()
+
+    @classmethod
+    def mark_incomplete( cls, path ):
+        '''Flag the catalog at path (if there is one) as missing files - placed by a run that 
+        didn't keep it up to date'''
+        if not os.path.exists( path ):
+            return
+        db = connect_index( path )
+        try:
+            db.execute( "DELETE FROM meta WHERE key='built'" )
+            db.commit()
+        finally:
+            db.close()
+
+    def row( self, relpath, statinfo, date, source, digest ):
+        return ( relpath, os.path.dirname( relpath ), os.path.basename( relpath ), statinfo.st_size, 
+                 statinfo.st_mtime_ns, date, source, digest )
+
+    def add( self, target, date=None, source=None ):
+        '''Record the file just placed at target, from source'''
+        relpath = os.path.relpath( target, self.root )
+        if relpath == os.pardir or relpath.startswith( os.pardir + os.sep ):
+            return # a plan applied to somewhere else
+        digest = full_hash( target ) if self.hashes else None
+        self.writes.add( "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)", 
+                         self.row( relpath, os.stat( target ), date, source, digest ))
+
+    def find( self, start, end=None ):
+        '''(creation date, path) of every file catalogued as created from start to end - see 
+        date_bounds - in date order'''
+        low, high = date_bounds( start, end )
+        if not self.complete:
+            logging.warning( "Catalog [%s] is incomplete - it may be missing files", self.path )
+        date, relpath = low, ""
+        while True:
+            rows = self.db.execute( "SELECT date, path FROM files WHERE ( date > ? OR ( date = ? AND path > ? )) AND date <= ?"
+                                    " ORDER BY date, path LIMIT ?", ( date, date, relpath, high, self.PAGE )).fetchall()
+            for date, relpath in rows:
+                yield date, os.path.join( self.root, relpath )
+            if len( rows ) < self.PAGE:
+                return
+
+    def names( self, directory ):
+        '''Set of the file names catalogued in directory'''
+        relpath = os.path.relpath( directory, self.root )
+        if relpath == os.curdir:
+            relpath = ""
+        return set( name for ( name, ) in self.db.execute( "SELECT name FROM files WHERE dir=?", ( relpath, )))
+
+    def rows( self, columns ):
+        '''columns of every row, read a page at a time - no read lock is held between pages, so 
+        other runs can commit while the rows are worked through'''
+        last = 0
+        while True:
+            rows = self.db.execute( "SELECT rowid, {0} FROM files WHERE rowid > ? ORDER BY rowid LIMIT ?".format( columns ), 
+                                    ( last, self.PAGE )).fetchall()
+            for row in rows:
+                yield row[1:]
+            if len( rows ) < self.PAGE:
+                return
+            last = rows[-1][0]
+
+    def files( self ):
+        '''(path relative to the root, size, mtime_ns) for every file catalogued'''
+        return self.rows( "path, size, mtime_ns" )
+
+    def check( self, row ):
+        '''What is wrong with a (relpath, size, mtime_ns, hash) row on disk - None if nothing'''
+        relpath, size, mtime_ns, digest = row
+        try:
+            statinfo = os.stat( os.path.join( self.root, relpath ))
+        except FileNotFoundError:
+            return "missing"
+        if statinfo.st_size != size or statinfo.st_mtime_ns != mtime_ns:
+            return "changed"
+        if digest is not None and full_hash( os.path.join( self.root, relpath )) != digest:
+            return "corrupt"
+        return None
+
+    def verify( self, jobs=1 ):
+        '''Check the catalog against the disk, yielding (path, problem) for each file that is 
+        "missing", "changed" (size or mtime not as catalogued), "corrupt" (unchanged as far as 
+        stat goes, but not matching its content hash - checked only for files catalogued with 
+        one) or "untracked" (in the tree, but not in the catalog). The catalogued files are 
+        checked on jobs workers, then the tree is walked for the untracked ones. Anything found 
+        means a rebuild is due'''
+        with worker_pool( jobs ) as checkers:
+            for row, problem in ordered_map( checkers, self.check, self.rows( "path, size, mtime_ns, hash" ), jobs * 4 ):
+                if problem is not None:
+                    yield os.path.join( self.root, row[0] ), problem
+        directory, names = None, set()
+        for entry in scan_images( self.root, recursive=True, extensions=self.extensions ):
+            # scan_images gives all of a directory's files together
+            if os.path.dirname( entry.path ) != directory:
+                directory = os.path.dirname( entry.path )
+                names = self.names( directory )
+            if entry.name not in names:
+                yield entry.path, "untracked"
+
+    def rebuild( self, jobs=1 ):
+        '''Walk the output tree and catalog what is there. Files catalogued as they are now keep
+        their row; the dates (and hashes) of the rest are read on jobs workers. Where a file came
+        from is kept for as long as it is there. Afterwards the catalog is complete'''
+        logging.info( "Rebuilding catalog of [{0}]".format( self.root ))
+        self.writes.flush()
+        known = { row[0]: row[1:] for row in self.rows( "path, size, mtime_ns, hash, source" ) }
+        found = set()
+        changed = []
+        for entry in scan_images( self.root, recursive=True, extensions=self.extensions ):
+            relpath = os.path.relpath( entry.path, self.root )
+            found.add( relpath )
+            statinfo = entry.stat()
+            entry_known = known.get( relpath )
+            if entry_known is None or entry_known[:2] != ( statinfo.st_size, statinfo.st_mtime_ns ) \
+                    or ( self.hashes and entry_known[2] is None ):
+                changed.append( ( relpath, statinfo, entry_known[3] if entry_known else None ) )
+        rows = []
+        with worker_pool( jobs ) as readers:
+            for ( relpath, statinfo, source ), ( date, digest ) in ordered_map( readers, self.read_file, changed, jobs * 2 ):
+                rows.append( self.row( relpath, statinfo, date, source, digest ))
+        # written in one go once the walk is done, not holding the lock through it
+        self.db.executemany( "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows )
+        self.db.executemany( "DELETE FROM files WHERE path=?", [ (p,) for p in set( known ) - found ] )
+        self.db.execute( "DELETE FROM writers WHERE token IS NOT ?", ( self.token, ))
+        self.mark_built()
+        self.complete = True
+        logging.info( "Catalog of [%s] holds %d files, %d of them new or changed", self.root, len( found ), len( changed ))
+
+    def read_file( self, item ):
+        '''(creation date, content hash or None) of a (relpath, statinfo, source) item'''
+        path = os.path.join( self.root, item[0] )
+        try:
+            date = read_image_creation_date( path, statinfo=item[1] )[0]
+        except (OSError, ValueError) as e:
+            logging.warning( "Cannot read creation date of [%s]: %s", path, e )
+            date = None
+        return date, full_hash( path ) if self.hashes else None
+
+    def close( self, finished=True ):
+        '''Close - a writing run that didn't finish leaves the catalog incomplete, as files it 
+        placed may not have been recorded'''
+        self.writes.flush()
+        if self.token is not None and finished:
+            self.db.execute( "DELETE FROM writers WHERE token=?", ( self.token, ))
+            self.db.commit()
+        elif self.token is not None:
+            logging.warning( "Catalog [%s] may be missing files placed by this run - run --rebuild-catalog", self.path )
+        self.db.close()
 
 # date is 2015:03:29 12:45:50
-def create_target_path( outdir, datetime, dryrun = True ):
+def create_target_path( outdir, datetime, dryrun = True, index = None, stats = None ):
     '''Create a path when given the output directory, and the created datetime. datetime must 
     be supplied as "yyyy:mm:dd HH:MM:SS". Thows exception if the created path exists and is a 
     file not a dir. Skips creation if the directory already exists, or if dryrun=True was 
-    specified on the command line.'''
+    specified on the command line. Pass a TargetIndex to skip the checks for directories 
+    already seen in this run.'''
     date = (datetime.split())[0].split(':')
     basedir = os.path.abspath( os.path.join( outdir, *date ) )
+    if index is not None and basedir in index.dirs:
+        return basedir
     
     if os.path.exists( basedir ):
         if os.path.isdir( basedir ):
-            logging.debug( "Directory: [{0}] exists - not creating".format( basedir ))
+            logging.debug( "Directory: [%s] exists - not creating", basedir )
         else:
             # There is a file in the way - stop
             logging.fatal( "Path [{0}] is a file - remove or rename and retry".format( basedir ))
@@ -92,55 +1505,313 @@ def create_target_path( outdir, datetime, dryrun = True ):
     else:
         # We have nothing - create the path
         if dryrun:
-            logging.info("Dryrun: Directory path [{0}] not created".format( basedir ))
+            logging.info( "Dryrun: Directory path [%s] not created", basedir )
         else:
-            logging.info("Creating directory path: [{0}]".format( basedir ))
+            logging.info( "Creating directory path: [%s]", basedir )
             os.makedirs( basedir ) 
+            if stats is not None:
+                stats.count( "dirs_created" )
+    if index is not None:
+        index.dirs.add( basedir )
     return basedir
 
-def create_target_file( dir, image, checksame=False ):
+def create_target_file( dir, image, checksame=False, pending=None, index=None, stats=None ):
     '''
     dir - full directory path
     image - fullpath of the image we are moving/copying
+    pending - dict of target path => Future for transfers handed out in this run but not yet 
+              finished
+    index - TargetIndex for the run. Without one the directory is listed for this call only
+    stats - RunStats to count clash loop iterations in
 
     Generate file name for target image in dir. Will try (1),(2) etc if clash found. 
     If checksame is set - then on clash - check that the file isn't the same as the one 
-    being copied by doing a shallow compare (stat info same on both)'''
+    being copied by doing a shallow compare (stat info same on both). The name returned 
+    is claimed in the index; a name another run claims first counts as a clash.'''
+    if pending is None:
+        pending = {}
+    if index is None:
+        index = TargetIndex()
+    taken = index.taken( dir )
     oldfile = image # start
     newfile = os.path.basename( image ) # image name
-    full_path = os.path.join( dir, newfile ) # new/proposed path
-    img_count = 1
+    key = ( dir, newfile )
+    # checksame has to compare against every clashing file, so it can't jump ahead
+    img_count = 1 if checksame else index.next_free.get( key, 1 )
     (name, ext) = os.path.splitext( newfile ) # bug: if you use image - it will split into the path and ext, 
                                               # so you get more then you really wanted
-    while os.path.exists( full_path ):
-        logging.debug("Clash found for " + newfile )
+    while newfile in taken or not index.claim( dir, newfile ):
+        logging.debug( "Clash found for %s", newfile )
         if checksame:
-            if filecmp.cmp( oldfile, full_path ):
-                logging.debug( "filecmp.cmp( Orig:[{0}] Target:[{1}] ) is true - files likely the same".format( oldfile, full_path ))
+            full_path = os.path.join( dir, newfile )
+            if pending.get( full_path ) is not None:
+                # wait for the transfer in flight so we compare against the real file
+                pending[full_path].result()
+            if os.path.exists( full_path ) and filecmp.cmp( oldfile, full_path ):
+                logging.debug( "filecmp.cmp( Orig:[%s] Target:[%s] ) is true - files likely the same", oldfile, full_path )
                 raise FileSameException
         newfile = name + "(" + str(img_count) + ")" + ext
-        logging.debug("Trying: " + newfile)
-        full_path = os.path.join( dir, newfile )
+        logging.debug( "Trying: %s", newfile )
         img_count += 1
     
+    if stats is not None and newfile != key[1]:
+        stats.count( "clashes" )
+        stats.count( "clash_iterations", img_count - ( 1 if checksame else index.next_free.get( key, 1 ) ) )
+    index.next_free[key] = max( img_count, index.next_free.get( key, 1 ) )
     return newfile
 
-def move_file( src, target, copy = True ):
-    '''Perform the file move - or copy. Default is copy as a non-damaging operation'''
-    if copy:
-        # copy filestat info
-        shutil.copy2( src, target )
+TRANSFER_MODES = ('auto', 'copy', 'hardlink', 'reflink', 'rename')
+FICLONE = 0x40049409 # from linux/fs.h
+COPY_CHUNK_SIZE = 64 * 1024 * 1024
+THROTTLE_CHUNK_SIZE = 1024 * 1024 # under --bwlimit
+BUFFERED_CHUNK_SIZE = 1024 * 1024
+# errors meaning "this kernel/filesystem can't do that" - try the next way of copying
+COPY_FALLBACK_ERRNOS = frozenset( e for e in ( errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EBADF, 
+                                              errno.ENOTTY, getattr( errno, 'EOPNOTSUPP', None ), 
+                                              getattr( errno, 'ENOTSUP', None ) ) if e is not None )
+
+def move_file( src, target, copy = True, mode = "auto", throttle = None ):
+    '''Perform the file move - or copy. Default is copy as a non-damaging operation. mode picks 
+    how the data gets to target:
+        auto - a move on one filesystem is a rename. Otherwise clone (reflink) the blocks if 
+               on one filesystem that can, else an in-kernel copy. Never hardlinks - the 
+               copy has to stay independent of the source
+        copy - always copy the bytes (in-kernel where the OS allows)
+        hardlink - link target to src (one filesystem only)
+        reflink - copy-on-write clone of src (btrfs/XFS, one filesystem only)
+        rename - rename src to target (one filesystem only, move only)
+    Copies keep the filestat info like shutil.copy2. For a move the source is removed once the 
+    target is in place. Whatever is at target (normally the placeholder claiming the name) is 
+    replaced atomically. throttle - see fast_copy; only copies that move the bytes use it'''
+    if mode == "rename" or ( mode == "auto" and not copy ):
+        try:
+            os.replace( src, target )
+            return
+        except OSError as e:
+            if mode == "rename" or e.errno != errno.EXDEV:
+                raise
+            logging.debug( "Cannot rename [%s] across filesystems - copying", src )
+    if mode == "hardlink":
+        temp = partial_name( target )
+        os.link( src, temp )
+        try:
+            os.replace( temp, target )
+        except BaseException:
+            os.unlink( temp )
+            raise
     else:
-        shutil.move( src, target )
+        # write under a temporary name and rename into place, so a crash never leaves a 
+        # partial file under a real name
+        temp = partial_name( target )
+        try:
+            if mode == "reflink":
+                reflink_file( src, temp )
+            elif mode == "auto" and same_device( src, target ):
+                try:
+                    reflink_file( src, temp )
+                except OSError as e:
+                    if e.errno not in COPY_FALLBACK_ERRNOS:
+                        raise
+                    fast_copy( src, temp, throttle )
+            else:
+                fast_copy( src, temp, throttle )
+            shutil.copystat( src, temp )
+            os.replace( temp, target )
+        except BaseException:
+            if os.path.lexists( temp ):
+                os.unlink( temp )
+            raise
+    if not copy:
+        os.unlink( src )
+
+PARTIAL_SUFFIX = ".partial"
+
+def partial_name( target ):
+    '''Hidden name, next to target, that a transfer writes to before renaming into place. 
+    The extension keeps it out of scan_images'''
+    directory, name = os.path.split( target )
+    return os.path.join( directory, ".{0}.{1}{2}".format( name, os.getpid(), PARTIAL_SUFFIX ) )
+
+def release_claims( targets ):
+    '''Remove the placeholders at targets that are still empty, and any .partial files of theirs'''
+    targets = list( targets )
+    for target in targets:
+        remove_placeholder( target )
+    remove_partials( targets )
+
+def remove_partials( targets ):
+    '''Remove the .partial files transfers to targets left behind when interrupted - whichever 
+    process was writing them. Names are claimed by one run at a time, so they can't belong to 
+    a transfer still going'''
+    names = collections.defaultdict( set ) # directory => target names
+    for target in targets:
+        directory, name = os.path.split( target )
+        names[directory].add( name )
+    for directory, targets_there in names.items():
+        try:
+            entries = os.listdir( directory )
+        except FileNotFoundError:
+            continue
+        for entry in entries:
+            if not ( entry.startswith( '.' ) and entry.endswith( PARTIAL_SUFFIX )):
+                continue
+            if entry[1:-len( PARTIAL_SUFFIX )].rsplit( '.', 1 )[0] in targets_there:
+                logging.info( "Removing [{0}] left by an interrupted transfer".format( os.path.join( directory, entry )))
+                try:
+                    os.unlink( os.path.join( directory, entry ))
+                except FileNotFoundError:
+                    pass
+
+def same_device( src, target ):
+    '''True if src and the directory target goes in are on the same device'''
+    return os.stat( src ).st_dev == os.stat( os.path.dirname( os.path.abspath( target ) ) ).st_dev
+
+def reflink_file( src, target ):
+    '''Make target a copy-on-write clone of src with the FICLONE ioctl - no data is copied. 
+    Raises OSError (and leaves no target behind) where the filesystem can't'''
+    if fcntl is None:
+        raise OSError( errno.ENOTTY, "reflink not supported on this platform" )
+    try:
+        with open( src, 'rb' ) as fsrc, open( target, 'wb' ) as fdst:
+            fcntl.ioctl( fdst.fileno(), FICLONE, fsrc.fileno() )
+    except OSError:
+        if os.path.exists( target ):
+            os.unlink( target )
+        raise
+
+def fast_copy( src, target, throttle=None ):
+    '''Copy the bytes of src to target without pulling them through userspace where the OS allows: 
+    copy_file_range (which can also clone, or copy server-side on NFS/SMB), then sendfile, and 
+    a plain buffered copy as the last resort. The kernel is told the source is read once, 
+    start to end, so it reads ahead in big runs and doesn't keep the pages cached afterwards. 
+    throttle - called with the size of each chunk before it is copied (see BandwidthLimit); 
+    chunks are THROTTLE_CHUNK_SIZE then, so the rate stays even'''
+    chunk_size = THROTTLE_CHUNK_SIZE if throttle is not None else COPY_CHUNK_SIZE
+    with open( src, 'rb' ) as fsrc, open( target, 'wb' ) as fdst:
+        infd, outfd = fsrc.fileno(), fdst.fileno()
+        size = os.fstat( infd ).st_size
+        fadvise( infd, 'POSIX_FADV_SEQUENTIAL' )
+        for copier in ( copy_range_chunks, sendfile_chunks, buffered_chunks ):
+            try:
+                copier( infd, outfd, size, chunk_size, throttle )
+                break
+            except OSError as e:
+                if e.errno not in COPY_FALLBACK_ERRNOS:
+                    raise
+            os.lseek( outfd, 0, os.SEEK_SET )
+            os.ftruncate( outfd, 0 )
+        fadvise( infd, 'POSIX_FADV_DONTNEED' )
+
+def fadvise( fd, advice ):
+    '''posix_fadvise the whole of fd, where the OS has it - a hint, so failures don't matter'''
+    if hasattr( os, 'posix_fadvise' ) and hasattr( os, advice ):
+        try:
+            os.posix_fadvise( fd, 0, 0, getattr( os, advice ))
+        except OSError:
+            pass
+
+def copy_range_chunks( infd, outfd, size, chunk_size=COPY_CHUNK_SIZE, throttle=None ):
+    '''In-kernel copy with os.copy_file_range'''
+    if not hasattr( os, 'copy_file_range' ):
+        raise OSError( errno.ENOSYS, "copy_file_range not available" )
+    offset = 0
+    while offset < size:
+        length = min( chunk_size, size - offset )
+        if throttle is not None:
+            throttle( length )
+        copied = os.copy_file_range( infd, outfd, length, offset, offset )
+        if copied == 0:
+            break
+        offset += copied
+
+def sendfile_chunks( infd, outfd, size, chunk_size=COPY_CHUNK_SIZE, throttle=None ):
+    '''In-kernel copy with os.sendfile - file to file works on Linux'''
+    if not hasattr( os, 'sendfile' ):
+        raise OSError( errno.ENOSYS, "sendfile not available" )
+    offset = 0
+    while offset < size:
+        length = min( chunk_size, size - offset )
+        if throttle is not None:
+            throttle( length )
+        sent = os.sendfile( outfd, infd, offset, length )
+        if sent == 0:
+            break
+        offset += sent
+
+def buffered_chunks( infd, outfd, size, chunk_size=COPY_CHUNK_SIZE, throttle=None ):
+    '''Plain read/write copy - the last resort'''
+    os.lseek( infd, 0, os.SEEK_SET )
+    chunk_size = min( chunk_size, BUFFERED_CHUNK_SIZE )
+    while True:
+        if throttle is not None:
+            throttle( chunk_size )
+        block = os.read( infd, chunk_size )
+        if not block:
+            break
+        while block:
+            block = block[os.write( outfd, block ):]
+
+class BandwidthLimit(object):
+    '''
+    --bwlimit: bytes per second shared between every transfer it is handed to. take() is called 
+    before each chunk is copied and sleeps until the chunk fits under the rate. There's no 
+    burst allowance beyond one chunk.
+    '''
+    def __init__( self, rate ):
+        self.rate = float( rate )
+        self.lock = threading.Lock()
+        self.clock = time.monotonic() # when the bytes taken so far will have been paid for
+
+    def take( self, nbytes ):
+        with self.lock:
+            now = time.monotonic()
+            start = max( self.clock, now )
+            self.clock = start + nbytes / self.rate
+        if start > now:
+            time.sleep( start - now )
+
+class DeferredQueueHandler( logging.handlers.QueueHandler ):
+    '''QueueHandler that leaves all formatting to the listener thread. Fine in-process, where the 
+    record and its args can be handed over as they are'''
+    def prepare( self, record ):
+        return record
+
+class LogListener( logging.handlers.QueueListener ):
+    '''QueueListener for setup_logger that undoes it on stop(): the queue handler comes off the 
+    root logger and the log file is closed, so the next setup_logger (another main() in the same 
+    process) starts afresh'''
+    def __init__( self, records, handler, queue_handler ):
+        super().__init__( records, handler )
+        self.queue_handler = queue_handler
+
+    def stop( self ):
+        logging.getLogger().removeHandler( self.queue_handler )
+        super().stop()
+        for handler in self.handlers:
+            handler.close()
 
 def setup_logger( logfile, debug=False ):
     '''Setup the logger - default is the STDERR file handle - we test for the string "STDERR" and 
-    rather than try and be clever, use the appropriate basicConfig call'''
+    rather than try and be clever, pick the appropriate handler. Records are put on a queue and 
+    formatted and written by a listener thread, which keeps the per-file log lines off the hot 
+    path. Returns the LogListener - stop it to flush and take the logging down again - or None 
+    if logging was already set up (as with basicConfig, the existing setup is left alone)'''
     level = logging.DEBUG if debug else logging.INFO
+    root = logging.getLogger()
+    if root.handlers:
+        return None
     if logfile == "STDERR":
-        logging.basicConfig( level=level, format='%(asctime)s|%(levelname)s|%(message)s' )
+        handler = logging.StreamHandler()
     else:
-        logging.basicConfig( filename=logfile, level=level, format='%(asctime)s|%(levelname)s|%(message)s' ) 
+        handler = logging.FileHandler( logfile )
+    handler.setFormatter( logging.Formatter( '%(asctime)s|%(levelname)s|%(message)s' ) )
+    records = queue.SimpleQueue()
+    queue_handler = DeferredQueueHandler( records )
+    root.addHandler( queue_handler )
+    root.setLevel( level )
+    listener = LogListener( records, handler, queue_handler )
+    listener.start()
+    return listener
 
 def log_startup_options( args ):
     '''capture startup args in the log'''
@@ -148,26 +1819,1115 @@ def log_startup_options( args ):
 
 def log_operation(image, newpath, newfile, copy, dryrun):
     '''log the operation being chosen'''
-    logging.info("{3}{2} File: [{0}] -> [{1}]".format( image, os.path.join(newpath, newfile), 
-                "Copying" if copy else "Moving", 
-                "Dryrun: Not " if dryrun else ""))
+    logging.info( "%s%s File: [%s] -> [%s]", "Dryrun: Not " if dryrun else "", 
+                  "Copying" if copy else "Moving", image, os.path.join( newpath, newfile ))
        
-def main():
-    args = parse_options()
-    setup_logger( args.logfile, debug=args.debug )
-    log_startup_options( args )
-    images = get_image_list( args.inputdir )
-    for image in images:
-        logging.info( "Processing image: " + image )
-        newpath = create_target_path( args.outputdir, get_image_creation_date( image ), dryrun=args.dryrun )
-        try:
-            newfile = create_target_file( newpath, image, checksame=args.skipsame )
-            logging.debug( "Newfile [{0}] Newpath [{1}]".format( newfile, newpath ))
+class RunStats(object):
+    '''
+    Counters, per-stage timers and per-file latency histograms for a run - reported by --stats. 
+    Safe to update from the worker threads.
+
+    Stage times are summed over all workers, so with --jobs/--io-jobs above 1 a stage can add up 
+    to more than the elapsed time. Histogram buckets are powers of two in microseconds: "n" 
+    counts files that took less than n us in that stage.
+    '''
+    def __init__( self ):
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.counters = collections.Counter()
+        self.seconds = collections.Counter() # stage => total seconds
+        self.histograms = collections.defaultdict( collections.Counter ) # stage => bucket => files
+
+    def count( self, name, n=1 ):
+        with self.lock:
+            self.counters[name] += n
+
+    def add_time( self, stage, seconds ):
+        bucket = 1 << int( seconds * 1e6 ).bit_length()
+        with self.lock:
+            self.seconds[stage] += seconds
+            self.histograms[stage][bucket] += 1
+
+    @contextlib.contextmanager
+    def timer( self, stage ):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time( stage, time.perf_counter() - start )
+
+    def timed_iter( self, stage, items ):
+        '''Pass items through, timing each step of the iterator (e.g. a directory scan)'''
+        items = iter( items )
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next( items )
+            except StopIteration:
+                return
+            self.add_time( stage, time.perf_counter() - start )
+            yield item
+
+    def summary( self ):
+        '''Everything as a JSON-able dict'''
+        with self.lock:
+            elapsed = time.perf_counter() - self.started
+            stages = {}
+            for stage, seconds in self.seconds.items():
+                files = sum( self.histograms[stage].values() )
+                stages[stage] = { "files": files, "seconds": seconds, "mean_ms": 1000.0 * seconds / files, 
+                                  "histogram_us": dict( ( str( bucket ), n ) for bucket, n in sorted( self.histograms[stage].items() ) ) }
+            return { "elapsed_seconds": elapsed, 
+                     "files_per_sec": self.counters["files_transferred"] / elapsed if elapsed else 0.0, 
+                     "mb_per_sec": self.counters["bytes_transferred"] / 1e6 / elapsed if elapsed else 0.0, 
+                     "counters": dict( self.counters ), "stages": stages }
+
+def write_stats( stats, path ):
+    '''Write the RunStats summary as JSON to path - "-" for STDOUT'''
+    if path == "-":
+        json.dump( stats.summary(), sys.stdout, indent=2 )
+        sys.stdout.write( "\n" )
+    else:
+        with open( path, 'w' ) as f:
+            json.dump( stats.summary(), f, indent=2 )
+
+BATCH_END = None # marks the end of a batch of images in a --watch stream
+
+def ordered_map( executor, func, items, window ):
+    '''Run func over items on the executor, yielding (item, result) in input order. Only "window" 
+    calls are kept in flight, so items can be a generator of any length. A BATCH_END item 
+    flushes everything in flight without waiting for more input.'''
+    in_flight = collections.deque()
+    for item in items:
+        if item is BATCH_END:
+            while in_flight:
+                item, future = in_flight.popleft()
+                yield item, future.result()
+            continue
+        in_flight.append( (item, executor.submit( func, item )) )
+        if len( in_flight ) >= window:
+            item, future = in_flight.popleft()
+            yield item, future.result()
+    while in_flight:
+        item, future = in_flight.popleft()
+        yield item, future.result()
+
+def drain_transfers( pending, limit ):
+    '''Block until no more than limit transfers are in flight. Finished transfers are dropped from 
+    pending (the file is on disk now) and any error they raised is re-raised here.'''
+    in_flight = list( pending.values() )
+    while len( in_flight ) > limit:
+        done, not_done = concurrent.futures.wait( in_flight, return_when=concurrent.futures.FIRST_COMPLETED )
+        in_flight = list( not_done )
+    for target, future in list( pending.items() ):
+        if future.done():
+            del pending[target]
+            future.result()
+
+def image_inode( image ):
+    '''Inode number for a path or an os.DirEntry - free from a DirEntry on POSIX'''
+    return image.inode() if isinstance( image, os.DirEntry ) else os.stat( image ).st_ino
+
+def plan_images( images, args, readers, read_date, index, dedup=None, pending=None, stats=None, near=None ):
+    '''
+    Phase one - work out where each image goes. A generator of plan entries, in input order: 
+    dicts of op ("copy" or "move"), src, target, mode (see move_file), date and the source 
+    ino and size. An image left out as a duplicate gets an entry with op "skip", the reason 
+    ("same" or "near") and duplicate_of, the file it matches.
+
+    Creation dates (and with near, a NearDupIndex, image hashes) are read by the readers pool; 
+    target names are then chosen one at a time (so clash suffixes match a serial run) and 
+    claimed in the TargetIndex, so it doesn't matter whether an entry has been carried out yet 
+    when the next one is planned.
+    '''
+    if stats is None:
+        stats = RunStats()
+    def read_date_and_hash( image ):
+        return read_date( image ), image_hash( image, stats )
+    read = read_date if near is None else read_date_and_hash
+    for entry, result in ordered_map( readers, read, images, args.jobs * 2 ):
+        date, value = result if near is not None else ( result, None )
+        image = os.fspath( entry )
+        logging.info( "Processing image: %s", image )
+        size = image_stat( entry ).st_size
+        if dedup is not None:
+            with stats.timer( "dedup" ):
+                same = dedup.find_duplicate( image, size, pending=pending )
+            if same is not None:
+                logging.info( "Files same - skipping - [%s] is already at [%s]", image, same )
+                stats.count( "files_skipped_same" )
+                yield skip_entry( image, "same", same, date, size )
+                continue
+        if value is not None:
+            with stats.timer( "near_dupes" ):
+                similar = near.find( value )
+            if similar is not None:
+                stats.count( "near_dupes_found" )
+                if args.near_dupes == "skip":
+                    logging.info( "Near duplicate - skipping - [%s] looks like [%s] (distance %d)", image, *similar )
+                    stats.count( "files_skipped_near" )
+                    yield skip_entry( image, "near", similar[0], date, size )
+                    continue
+                logging.warning( "Near duplicate: [%s] looks like [%s] (distance %d)", image, *similar )
+        with stats.timer( "target_path" ):
+            newpath = create_target_path( args.outputdir, date, dryrun=args.dryrun, index=index, stats=stats )
+        with stats.timer( "target_file" ):
+            newfile = create_target_file( newpath, image, pending=pending, index=index, stats=stats )
+        logging.debug( "Newfile [%s] Newpath [%s]", newfile, newpath )
+        if not args.plan_out:
             log_operation( image, newpath, newfile, args.copy, args.dryrun )
-            if not args.dryrun:
-                move_file( image, os.path.join(newpath, newfile), copy=args.copy )
-        except FileSameException:
-            logging.info("Files same - skipping")
+        target = os.path.join( newpath, newfile )
+        if dedup is not None:
+            dedup.add( target, image, size )
+        if value is not None:
+            near.add( target, value )
+        yield { "op": "copy" if args.copy else "move", "src": os.path.abspath( image ), "target": target, 
+                "mode": args.transfer, "date": date, "ino": image_inode( entry ), "dev": image_stat( entry ).st_dev, "size": size }
+
+def skip_entry( image, reason, duplicate_of, date, size ):
+    return { "op": "skip", "src": os.path.abspath( image ), "reason": reason, "duplicate_of": duplicate_of, 
+             "date": date, "size": size }
+
+class FileResult(object):
+    '''
+    What became of one image - yielded by Arranger.arrange and apply. status is one of
+        done - op ("copy" or "move") has put it at target
+        planned - target chosen but nothing written: a dryrun, or --plan-out before the plan is 
+                  carried out
+        skipped - left where it is. reason is "same" or "near" (duplicate_of is the file 
+                  already in the output directory that it matches) or "exists" (the plan's 
+                  target was taken by the time the plan ran)
+    There is one of these for every file of a big ingest, so they are slotted.
+    '''
+    __slots__ = ( 'src', 'target', 'op', 'status', 'reason', 'duplicate_of', 'date', 'size' )
+
+    def __init__( self, src, target=None, op=None, status="done", reason=None, duplicate_of=None, date=None, size=None ):
+        self.src = src
+        self.target = target
+        self.op = op
+        self.status = status
+        self.reason = reason
+        self.duplicate_of = duplicate_of
+        self.date = date
+        self.size = size
+
+    @classmethod
+    def from_op( cls, op, status ):
+        '''Result for a plan entry - status is what happened to a transfer; a skip entry is always "skipped"'''
+        if op["op"] == "skip":
+            return cls( op["src"], op.get( "target" ), None, "skipped", op["reason"], op.get( "duplicate_of" ), 
+                        op.get( "date" ), op.get( "size" ))
+        return cls( op["src"], op["target"], op["op"], status, date=op.get( "date" ), size=op.get( "size" ))
+
+    def __repr__( self ):
+        return "FileResult({0})".format( ", ".join( "{0}={1!r}".format( name, getattr( self, name )) for name in self.__slots__ ))
+
+def image_hash( image, stats ):
+    '''dhash of image for --near-dupes - None (and a warning) if it can't be read as an image. 
+    Videos and RAW/HEIC files, which PIL can't decode, are passed over quietly'''
+    if os.path.splitext( os.fspath( image ))[1].lower() not in HASHABLE_EXTENSIONS:
+        return None
+    with stats.timer( "image_hash" ):
+        try:
+            return dhash( os.fspath( image ))
+        except (OSError, ValueError) as e:
+            logging.warning( "Cannot hash [%s] for near duplicates: %s", os.fspath( image ), e )
+            return None
+
+def run_operation( op, journal=None, stats=None, throttle=None ):
+    '''Carry out one plan entry, recording its start and finish in the journal'''
+    if journal is not None:
+        journal.record( "start", op )
+    start = time.perf_counter()
+    try:
+        move_file( op["src"], op["target"], copy=op["op"] == "copy", mode=op["mode"], throttle=throttle )
+    except BaseException:
+        remove_placeholder( op["target"] )
+        raise
+    if stats is not None:
+        stats.add_time( "transfer", time.perf_counter() - start )
+        stats.count( "files_transferred" )
+        stats.count( "bytes_transferred", op.get( "size", 0 ) )
+    if journal is not None:
+        journal.record( "done", op )
+
+def submit_operation( writers, op, pending, limit, journal=None, stats=None, scheduler=None ):
+    '''Hand a plan entry to the writers pool - through the TransferScheduler, if given - with no 
+    more than limit transfers in flight (started or waiting their turn). Returns the Future of 
+    the transfer'''
+    drain_transfers( pending, limit - 1 )
+    if scheduler is not None:
+        future = scheduler.submit( writers, op, journal=journal, stats=stats )
+    else:
+        future = writers.submit( run_operation, op, journal, stats )
+    pending[op["target"]] = future
+    return future
+
+def is_rotational( dev ):
+    '''True if the block device dev (an st_dev) is a spinning disk, going by Linux's sysfs. False 
+    where that can't be told - other platforms, network and virtual filesystems'''
+    if not hasattr( os, 'major' ):
+        return False
+    base = "/sys/dev/block/{0}:{1}".format( os.major( dev ), os.minor( dev ))
+    # a partition has no queue of its own - its disk's is one level up
+    for path in ( os.path.join( base, "queue", "rotational" ), os.path.join( base, "..", "queue", "rotational" )):
+        try:
+            with open( path ) as f:
+                return f.read().strip() == "1"
+        except OSError:
+            continue
+    return False
+
+class TransferScheduler(object):
+    '''
+    Decides when each transfer may start, so every device is kept busy without being swamped. 
+    A transfer holds a slot on the device it reads from and on the one it writes to (just one 
+    if they are the same) while it runs. Each device has device_jobs slots - by default one for 
+    a spinning disk, where interleaved transfers would turn sequential reads and writes into 
+    seeks, and no limit (beyond the writers pool) otherwise. So a slow card and a fast array 
+    are both kept going, and one HDD is not thrashed.
+
+    A transfer waiting for a slot doesn't hold a writer thread - those go to transfers between 
+    other devices - and doesn't get overtaken by later transfers on the same device. One 
+    scheduler can be shared by runs going on at once (see Arranger), so their limits add up. 
+    bwlimit (bytes per second) is a BandwidthLimit over all the transfers it starts.
+    '''
+    def __init__( self, device_jobs=None, bwlimit=None ):
+        self.device_jobs = device_jobs
+        self.throttle = BandwidthLimit( bwlimit ).take if bwlimit else None
+        self.lock = threading.Lock()
+        self.busy = collections.Counter() # st_dev => transfers running on it
+        self.limits = {} # st_dev => slots, None for no limit
+        self.dir_devices = {} # target directory => st_dev
+        self.waiting = collections.deque() # (devices, executor, Future, op, journal, stats, queued at)
+
+    def devices( self, op ):
+        '''The devices a plan entry's transfer uses - the source's comes with it from plan_images'''
+        devices = set()
+        src_dev = op.get( "dev" )
+        if src_dev is None:
+            try:
+                src_dev = os.stat( op["src"] ).st_dev
+            except OSError:
+                pass # the transfer will say what is wrong
+        if src_dev is not None:
+            devices.add( src_dev )
+        directory = os.path.dirname( op["target"] )
+        if directory not in self.dir_devices:
+            try:
+                self.dir_devices[directory] = os.stat( directory ).st_dev
+            except OSError:
+                self.dir_devices[directory] = None
+        if self.dir_devices[directory] is not None:
+            devices.add( self.dir_devices[directory] )
+        return frozenset( devices )
+
+    def limit( self, dev ):
+        if dev not in self.limits:
+            self.limits[dev] = self.device_jobs or ( 1 if is_rotational( dev ) else None )
+            logging.debug( "Transfers at once on device %s: %s", dev, self.limits[dev] or "no limit" )
+        return self.limits[dev]
+
+    def submit( self, executor, op, journal=None, stats=None ):
+        '''Run op on executor as soon as its devices have room - returns a Future for the transfer'''
+        future = concurrent.futures.Future()
+        devices = self.devices( op )
+        with self.lock:
+            self.waiting.append( ( devices, executor, future, op, journal, stats, time.perf_counter() ))
+            self.dispatch()
+        return future
+
+    def dispatch( self ):
+        '''Start every waiting transfer (oldest first) whose devices all have a free slot. Called 
+        with the lock held'''
+        still_waiting = collections.deque()
+        blocked = set() # devices an earlier transfer is waiting for - no overtaking on these
+        for item in self.waiting:
+            devices = item[0]
+            if blocked & devices or any( self.limit( dev ) is not None and self.busy[dev] >= self.limit( dev ) for dev in devices ):
+                blocked |= devices
+                still_waiting.append( item )
+                continue
+            for dev in devices:
+                self.busy[dev] += 1
+            try:
+                item[1].submit( self.run, item )
+            except RuntimeError as e: # the pool has been shut down
+                self.release( devices )
+                item[2].set_exception( e )
+        self.waiting = still_waiting
+
+    def release( self, devices ):
+        for dev in devices:
+            self.busy[dev] -= 1
+
+    def run( self, item ):
+        devices, _, future, op, journal, stats, queued = item
+        error = None
+        if stats is not None:
+            stats.add_time( "transfer_wait", time.perf_counter() - queued )
+        try:
+            run_operation( op, journal=journal, stats=stats, throttle=self.throttle )
+        except BaseException as e:
+            error = e
+        with self.lock:
+            self.release( devices )
+            self.dispatch()
+        if error is None:
+            future.set_result( None )
+        else:
+            future.set_exception( error )
+
+def transfer_ops( plan, writers, pending, limit, journal=None, stats=None, scheduler=None ):
+    '''Hand plan entries to the writers pool as they come, yielding a FileResult for each once 
+    its transfer has finished (skip entries straight away). Transfers finish in any order, but 
+    are reported in the order they were handed out. A failed transfer's error is raised here'''
+    in_flight = collections.deque() # (plan entry, Future) in the order submitted
+    for op in plan:
+        if op["op"] == "skip":
+            yield FileResult.from_op( op, "skipped" )
+            continue
+        in_flight.append( ( op, submit_operation( writers, op, pending, limit, journal=journal, stats=stats, scheduler=scheduler )))
+        while in_flight and in_flight[0][1].done():
+            done, future = in_flight.popleft()
+            future.result()
+            yield FileResult.from_op( done, "done" )
+    for done, future in in_flight:
+        future.result()
+        yield FileResult.from_op( done, "done" )
+
+class Journal(object):
+    '''
+    Append-only record (JSON lines) of the transfers a run starts and finishes, so an 
+    interrupted run can be picked up with --resume at a cost in proportion to the work left.
+
+    Each record is flushed to the OS as it is made, so it survives the process being killed; 
+    fsyncs, against a power cut, are batched - every SYNC_EVERY records or SYNC_INTERVAL 
+    seconds. A journal is removed once its run finishes cleanly.
+
+    On resume, sources finished by the earlier run are in done. A transfer that was started 
+    but not recorded as finished is settled by recover(): targets only ever appear by an 
+    atomic rename, so if the target is there and the right size it is complete. An empty 
+    placeholder left by the crash is removed and the transfer redone, as are any half 
+    written .partial files of those targets.
+
+    Names claimed with a placeholder (see TargetIndex) are journalled as "claim" before the 
+    placeholder is made, and count as the run's until their transfer starts. close() removes 
+    the placeholders of claims that never got that far - the run failed or was stopped. A 
+    crash leaves them in the journal: recover() removes them on --resume, and a run starting 
+    afresh over the journal does so too.
+
+    Each input directory has its own journal by default (see default_journal_file), so runs 
+    from several sources into one output directory don't trip over each other's.
+    '''
+    DEFAULT_NAME = ".picture_arranger.journal"
+    SYNC_EVERY = 256
+    SYNC_INTERVAL = 1.0
+
+    def __init__( self, path, resume=False ):
+        self.path = path
+        self.done = set() # sources finished by the run being resumed
+        self.started = {} # source => plan entry started, but not finished, by that run
+        self.claims = set() # targets claimed, but with no transfer started - by that run, then this one
+        self.lock = threading.Lock()
+        self.unsynced = 0
+        self.last_sync = time.time()
+        if os.path.exists( path ):
+            self.load()
+            if not resume:
+                logging.warning( "Journal [{0}] of an unfinished run found - starting afresh (use --resume to pick it up)".format( path ))
+                release_claims( list( self.claims ) + [ op["target"] for op in self.started.values() ] )
+                self.done = set()
+                self.started = {}
+                self.claims = set()
+        journal_dir = os.path.dirname( os.path.abspath( path ) )
+        if not os.path.isdir( journal_dir ):
+            os.makedirs( journal_dir )
+        self.file = open( path, 'a' if resume else 'w' )
+
+    def load( self ):
+        with open( self.path ) as f:
+            for line in f:
+                try:
+                    record = json.loads( line )
+                except ValueError:
+                    break # torn last line from the crash
+                self.track( record )
+                if record["event"] == "done":
+                    self.done.add( record["src"] )
+                    self.started.pop( record["src"], None )
+                elif record["event"] == "start":
+                    self.started[record["src"]] = record
+        logging.info( "Journal [{0}]: {1} finished, {2} interrupted, {3} claimed".format( 
+                      self.path, len( self.done ), len( self.started ), len( self.claims ) ))
+
+    def track( self, record ):
+        '''Keep claims up to date with a record'''
+        if record["event"] == "claim":
+            self.claims.add( record["target"] )
+        else:
+            self.claims.discard( record["target"] )
+
+    def recover( self ):
+        '''Settle the transfers the earlier run was in the middle of. Returns how many were complete'''
+        recovered = 0
+        release_claims( self.claims )
+        self.claims = set()
+        remove_partials( op["target"] for op in self.started.values() )
+        for src, op in self.started.items():
+            try:
+                target_size = os.stat( op["target"] ).st_size
+            except FileNotFoundError:
+                continue # never got there - it will be redone
+            if os.path.exists( src ):
+                if os.stat( src ).st_size != target_size:
+                    if target_size == 0:
+                        remove_placeholder( op["target"] )
+                    continue
+                if op["op"] == "move":
+                    os.unlink( src )
+            logging.info( "Interrupted transfer [{0}] -> [{1}] had completed".format( src, op["target"] ))
+            self.record( "done", op )
+            self.done.add( src )
+            recovered += 1
+        self.started = {}
+        return recovered
+
+    def record( self, event, op ):
+        record = dict( op, event=event )
+        line = json.dumps( record ) + "\n"
+        with self.lock:
+            self.track( record )
+            self.file.write( line )
+            self.file.flush()
+            self.unsynced += 1
+            if self.unsynced >= self.SYNC_EVERY or time.time() - self.last_sync >= self.SYNC_INTERVAL:
+                self._sync()
+
+    def _sync( self ):
+        self.file.flush()
+        os.fsync( self.file.fileno() )
+        self.unsynced = 0
+        self.last_sync = time.time()
+
+    def rotate( self ):
+        '''Start the journal afresh once all it records is settled - after each --watch batch - 
+        so it doesn't grow for as long as the run goes on. Open claims are carried over'''
+        with self.lock:
+            self.file.close()
+            self.file = open( self.path, 'w' )
+            self.done = set()
+            self.started = {}
+            for target in self.claims:
+                self.file.write( json.dumps( { "target": target, "event": "claim" } ) + "\n" )
+            self._sync()
+
+    def close( self, finished=False ):
+        '''Sync and close - and remove the journal if the run finished. Placeholders claimed but 
+        never transferred to are removed first'''
+        with self.lock:
+            claims, self.claims = self.claims, set()
+        release_claims( claims )
+        with self.lock:
+            self._sync()
+            self.file.close()
+        if finished:
+            os.unlink( self.path )
+
+def write_plan( plan, path ):
+    '''Write plan entries to path as JSON lines as they are made, passing every entry on. Skip 
+    entries are passed on but not written'''
+    written = 0
+    with open( path, 'w' ) as f:
+        for op in plan:
+            if op["op"] != "skip":
+                f.write( json.dumps( op ) + "\n" )
+                written += 1
+            yield op
+    logging.info( "Plan of {0} operations written to [{1}]".format( written, path ))
+
+def read_plan( path ):
+    '''Load a plan written by write_plan'''
+    with open( path ) as f:
+        return [ json.loads( line ) for line in f if line.strip() ]
+
+def execute_plan( plan, io_jobs, dryrun=False, journal=None, stats=None, scheduler=None ):
+    '''Phase two - carry out a plan, with no metadata parsing at all. Operations are grouped by 
+    target directory and ordered by source inode within each group - a fair proxy for on-disk 
+    order - so the disks see mostly sequential work. A target that exists by now is never 
+    overwritten; that operation is skipped with a warning. Targets are claimed with a 
+    placeholder (see TargetIndex) just before their transfer, so a concurrent run can't take 
+    one between the check and the write. Operations the journal has as done are skipped 
+    quietly. Transfers go through scheduler, a TransferScheduler. A generator of FileResults - 
+    nothing is done until it is iterated.'''
+    if journal is not None and journal.done:
+        plan = [ op for op in plan if op["src"] not in journal.done ]
+    plan = sorted( plan, key=lambda op: ( os.path.dirname( op["target"] ), op.get( "ino", 0 ) ) )
+    def claim_targets():
+        directory = None
+        for op in plan:
+            if os.path.dirname( op["target"] ) != directory:
+                directory = os.path.dirname( op["target"] )
+                if not dryrun:
+                    os.makedirs( directory, exist_ok=True )
+            taken = os.path.lexists( op["target"] ) if dryrun else not claim_placeholder( op["target"], journal )
+            if taken:
+                logging.warning( "Target [%s] already exists - skipping [%s]", op["target"], op["src"] )
+                yield dict( op, op="skip", reason="exists", duplicate_of=None )
+                continue
+            log_operation( op["src"], directory, os.path.basename( op["target"] ), op["op"] == "copy", dryrun )
+            yield op
+    if dryrun:
+        for op in claim_targets():
+            yield FileResult.from_op( op, "planned" )
+        return
+    pending = {} # target path => Future of the transfer writing it
+    with worker_pool( io_jobs ) as writers:
+        try:
+            yield from transfer_ops( claim_targets(), writers, pending, io_jobs * 2, journal=journal, stats=stats, scheduler=scheduler )
+        finally:
+            drain_transfers( pending, 0 )
+
+def arrange_images( images, args, stats=None, scheduler=None ):
+    '''Staged pipeline: plan_images works out where each image goes, reading creation dates on 
+    a pool of args.jobs workers. Normally each plan entry is handed straight to a bounded pool 
+    of args.io_jobs writers, when the scheduler (a TransferScheduler - by default one for this 
+    call) says the devices involved have room. With --plan-out the whole plan is made and written out first, then 
+    (unless --dryrun) carried out by execute_plan. images can be paths or os.DirEntry objects. 
+    On --resume, images the journal has as done are dropped before anything is read from them. 
+    Each stage is timed and counted in stats.
+
+    A generator of a FileResult per image, as each is dealt with - nothing is done until it is 
+    iterated, and stopping early leaves the journal for --resume. With --plan-out each image 
+    is reported as planned first, then again as the plan is carried out.
+
+    A --watch stream is arranged batch by batch (see BATCH_END): once a batch's transfers are 
+    all done the journal is started afresh, while the target index, indexes, catalog and date 
+    cache stay open - and warm - for the next.'''
+    if stats is None:
+        stats = RunStats()
+    if scheduler is None:
+        scheduler = TransferScheduler( args.device_jobs, args.bwlimit )
+    pending = {} # target path => Future of the transfer writing it
+    journal = open_journal( args, default_journal_file( args.outputdir, args.inputdir ) )
+    if journal is not None and journal.done:
+        images = ( image for image in images 
+                   if image is BATCH_END or os.path.abspath( os.fspath( image ) ) not in journal.done )
+    # plans are carried out later (or never), so only claim names for real when streaming
+    catalog = None if args.dryrun else open_catalog( args, writing=not args.plan_out )
+    index = TargetIndex( placeholders=not ( args.dryrun or args.plan_out ), catalog=catalog, journal=journal )
+    dedup = open_dedup_index( args, catalog )
+    near = open_near_dup_index( args )
+    cache = open_date_cache( args )
+    def read_date( image ):
+        with stats.timer( "date" ):
+            return get_image_creation_date( image, cache=cache, stats=stats )
+    finished = False
+    plan = []
+    with worker_pool( args.jobs ) as readers, worker_pool( args.io_jobs ) as writers:
+        try:
+            if args.plan_out:
+                planned = plan_images( images, args, readers, read_date, index, dedup=dedup, pending=pending, stats=stats, near=near )
+                for op in write_plan( planned, args.plan_out ):
+                    if op["op"] != "skip":
+                        plan.append( op )
+                    yield FileResult.from_op( op, "planned" )
+            elif args.dryrun:
+                for op in plan_images( images, args, readers, read_date, index, dedup=dedup, pending=pending, stats=stats, near=near ):
+                    yield FileResult.from_op( op, "planned" )
+            else:
+                for batch in split_batches( images ):
+                    planned = plan_images( batch, args, readers, read_date, index, dedup=dedup, pending=pending, stats=stats, near=near )
+                    yield from catalogued( transfer_ops( planned, writers, pending, args.io_jobs * 2, journal=journal, stats=stats, scheduler=scheduler ), catalog, dedup )
+                    drain_transfers( pending, 0 )
+                    for held in ( catalog, dedup, near ):
+                        if held is not None:
+                            held.writes.flush() # the next batch may be hours away
+                    if journal is not None:
+                        journal.rotate()
+            finished = True
+        finally:
+            drain_transfers( pending, 0 )
+            if catalog is not None:
+                catalog.close( finished )
+            if cache is not None:
+                cache.close()
+            if dedup is not None:
+                dedup.close()
+            if near is not None:
+                near.close()
+            if journal is not None and not ( finished and args.plan_out ):
+                journal.close( finished )
+    if args.plan_out and not args.dryrun:
+        yield from run_plan( plan, args, journal, stats=stats, scheduler=scheduler )
+
+def run_plan( plan, args, journal, stats=None, scheduler=None ):
+    '''execute_plan, closing the journal (and so removing it, if all went well) afterwards. Files 
+    placed are added to the output directory's catalog - with no args.outputdir, that of the 
+    directory the plan's targets are in'''
+    if scheduler is None:
+        scheduler = TransferScheduler( args.device_jobs, args.bwlimit )
+    if args.outputdir is None and not args.dryrun:
+        args = copy.copy( args )
+        args.outputdir = plan_outputdir( plan )
+    catalog = None if args.dryrun else open_catalog( args, writing=True )
+    # the plan was checked against the index when it was made - here it is only kept up to date
+    dedup = None if args.dryrun else open_dedup_index( args, catalog, rescan=False )
+    finished = False
+    try:
+        yield from catalogued( execute_plan( plan, args.io_jobs, dryrun=args.dryrun, journal=journal, stats=stats, scheduler=scheduler ), catalog, dedup )
+        finished = True
+    finally:
+        if dedup is not None:
+            dedup.close()
+        if catalog is not None:
+            catalog.close( finished )
+        if journal is not None:
+            journal.close( finished )
+
+def plan_outputdir( plan ):
+    '''The output directory of a plan's targets - the one above their YYYY/MM/DD directories 
+    (see create_target_path). None for a plan with nothing to do'''
+    for op in plan:
+        if op["op"] != "skip":
+            day_dir = os.path.dirname( op["target"] )
+            return os.path.dirname( os.path.dirname( os.path.dirname( day_dir )))
+    return None
+
+def catalogued( results, catalog, dedup=None ):
+    '''Pass FileResults on, adding each file placed to catalog and the DedupIndex dedup - those 
+    there are'''
+    for result in results:
+        if result.status == "done":
+            if catalog is not None:
+                catalog.add( result.target, date=result.date, source=result.src )
+            if dedup is not None:
+                dedup.done( result.target )
+        yield result
+
+def default_journal_file( outputdir, inputdir ):
+    '''Journal for a run from inputdir into outputdir - named after the input directory, so 
+    concurrent runs from different sources each have their own. Plain Journal.DEFAULT_NAME for 
+    images handed over by a caller, with no inputdir'''
+    if inputdir is None:
+        return os.path.join( outputdir, Journal.DEFAULT_NAME )
+    key = hashlib.blake2b( os.path.abspath( inputdir ).encode( 'utf-8', 'surrogateescape' ), digest_size=8 ).hexdigest()
+    root, ext = os.path.splitext( Journal.DEFAULT_NAME )
+    return os.path.join( outputdir, "{0}.{1}{2}".format( root, key, ext ) )
+
+def open_journal( args, default_path ):
+    '''The Journal for this run - None on a dryrun. On --resume, interrupted transfers are 
+    settled straight away'''
+    if args.dryrun:
+        return None
+    journal = Journal( args.journal or default_path, resume=args.resume )
+    if args.resume:
+        journal.recover()
+    return journal
+
+def open_dedup_index( args, catalog=None, rescan=None ):
+    '''The DedupIndex for --skipsame, or None if it wasn't asked for. It is built from catalog, 
+    if that is complete. rescan - overrides --dedup-rescan'''
+    if not args.skipsame:
+        return None
+    index_file = args.dedup_index or os.path.join( args.outputdir, DedupIndex.DEFAULT_NAME )
+    return DedupIndex( index_file, args.outputdir, extensions=args.extensions or IMAGE_EXTENSIONS, 
+                       rescan=args.dedup_rescan if rescan is None else rescan, dryrun=args.dryrun, catalog=catalog )
+
+def open_catalog( args, writing=False ):
+    '''The Catalog of the output directory, or None with no output directory or --no-catalog - 
+    in which case a run writing to the directory marks any catalog there as incomplete'''
+    if args.outputdir is None:
+        return None
+    catalog_file = args.catalog_file or os.path.join( args.outputdir, Catalog.DEFAULT_NAME )
+    if not args.catalog:
+        if writing:
+            Catalog.mark_incomplete( catalog_file )
+        return None
+    return Catalog( catalog_file, args.outputdir, extensions=args.extensions or IMAGE_EXTENSIONS, 
+                    hashes=args.catalog_hash, writing=writing )
+
+def open_near_dup_index( args ):
+    '''The NearDupIndex for --near-dupes, or None if it wasn't asked for'''
+    if not args.near_dupes:
+        return None
+    index_file = args.near_dupe_index or os.path.join( args.outputdir, NearDupIndex.DEFAULT_NAME )
+    return NearDupIndex( index_file, args.outputdir, args.near_dupe_distance, 
+                         extensions=args.extensions or IMAGE_EXTENSIONS, rescan=args.dedup_rescan, 
+                         dryrun=args.dryrun, jobs=args.jobs )
+
+def open_date_cache( args ):
+    '''The DateCache asked for on the command line, or None if --no-cache'''
+    if not args.cache:
+        return None
+    cache_file = args.cache_file or default_cache_file( args.logfile )
+    logging.debug( "Using creation date cache [{0}]".format( cache_file ))
+    return DateCache( cache_file, max_entries=args.cache_size )
+
+class PollingWatcher(object):
+    '''
+    --watch backend that rescans the input directory every interval seconds. A file is reported 
+    once its size and mtime have held still between two scans, i.e. it has been fully written. 
+    Works anywhere, but costs a scan per interval - see InotifyWatcher.
+    '''
+    def __init__( self, input_dir, interval=2.0, **scan_options ):
+        self.input_dir = input_dir
+        self.interval = interval
+        self.scan_options = scan_options
+        self.last = {} # path => (size, mtime_ns) at the last scan
+        self.reported = set()
+
+    def poll( self, timeout=None ):
+        '''Wait up to timeout seconds (None - one interval) and return the paths ready since last time'''
+        time.sleep( self.interval if timeout is None else min( timeout, self.interval ) )
+        current = {}
+        for entry in scan_images( self.input_dir, **self.scan_options ):
+            try:
+                statinfo = entry.stat()
+            except FileNotFoundError:
+                continue
+            current[entry.path] = ( statinfo.st_size, statinfo.st_mtime_ns )
+        ready = [ path for path, signature in current.items() 
+                  if self.last.get( path ) == signature and path not in self.reported ]
+        self.reported = ( self.reported & set( current ) ) | set( ready )
+        self.last = current
+        return ready
+
+    def close( self ):
+        pass
+
+class InotifyWatcher(object):
+    '''
+    --watch backend for Linux, using inotify through ctypes (no extra packages). A file is 
+    reported when it is closed after writing or moved into the watched tree, so nothing is 
+    rescanned. New subdirectories are watched (and scanned, for files that beat the watch) 
+    when recursive. If the kernel's event queue overflows, the whole tree is scanned once.
+    '''
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+    EVENT = struct.Struct( 'iIII' ) # wd, mask, cookie, len - then len bytes of name
+
+    def __init__( self, input_dir, recursive=False, extensions=IMAGE_EXTENSIONS, include=None, exclude=None, skip_dirs=() ):
+        import ctypes
+        import ctypes.util
+        self.libc = ctypes.CDLL( ctypes.util.find_library( 'c' ) or 'libc.so.6', use_errno=True )
+        self.fd = self.libc.inotify_init1( os.O_CLOEXEC )
+        if self.fd < 0:
+            raise OSError( ctypes.get_errno(), "inotify_init1 failed" )
+        self.input_dir = input_dir
+        self.scan_options = dict( recursive=recursive, extensions=extensions, include=include, exclude=exclude, skip_dirs=skip_dirs )
+        self.recursive = recursive
+        self.extensions = normalise_extensions( extensions )
+        self.include = include
+        self.exclude = exclude
+        self.skip_dirs = frozenset( os.path.abspath( d ) for d in skip_dirs )
+        self.watches = {} # watch descriptor => directory
+        self.add_tree( input_dir )
+
+    def add_watch( self, directory ):
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+        wd = self.libc.inotify_add_watch( self.fd, os.fsencode( directory ), mask )
+        if wd < 0:
+            logging.warning( "Cannot watch directory [%s]", directory )
+        else:
+            self.watches[wd] = directory
+
+    def add_tree( self, top ):
+        self.add_watch( top )
+        if not self.recursive:
+            return
+        for root, dirs, _ in os.walk( top ):
+            dirs[:] = [ d for d in dirs if os.path.abspath( os.path.join( root, d ) ) not in self.skip_dirs
+                        and not ( self.exclude and any( fnmatch.fnmatch( d, pattern ) for pattern in self.exclude ) ) ]
+            for d in dirs:
+                self.add_watch( os.path.join( root, d ) )
+
+    def poll( self, timeout=None ):
+        '''Wait up to timeout seconds (None - for ever) for events, and return the paths ready'''
+        readable, _, _ = select.select( [ self.fd ], [], [], timeout )
+        if not readable:
+            return []
+        data = os.read( self.fd, 64 * 1024 )
+        ready = []
+        offset = 0
+        while offset < len( data ):
+            wd, mask, _, length = self.EVENT.unpack_from( data, offset )
+            name = os.fsdecode( data[offset + self.EVENT.size:offset + self.EVENT.size + length].rstrip( b'\x00' ) )
+            offset += self.EVENT.size + length
+            if mask & self.IN_Q_OVERFLOW:
+                logging.warning( "inotify queue overflowed - rescanning [%s]", self.input_dir )
+                ready.extend( entry.path for entry in scan_images( self.input_dir, **self.scan_options ) )
+                continue
+            if mask & self.IN_IGNORED:
+                self.watches.pop( wd, None )
+                continue
+            if wd not in self.watches:
+                continue
+            path = os.path.join( self.watches[wd], name )
+            if mask & self.IN_ISDIR:
+                if self.recursive and mask & ( self.IN_CREATE | self.IN_MOVED_TO ) \
+                        and os.path.abspath( path ) not in self.skip_dirs \
+                        and not ( self.exclude and any( fnmatch.fnmatch( name, pattern ) for pattern in self.exclude ) ):
+                    self.add_tree( path )
+                    ready.extend( entry.path for entry in scan_images( path, **self.scan_options ) )
+            elif mask & ( self.IN_CLOSE_WRITE | self.IN_MOVED_TO ):
+                if wanted_image( name, self.extensions, include=self.include, exclude=self.exclude ):
+                    ready.append( path )
+        return ready
+
+    def close( self ):
+        os.close( self.fd )
+
+def make_watcher( input_dir, backend="auto", interval=2.0, **scan_options ):
+    '''The --watch backend asked for - "auto" means inotify where the platform has it'''
+    if backend == "auto":
+        backend = "inotify" if sys.platform.startswith( 'linux' ) else "poll"
+    if backend == "inotify":
+        try:
+            return InotifyWatcher( input_dir, **scan_options )
+        except (OSError, AttributeError) as e:
+            logging.warning( "inotify not available (%s) - polling every %s seconds instead", e, interval )
+    return PollingWatcher( input_dir, interval=interval, **scan_options )
+
+def watch_batches( watcher, debounce, max_batch ):
+    '''Group the paths the watcher reports into batches (lists). A batch is sent once no new file 
+    has turned up for debounce seconds, or once it holds max_batch files'''
+    batch = collections.OrderedDict()
+    while True:
+        ready = watcher.poll( debounce if batch else None )
+        for path in ready:
+            batch[path] = True
+        if batch and ( not ready or len( batch ) >= max_batch ):
+            yield list( batch )
+            batch = collections.OrderedDict()
+
+def watch_images( input_dir, watcher, debounce, max_batch, gone=None, **scan_options ):
+    '''The image stream for --watch: what is in input_dir now, then new images in batches as the 
+    watcher reports them, each batch followed by BATCH_END. A path is passed on again only if it 
+    has changed (size or mtime) since. gone - a set the caller adds (absolute) paths it has moved 
+    away to; they are forgotten before each batch, so a long watch doesn't grow without bound, 
+    and a file that turns up under the name again is passed on. Ends quietly on Ctrl-C'''
+    seen = {} # absolute path => (size, mtime_ns) when passed on
+    if gone is None:
+        gone = set()
+    def fresh( paths ):
+        for path in paths:
+            try:
+                statinfo = os.stat( path )
+            except FileNotFoundError:
+                seen.pop( os.path.abspath( path ), None )
+                continue # moved away again - or already moved by us
+            signature = ( statinfo.st_size, statinfo.st_mtime_ns )
+            if seen.get( os.path.abspath( path )) != signature:
+                seen[os.path.abspath( path )] = signature
+                yield path
+    try:
+        for path in fresh( entry.path for entry in scan_images( input_dir, **scan_options ) ):
+            yield path
+        yield BATCH_END
+        logging.info( "Watching [%s] for new images", input_dir )
+        for batch in watch_batches( watcher, debounce, max_batch ):
+            logging.info( "Watch: %d new images", len( batch ) )
+            while gone:
+                seen.pop( gone.pop(), None )
+            for path in fresh( batch ):
+                yield path
+            yield BATCH_END
+    except KeyboardInterrupt:
+        logging.info( "Watch stopped" )
+
+def split_batches( images ):
+    '''Split an image stream at its BATCH_ENDs - an iterator per (non-empty) batch, to be used 
+    up before the next is asked for'''
+    images = iter( images )
+    for first in images:
+        if first is not BATCH_END:
+            yield itertools.chain( [ first ], itertools.takewhile( lambda image: image is not BATCH_END, images ))
+
+_thread_profiles = None # cProfile.Profile per worker thread while profile_run is running
+
+def worker_pool( max_workers ):
+    '''ThreadPoolExecutor for the date readers and the writers - under --profile each of its 
+    threads is profiled too'''
+    if _thread_profiles is None:
+        return concurrent.futures.ThreadPoolExecutor( max_workers=max_workers )
+    return concurrent.futures.ThreadPoolExecutor( max_workers=max_workers, initializer=start_thread_profile )
+
+def start_thread_profile():
+    import cProfile
+    profile = cProfile.Profile()
+    try:
+        profile.enable()
+    except ValueError:
+        return # one profiler already sees every thread (Python 3.12+)
+    _thread_profiles.append( profile )
+
+def profile_run( func, path ):
+    '''Run func() under cProfile - worker threads included - and dump the combined stats to path'''
+    import cProfile
+    import pstats
+    global _thread_profiles
+    _thread_profiles = []
+    profile = cProfile.Profile()
+    try:
+        return profile.runcall( func )
+    finally:
+        combined = pstats.Stats( profile )
+        for thread_profile in _thread_profiles:
+            combined.add( thread_profile )
+        _thread_profiles = None
+        combined.dump_stats( path )
+        logging.info( "Profile written to [%s]", path )
+
+class Arranger(object):
+    '''
+    The arranger as a library - for a service that wants to take in card after card without 
+    starting a process for each. Give it a Config, or the settings as keyword arguments, and 
+    iterate arrange() (or apply() for a saved plan) for a FileResult per image:
+
+        arranger = Arranger( outputdir="/archive", copy=True, skipsame=True )
+        for card in cards:
+            for result in arranger.arrange( inputdir=card ):
+                ...
+
+    The work is done as the results are pulled; stop pulling and it stops, leaving the journal 
+    to resume from. Setting up logging is left to the caller. stats is a RunStats over every 
+    call. The command line (main) is a thin wrapper round this. find_dates(), verify() and 
+    rebuild_catalog() work on the output directory's Catalog.
+
+    Calls may run at once, from several threads - one per card reader, say. They share one 
+    TransferScheduler, so the per-device limits and --bwlimit hold over all of them.
+    '''
+    def __init__( self, config=None, **settings ):
+        if config is None:
+            config = Config( **settings )
+        elif settings:
+            config = Config( **dict( vars( config ), **settings ))
+        self.config = config
+        self.stats = RunStats()
+        self.scheduler = TransferScheduler( config.device_jobs, config.bwlimit )
+
+    def settings( self, need_input=True, **overrides ):
+        '''A copy of the config with overrides (those not None), checked - raises ValueError'''
+        args = copy.copy( self.config )
+        for name, value in overrides.items():
+            if value is not None:
+                setattr( args, name, value )
+        problem = check_options( args, need_input=need_input )
+        if problem:
+            raise ValueError( problem )
+        return args
+
+    def arrange( self, images=None, inputdir=None ):
+        '''FileResults for arranging images (paths or os.DirEntry objects) - by default those in 
+        inputdir (the config's if not given) and, with watch set, then those that arrive there'''
+        args = self.settings( need_input=images is None, inputdir=inputdir )
+        if images is not None:
+            return arrange_images( images, args, stats=self.stats, scheduler=self.scheduler )
+        scan_options = dict( recursive=args.recursive, extensions=args.extensions or IMAGE_EXTENSIONS, 
+                             include=args.include, exclude=args.exclude, skip_dirs=[ args.outputdir ] )
+        if args.watch:
+            return self.watch( args, scan_options )
+        images = scan_images( args.inputdir, **scan_options )
+        return arrange_images( self.stats.timed_iter( "scan", images ), args, stats=self.stats, scheduler=self.scheduler )
+
+    def watch( self, args, scan_options ):
+        '''arrange_images over the watch stream - images this run moves away are passed back to 
+        watch_images to be forgotten'''
+        watcher = make_watcher( args.inputdir, args.watch_backend, interval=args.watch_interval, **scan_options )
+        gone = set()
+        try:
+            images = watch_images( args.inputdir, watcher, args.watch_debounce, args.watch_batch, gone=gone, **scan_options )
+            for result in arrange_images( images, args, stats=self.stats, scheduler=self.scheduler ):
+                if result.status == "done" and result.op == "move":
+                    gone.add( result.src )
+                yield result
+        finally:
+            watcher.close()
+
+    def apply( self, plan_file=None ):
+        '''FileResults for carrying out a plan written with plan_out - plan_file, or the config's apply'''
+        if not ( plan_file or self.config.apply ):
+            raise ValueError( "No plan to apply" )
+        args = self.settings( apply=plan_file )
+        return run_plan( read_plan( args.apply ), args, open_journal( args, args.apply + ".journal" ), 
+                         stats=self.stats, scheduler=self.scheduler )
+
+    def catalog( self ):
+        '''The Catalog of the output directory - to be closed by the caller'''
+        catalog = open_catalog( self.settings( need_input=False ))
+        if catalog is None:
+            raise ValueError( "The catalog is turned off" )
+        return catalog
+
+    def find_dates( self, start, end=None ):
+        '''(creation date, path) of each catalogued file created from start to end - "2015", 
+        "2015-03" or "2015-03-29" - in date order'''
+        catalog = self.catalog()
+        try:
+            yield from catalog.find( start, end )
+        finally:
+            catalog.close()
+
+    def verify( self ):
+        '''(path, problem) for each catalogued file that is not on disk as catalogued - see 
+        Catalog.verify. Counted in stats as verify_<problem>'''
+        catalog = self.catalog()
+        try:
+            for path, problem in catalog.verify( self.config.jobs ):
+                logging.warning( "Catalogued file [%s] is %s", path, problem )
+                self.stats.count( "verify_" + problem )
+                yield path, problem
+        finally:
+            catalog.close()
+
+    def rebuild_catalog( self ):
+        '''Catalog what is in the output directory now'''
+        catalog = self.catalog()
+        try:
+            with self.stats.timer( "rebuild_catalog" ):
+                catalog.rebuild( self.config.jobs )
+        finally:
+            catalog.close()
+
+    def run( self ):
+        '''Do whatever the config asks for, as the command line does - results are only logged, 
+        except that --find-dates prints what it finds. Returns stats'''
+        config = self.config
+        if config.rebuild_catalog:
+            self.rebuild_catalog()
+        if config.find_dates:
+            for date, path in self.find_dates( *config.find_dates ):
+                print( "{0}\t{1}".format( date, path ))
+        if config.verify:
+            problems = sum( 1 for problem in self.verify() )
+            logging.info( "Verified catalog of [%s]: %d problems", config.outputdir, problems )
+        if catalog_command( config ) and not ( config.inputdir or config.apply ):
+            return self.stats
+        collections.deque( self.apply() if config.apply else self.arrange(), maxlen=0 )
+        return self.stats
+
+def main( argv=None ):
+    args = parse_options( argv )
+    listener = setup_logger( args.logfile, debug=args.debug )
+    try:
+        log_startup_options( args )
+        arranger = Arranger( args )
+        if args.profile:
+            profile_run( arranger.run, args.profile )
+        else:
+            arranger.run()
+        if args.stats:
+            write_stats( arranger.stats, args.stats )
+    finally:
+        if listener is not None:
+            listener.stop()
+    if any( count for name, count in arranger.stats.counters.items() if name.startswith( "verify_" )):
+        sys.exit( 1 )
 
 
 
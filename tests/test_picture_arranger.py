@@ -1,6 +1,19 @@
 import unittest
 import os
 import sys
+import json
+import logging
+import struct
+import time
+import zlib
+import datetime
+import shutil
+import collections
+import threading
+import concurrent.futures
+import subprocess
+import tempfile
+from unittest import mock
 import picture_arranger
 from picture_arranger import FileSameException
 
@@ -23,18 +36,110 @@ class TestPictureArranger(unittest.TestCase):
         self.assertEquals( args.inputdir, " in" )    
 
     def test_get_image_list(self):
-        images = picture_arranger.get_image_list( os.path.join( os.getcwd(), "tests/1" ) )
-        test_images = [ os.path.join( os.getcwd(), 'tests/1\\IMG-20140626-00774.jpg') ]
+        images = list( picture_arranger.get_image_list( os.path.join( os.getcwd(), "tests", "1" ) ) )
+        test_images = [ os.path.join( os.getcwd(), 'tests', '1', 'IMG-20140626-00774.jpg') ]
         self.assertListEqual(test_images, images)
 
+    def test_get_image_list_recursive(self):
+        images = picture_arranger.get_image_list( os.path.join( os.getcwd(), "tests" ), recursive=True, 
+                                                  exclude=['*(*)*'] )
+        names = sorted( os.path.relpath( image, os.path.join( os.getcwd(), "tests" ) ) for image in images )
+        self.assertListEqual( names, [ os.path.join( '1', 'IMG-20140626-00774.jpg'),
+                                       os.path.join( '2', 'IMG-20140626-00774_no_exif.jpg'),
+                                       os.path.join( '4', 'IMG-20140626-00774.jpg'),
+                                       os.path.join( '5', 'IMG-20140626-00774.jpg'),
+                                       os.path.join( 'integration', 'test_data', 'IMG_1030.JPG') ] )
+
+    def test_get_image_list_include_and_skip_dirs(self):
+        images = picture_arranger.get_image_list( os.path.join( os.getcwd(), "tests" ), recursive=True, 
+                                                  include=['IMG_*'], skip_dirs=[ os.path.join( os.getcwd(), "tests", "5" ) ] )
+        self.assertListEqual( list( images ), [ os.path.join( os.getcwd(), 'tests', 'integration', 'test_data', 'IMG_1030.JPG') ] )
+
     def test_get_image_creation_date_from_exif(self):
-        date = picture_arranger.get_image_creation_date( os.path.join( os.getcwd(), 'tests/1\\IMG-20140626-00774.jpg') )
+        date = picture_arranger.get_image_creation_date( os.path.join( os.getcwd(), 'tests', '1', 'IMG-20140626-00774.jpg') )
         self.assertEquals( date, "2014:06:26 16:45:58" )
 
     def test_get_image_creation_date_from_mtime(self):
-        date = picture_arranger.get_image_creation_date( os.path.join( os.getcwd(), 'tests/2\\IMG-20140626-00774_no_exif.jpg') )
+        date = picture_arranger.get_image_creation_date( os.path.join( os.getcwd(), 'tests', '2', 'IMG-20140626-00774_no_exif.jpg') )
         self.assertEquals( date, "2018:05:01 22:37:22" )
 
+    def test_read_exif_date_matches_pil(self):
+        for image in [ os.path.join( os.getcwd(), 'tests', '1', 'IMG-20140626-00774.jpg'),
+                       os.path.join( os.getcwd(), 'tests', '2', 'IMG-20140626-00774_no_exif.jpg'),
+                       os.path.join( os.getcwd(), 'tests', 'integration', 'test_data', 'IMG_1030.JPG') ]:
+            self.assertEqual( picture_arranger.read_exif_date( image ), picture_arranger.read_exif_date_pil( image ) )
+
+    def test_read_exif_date_not_jpeg(self):
+        with self.assertRaises(ValueError):
+            picture_arranger.read_exif_date( os.path.join( os.getcwd(), 'tests', 'test_picture_arranger.py') )
+
+    def test_read_header_date_truncated(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup( shutil.rmtree, tmpdir )
+        for name, data in [ ('a.jpg', b'\xff\xd8\xff\xe1\x00'), ('a.tif', b'II*\x00\x08') ]:
+            path = os.path.join( tmpdir, name )
+            with open( path, 'wb' ) as f:
+                f.write( data )
+            with self.assertRaises(ValueError):
+                picture_arranger.read_header_date( path )
+            self.assertEqual( picture_arranger.read_image_creation_date( path )[1], "mtime" )
+
+    def test_date_cache_hit(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup( shutil.rmtree, tmpdir )
+        image = os.path.join( os.getcwd(), 'tests', '1', 'IMG-20140626-00774.jpg')
+        cache = picture_arranger.DateCache( os.path.join( tmpdir, 'dates.sqlite' ) )
+        self.assertEqual( picture_arranger.get_image_creation_date( image, cache=cache ), "2014:06:26 16:45:58" )
+        cache.close()
+        cache = picture_arranger.DateCache( os.path.join( tmpdir, 'dates.sqlite' ) )
+        with mock.patch.object( picture_arranger, 'read_image_creation_date', side_effect=AssertionError ):
+            self.assertEqual( picture_arranger.get_image_creation_date( image, cache=cache ), "2014:06:26 16:45:58" )
+        self.assertEqual( cache.get( os.stat( image ) ), ("2014:06:26 16:45:58", "exif") )
+        cache.close()
+
+    def test_date_cache_tells_dir_entries_apart_without_inodes(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup( shutil.rmtree, tmpdir )
+        class WindowsDirEntry(object): # DirEntry.stat() on Windows leaves st_ino and st_dev 0
+            def __init__( self, path ):
+                self.path = path
+            def __fspath__( self ):
+                return self.path
+            def stat( self ):
+                statinfo = os.stat( self.path )
+                return os.stat_result( ( statinfo.st_mode, 0, 0 ) + tuple( statinfo )[3:] )
+        images = []
+        for name, date in [ ( 'a.raw', 1500000000 ), ( 'b.raw', 1600000000 ) ]:
+            path = os.path.join( tmpdir, name )
+            with open( path, 'wb' ) as f:
+                f.write( bytes( 100 ) ) # same size, same (FAT) mtime, different shots
+            os.utime( path, ns=( 1500000000 * 10 ** 9, 1500000000 * 10 ** 9 ) )
+            images.append( ( WindowsDirEntry( path ), date ) )
+        cache = picture_arranger.DateCache( os.path.join( tmpdir, 'dates.sqlite' ) )
+        self.addCleanup( cache.close )
+        with mock.patch.object( picture_arranger.os, 'DirEntry', WindowsDirEntry ):
+            for entry, date in images:
+                self.assertNotEqual( picture_arranger.image_stat( entry ).st_ino, 0 )
+                with mock.patch.object( picture_arranger, 'read_image_creation_date', return_value=( date, "exif" ) ):
+                    self.assertEqual( picture_arranger.get_image_creation_date( entry, cache=cache ), date )
+
+    def test_date_cache_eviction(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup( shutil.rmtree, tmpdir )
+        cache = picture_arranger.DateCache( os.path.join( tmpdir, 'dates.sqlite' ), max_entries=2 )
+        stats = []
+        for name in ['a.jpg', 'b.jpg', 'c.jpg']:
+            with open( os.path.join( tmpdir, name ), 'w' ) as f:
+                f.write( name )
+            stats.append( os.stat( os.path.join( tmpdir, name ) ) )
+        for statinfo in stats:
+            cache.put( statinfo, "2018:04:01 22:15:00", "mtime" )
+        cache.close()
+        cache = picture_arranger.DateCache( os.path.join( tmpdir, 'dates.sqlite' ), max_entries=2 )
+        self.assertIsNone( cache.get( stats[0] ) )
+        self.assertIsNotNone( cache.get( stats[2] ) )
+        cache.close()
+
     def test_create_target_path_file_in_way(self):
         outputdir = os.path.join( os.getcwd(), 'tests/3' )
         with self.assertRaises(IOError):
@@ -77,6 +182,839 @@ class TestPictureArranger(unittest.TestCase):
         filename = picture_arranger.create_target_file( outdir, image )
         self.assertEquals( filename, expected_filename )
 
+    def test_create_target_file_index_burst(self):
+        image = os.path.join( os.getcwd(), 'tests', '1', 'IMG-20140626-00774.jpg')
+        outdir = os.path.join( os.getcwd(), 'tests', '5' )
+        index = picture_arranger.TargetIndex()
+        filenames = [ picture_arranger.create_target_file( outdir, image, index=index ) for i in range( 3 ) ]
+        self.assertListEqual( filenames, [ 'IMG-20140626-00774(4).jpg', 'IMG-20140626-00774(5).jpg', 'IMG-20140626-00774(6).jpg' ] )
+        self.assertEqual( index.next_free[ (outdir, 'IMG-20140626-00774.jpg') ], 7 )
+
+    def test_create_target_path_index_skips_checks(self):
+        outputdir = os.path.join( os.getcwd(), 'tests', '3' )
+        index = picture_arranger.TargetIndex()
+        picture_arranger.create_target_path( outputdir, "2018:04:05 22:17:00", dryrun=True, index=index )
+        with mock.patch.object( picture_arranger.os.path, 'exists', side_effect=AssertionError ):
+            picture_arranger.create_target_path( outputdir, "2018:04:05 23:17:00", dryrun=True, index=index )
+
+    def test_dedup_index_finds_copy_anywhere(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup( shutil.rmtree, tmpdir )
+        image = os.path.join( os.getcwd(), 'tests', '1', 'IMG-20140626-00774.jpg')
+        no_exif = os.path.join( os.getcwd(), 'tests', '2', 'IMG-20140626-00774_no_exif.jpg')
+        os.makedirs( os.path.join( tmpdir, '2001', '01', '01' ) )
+        shutil.copy2( image, os.path.join( tmpdir, '2001', '01', '01', 'renamed.jpg' ) )
+        dedup = picture_arranger.DedupIndex( os.path.join( tmpdir, 'dedup' ), tmpdir )
+        self.assertEqual( dedup.find_duplicate( image, os.path.getsize( image ) ), 
+                          os.path.join( tmpdir, '2001', '01', '01', 'renamed.jpg' ) )
+        # same size, different bytes
+        self.assertIsNone( dedup.find_duplicate( no_exif, os.path.getsize( no_exif ) ) )
+        dedup.add( os.path.join( tmpdir, 'placed.jpg' ), no_exif, os.path.getsize( no_exif ) )
+        shutil.copy2( no_exif, os.path.join( tmpdir, 'placed.jpg' ) )
+        dedup.done( os.path.join( tmpdir, 'placed.jpg' ) )
+        # planned, but the transfer was skipped - something else of that size got there first
+        dedup.add( os.path.join( tmpdir, 'taken.jpg' ), no_exif, os.path.getsize( no_exif ) )
+        shutil.copy2( image, os.path.join( tmpdir, 'taken.jpg' ) )
+        dedup.close()
+        dedup = picture_arranger.DedupIndex( os.path.join( tmpdir, 'dedup' ), tmpdir )
+        self.assertEqual( sorted( path for ( path, ) in dedup.db.execute( "SELECT path FROM files" )), 
+                          [ os.path.join( '2001', '01', '01', 'renamed.jpg' ), 'placed.jpg' ] )
+        self.assertEqual( dedup.find_duplicate( no_exif, os.path.getsize( no_exif ) ), os.path.join( tmpdir, 'placed.jpg' ) )
+        dedup.close()
+        os.unlink( os.path.join( tmpdir, 'taken.jpg' ) )
+        # a dryrun sees the index as it is, but leaves it alone
+        with open( os.path.join( tmpdir, 'dedup' ), 'rb' ) as f:
+            stored = f.read()
+        os.unlink( os.path.join( tmpdir, '2001', '01', '01', 'renamed.jpg' ) )
+        dedup = picture_arranger.DedupIndex( os.path.join( tmpdir, 'dedup' ), tmpdir, rescan=True, dryrun=True )
+        self.assertIsNone( dedup.find_duplicate( image, os.path.getsize( image ) ) )
+        dedup.add( os.path.join( tmpdir, 'more.jpg' ), image, os.path.getsize( image ) )
+        dedup.close()
+        with open( os.path.join( tmpdir, 'dedup' ), 'rb' ) as f:
+            self.assertEqual( f.read(), stored )
+        self.assertIsNone( picture_arranger.DedupIndex( os.path.join( tmpdir, 'new', 'dedup' ), tmpdir, dryrun=True ).close() )
+        self.assertFalse( os.path.exists( os.path.join( tmpdir, 'new' ) ) )
+        dedup = picture_arranger.DedupIndex( os.path.join( tmpdir, 'dedup' ), tmpdir )
+        self.assertIsNone( dedup.find_duplicate( image, os.path.getsize( image ) ) )
+        dedup.close()
+
+    def _transfer_source(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup( shutil.rmtree, tmpdir )
+        src = os.path.join( tmpdir, 'src.jpg' )
+        shutil.copy2( os.path.join( os.getcwd(), 'tests', '1', 'IMG-20140626-00774.jpg'), src )
+        os.utime( src, ns=(1000000000, 1000000000) )
+        return tmpdir, src
+
+    def test_move_file_copy_modes(self):
+        tmpdir, src = self._transfer_source()
+        for mode in ['auto', 'copy']:
+            target = os.path.join( tmpdir, mode + '.jpg' )
+            picture_arranger.move_file( src, target, copy=True, mode=mode )
+            with open( src, 'rb' ) as f1, open( target, 'rb' ) as f2:
+                self.assertEqual( f1.read(), f2.read() )
+            self.assertEqual( os.stat( target ).st_mtime_ns, 1000000000 )
+            self.assertNotEqual( os.stat( target ).st_ino, os.stat( src ).st_ino )
+
+    def test_move_file_hardlink(self):
+        tmpdir, src = self._transfer_source()
+        target = os.path.join( tmpdir, 'link.jpg' )
+        picture_arranger.move_file( src, target, copy=True, mode='hardlink' )
+        self.assertEqual( os.stat( target ).st_ino, os.stat( src ).st_ino )
+
+    def test_move_file_move_modes(self):
+        tmpdir, src = self._transfer_source()
+        inode = os.stat( src ).st_ino
+        target = os.path.join( tmpdir, 'moved.jpg' )
+        picture_arranger.move_file( src, target, copy=False, mode='auto' )
+        self.assertFalse( os.path.exists( src ) )
+        self.assertEqual( os.stat( target ).st_ino, inode )
+        picture_arranger.move_file( target, src, copy=False, mode='copy' )
+        self.assertFalse( os.path.exists( target ) )
+        self.assertNotEqual( os.stat( src ).st_ino, inode )
+        self.assertEqual( os.stat( src ).st_mtime_ns, 1000000000 )
+
+    def test_fast_copy_falls_back(self):
+        tmpdir, src = self._transfer_source()
+        target = os.path.join( tmpdir, 'fallback.jpg' )
+        unsupported = OSError( picture_arranger.errno.ENOSYS, "nope" )
+        with mock.patch.object( picture_arranger, 'copy_range_chunks', side_effect=unsupported ), \
+             mock.patch.object( picture_arranger, 'sendfile_chunks', side_effect=unsupported ):
+            picture_arranger.fast_copy( src, target )
+        with open( src, 'rb' ) as f1, open( target, 'rb' ) as f2:
+            self.assertEqual( f1.read(), f2.read() )
+
+    def test_move_file_failure_leaves_no_partial(self):
+        tmpdir, src = self._transfer_source()
+        target = os.path.join( tmpdir, 'target.jpg' )
+        with mock.patch.object( picture_arranger.shutil, 'copystat', side_effect=OSError( "disk gone" ) ):
+            with self.assertRaises(OSError):
+                picture_arranger.move_file( src, target, copy=True, mode='copy' )
+        self.assertListEqual( os.listdir( tmpdir ), [ 'src.jpg' ] )
+
+    def test_resume_from_journal(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup( shutil.rmtree, tmpdir )
+        indir = os.path.join( tmpdir, 'in' )
+        daydir = os.path.join( tmpdir, 'out', '2018', '04', '01' )
+        os.makedirs( indir )
+        os.makedirs( daydir )
+        for name in ['a.jpg', 'b.jpg', 'c.jpg']:
+            with open( os.path.join( indir, name ), 'w' ) as f:
+                f.write( name )
+        # a.jpg finished, b.jpg was renamed into place but not journalled as done
+        shutil.copy2( os.path.join( indir, 'b.jpg' ), os.path.join( daydir, 'b.jpg' ) )
+        journal = picture_arranger.Journal( picture_arranger.default_journal_file( os.path.join( tmpdir, 'out' ), indir ) )
+        for event, name in [('start', 'a.jpg'), ('done', 'a.jpg'), ('start', 'b.jpg')]:
+            journal.record( event, { "op": "move", "src": os.path.join( indir, name ), 
+                                     "target": os.path.join( daydir, name ), "mode": "auto" } )
+        journal.close()
+        sys.argv[1:] = ['-i', indir, '-o', os.path.join( tmpdir, 'out' ), '--no-cache', '--resume']
+        with mock.patch.object( picture_arranger, 'get_image_creation_date', return_value="2018:04:01 22:15:00" ) as read_date:
+            picture_arranger.main()
+        self.assertListEqual( [ os.path.basename( os.fspath( call[0][0] ) ) for call in read_date.call_args_list ], [ 'c.jpg' ] )
+        self.assertListEqual( sorted( os.listdir( indir ) ), [ 'a.jpg' ] ) # "finished" by a run that didn't really move it
+        self.assertListEqual( sorted( os.listdir( daydir ) ), [ 'b.jpg', 'c.jpg' ] )
+        self.assertFalse( os.path.exists( picture_arranger.default_journal_file( os.path.join( tmpdir, 'out' ), indir ) ) )
+
+    def test_journal_survives_kill_and_sweeps_partials(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup( shutil.rmtree, tmpdir )
+        daydir = os.path.join( tmpdir, 'out', '2018', '04', '01' )
+        os.makedirs( daydir )
+        op = { "op": "copy", "src": os.path.join( tmpdir, 'a.jpg' ), "target": os.path.join( daydir, 'a.jpg' ), "mode": "auto" }
+        journal = picture_arranger.Journal( os.path.join( tmpdir, 'journal' ) )
+        journal.record( "start", op )
+        with open( os.path.join( tmpdir, 'journal' ) ) as f: # on its way to disk without a sync or close
+            self.assertEqual( json.loads( f.read() )["src"], op["src"] )
+        for name in [ '.a.jpg.4242.partial', '.b.jpg.4242.partial', 'a.jpg.partial' ]:
+            open( os.path.join( daydir, name ), 'w' ).close()
+        resumed = picture_arranger.Journal( os.path.join( tmpdir, 'journal' ), resume=True )
+        self.assertEqual( resumed.recover(), 0 )
+        resumed.close()
+        journal.close()
+        self.assertListEqual( sorted( os.listdir( daydir ) ), [ '.b.jpg.4242.partial', 'a.jpg.partial' ] )
+
+    def test_setup_logger_twice(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup( shutil.rmtree, tmpdir )
+        root = logging.getLogger()
+        saved = root.handlers[:], root.level
+        def restore():
+            root.handlers[:] = saved[0]
+            root.setLevel( saved[1] )
+        self.addCleanup( restore )
+        root.handlers[:] = []
+        for name in [ 'log1', 'log2' ]:
+            listener = picture_arranger.setup_logger( os.path.join( tmpdir, name ) )
+            self.assertIsNotNone( listener )
+            logging.info( "to %s", name )
+            listener.stop()
+            self.assertEqual( root.handlers, [] )
+            with open( os.path.join( tmpdir, name ) ) as f:
+                self.assertIn( "to " + name, f.read() )
+
+    def test_plan_out_then_apply(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup( shutil.rmtree, tmpdir )
+        indir = os.path.join( tmpdir, 'in' )
+        outdir = os.path.join( tmpdir, 'out' )
+        plan_file = os.path.join( tmpdir, 'plan.jsonl' )
+        os.makedirs( indir )
+        for name in ['a.jpg', 'b.jpg']:
+            shutil.copy2( os.path.join( os.getcwd(), 'tests', '1', 'IMG-20140626-00774.jpg'), os.path.join( indir, name ) )
+        shutil.copy2( os.path.join( os.getcwd(), 'tests', 'integration', 'test_data', 'IMG_1030.JPG'), os.path.join( indir, 'c.jpg' ) )
+        sys.argv[1:] = ['-i', indir, '-o', outdir, '-c', '-s', '-d', '--no-cache', '--plan-out', plan_file]
+        picture_arranger.main()
+        self.assertFalse( os.path.exists( outdir ) )
+        plan = picture_arranger.read_plan( plan_file )
+        self.assertEqual( len( plan ), 2 ) # a.jpg and b.jpg are the same
+        self.assertEqual( sorted( os.path.relpath( op['target'], outdir ) for op in plan )[1], 
+                          os.path.join( '2015', '03', '29', 'c.jpg' ) )
+        sys.argv[1:] = ['--apply', plan_file]
+        with mock.patch.object( picture_arranger, 'get_image_creation_date', side_effect=AssertionError ):
+            picture_arranger.main()
+        for op in plan:
+            self.assertTrue( os.path.exists( op['target'] ) )
+            self.assertTrue( os.path.exists( op['src'] ) )
+        # no -o given, but the output directory's catalog still hears of what was placed
+        self.assertEqual( sorted( path for date, path in picture_arranger.Arranger( outputdir=outdir ).find_dates( '2000', '2020' ) ), 
+                          sorted( op['target'] for op in plan ) )
+
+    def test_stats_report(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup( shutil.rmtree, tmpdir )
+        indir = os.path.join( tmpdir, 'in' )
+        os.makedirs( indir )
+        shutil.copy2( os.path.join( os.getcwd(), 'tests', '1', 'IMG-20140626-00774.jpg'), indir )
+        shutil.copy2( os.path.join( os.getcwd(), 'tests', '2', 'IMG-20140626-00774_no_exif.jpg'), indir )
+        stats_file = os.path.join( tmpdir, 'stats.json' )
+        sys.argv[1:] = ['-i', indir, '-o', os.path.join( tmpdir, 'out' ), '-c', '--no-cache', '--stats', stats_file]
+        picture_arranger.main()
+        with open( stats_file ) as f:
+            summary = json.load( f )
+        self.assertEqual( summary['counters']['date_from_exif'], 1 )
+        self.assertEqual( summary['counters']['date_from_mtime'], 1 )
+        self.assertEqual( summary['counters']['files_transferred'], 2 )
+        self.assertEqual( summary['counters']['bytes_transferred'], 2 * 45440 )
+        for stage in ['scan', 'date', 'target_path', 'target_file', 'transfer']:
+            self.assertEqual( summary['stages'][stage]['files'], 2 )
+            self.assertEqual( sum( summary['stages'][stage]['histogram_us'].values() ), 2 )
+
+    def test_stats_clash_iterations(self):
+        stats = picture_arranger.RunStats()
+        image = os.path.join( os.getcwd(), 'tests', '1', 'IMG-20140626-00774.jpg')
+        picture_arranger.create_target_file( os.path.join( os.getcwd(), 'tests', '5' ), image, stats=stats )
+        self.assertEqual( stats.counters['clash_iterations'], 4 )
+
+    def test_parallel_clash_order_matches_serial(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup( shutil.rmtree, tmpdir )
+        images = []
+        for src in ['a', 'b', 'c', 'd']:
+            os.makedirs( os.path.join( tmpdir, src ) )
+            images.append( os.path.join( tmpdir, src, 'IMG.jpg' ) )
+            with open( images[-1], 'w' ) as f:
+                f.write( src )
+        outdir = os.path.join( tmpdir, 'out' )
+        sys.argv[1:] = ['-i', tmpdir, '-o', outdir, '-c', '--jobs', '4', '--io-jobs', '4', '--no-cache']
+        with mock.patch.object( picture_arranger, 'scan_images', return_value=images ), \
+             mock.patch.object( picture_arranger, 'get_image_creation_date', return_value="2018:04:01 22:15:00" ):
+            picture_arranger.main()
+        daydir = os.path.join( outdir, '2018', '04', '01' )
+        for name, content in [('IMG.jpg', 'a'), ('IMG(1).jpg', 'b'), ('IMG(2).jpg', 'c'), ('IMG(3).jpg', 'd')]:
+            with open( os.path.join( daydir, name ) ) as f:
+                self.assertEqual( f.read(), content )
+
+    def test_watch_batches_debounce(self):
+        class FakeWatcher(object):
+            def __init__(self, polls):
+                self.polls = list( polls )
+            def poll(self, timeout=None):
+                if not self.polls:
+                    raise KeyboardInterrupt
+                return self.polls.pop( 0 )
+        watcher = FakeWatcher( [['a'], ['b', 'a'], [], ['c', 'd', 'e'], ['f']] )
+        batches = picture_arranger.watch_batches( watcher, debounce=1, max_batch=3 )
+        self.assertEqual( next( batches ), ['a', 'b'] )
+        self.assertEqual( next( batches ), ['c', 'd', 'e'] )
+        self.assertRaises( KeyboardInterrupt, next, batches )
+
+    def test_polling_watcher_waits_for_stable_files(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup( shutil.rmtree, tmpdir )
+        watcher = picture_arranger.PollingWatcher( tmpdir, interval=0 )
+        path = os.path.join( tmpdir, 'a.jpg' )
+        with open( path, 'w' ) as f:
+            f.write( 'a' )
+        self.assertEqual( watcher.poll(), [] )
+        self.assertEqual( watcher.poll(), [path] )
+        self.assertEqual( watcher.poll(), [] )
+
+    def test_watch_arranges_new_batches(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup( shutil.rmtree, tmpdir )
+        indir = os.path.join( tmpdir, 'in' )
+        outdir = os.path.join( tmpdir, 'out' )
+        os.makedirs( indir )
+        shutil.copy2( os.path.join( os.getcwd(), 'tests', '1', 'IMG-20140626-00774.jpg'), indir )
+        new_image = os.path.join( indir, 'new.jpg' )
+        test = self
+        class FakeWatcher(object):
+            polls = 0
+            def poll(self, timeout=None):
+                self.polls += 1
+                if self.polls == 1:
+                    # the first batch is over and done with - its journal records with it
+                    journals = [ os.path.join( outdir, name ) for name in os.listdir( outdir ) if 'journal' in name ]
+                    test.assertEqual( [ os.path.getsize( journal ) for journal in journals ], [0] )
+                    shutil.copy2( os.path.join( os.getcwd(), 'tests', '1', 'IMG-20140626-00774.jpg'), new_image )
+                    with open( new_image, 'ab' ) as f:
+                        f.write( b'\x00' ) # not the same file, for -s
+                    return [new_image]
+                if self.polls == 2:
+                    return []
+                raise KeyboardInterrupt
+            def close(self):
+                pass
+        sys.argv[1:] = ['-i', indir, '-o', outdir, '--no-cache', '--watch', '-s', '--dedup-rescan']
+        build = picture_arranger.DedupIndex.build
+        catalog_names = picture_arranger.Catalog.names
+        with mock.patch.object( picture_arranger, 'make_watcher', return_value=FakeWatcher() ), \
+                mock.patch.object( picture_arranger.DedupIndex, 'build', autospec=True, side_effect=build ) as builds, \
+                mock.patch.object( picture_arranger.Catalog, 'names', autospec=True, side_effect=catalog_names ) as listings:
+            picture_arranger.main()
+        daydir = os.path.join( outdir, '2014', '06', '26' )
+        self.assertEqual( sorted( os.listdir( daydir ) ), ['IMG-20140626-00774.jpg', 'new.jpg'] )
+        self.assertEqual( os.listdir( indir ), [] )
+        # the indexes stay open - and the target directory known - from one batch to the next
+        self.assertEqual( builds.call_count, 1 )
+        self.assertEqual( listings.call_count, 1 )
+        self.assertEqual( [ name for name in os.listdir( outdir ) if 'journal' in name ], [] )
+
+    def test_watch_images_forgets_moved_files(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup( shutil.rmtree, tmpdir )
+        first = os.path.join( tmpdir, 'a.jpg' )
+        second = os.path.join( tmpdir, 'b.jpg' )
+        for path in ( first, second ):
+            open( path, 'wb' ).close()
+            os.utime( path, ( 1500000000, 1500000000 ))
+        class FakeWatcher(object):
+            polls = 0
+            def poll(self, timeout=None):
+                self.polls += 1
+                if self.polls > 1:
+                    return []
+                # another card with the same name, size and (FAT) mtime
+                open( first, 'wb' ).close()
+                os.utime( first, ( 1500000000, 1500000000 ))
+                return [first, second]
+        gone = set()
+        images = picture_arranger.watch_images( tmpdir, FakeWatcher(), debounce=0, max_batch=10, gone=gone )
+        batches = picture_arranger.split_batches( images )
+        self.assertEqual( sorted( next( batches )), [first, second] )
+        os.unlink( first ) # arranged, and so moved away
+        gone.add( first )
+        self.assertEqual( list( next( batches )), [first] ) # second is unchanged - and was left where it is
+
+    @unittest.skipUnless( sys.platform.startswith( 'linux' ), "inotify is Linux only" )
+    def test_inotify_watcher(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup( shutil.rmtree, tmpdir )
+        watcher = picture_arranger.InotifyWatcher( tmpdir, recursive=True )
+        self.addCleanup( watcher.close )
+        image = os.path.join( tmpdir, 'a.jpg' )
+        with open( image, 'wb' ) as f:
+            f.write( b'\xff\xd8' )
+        with open( os.path.join( tmpdir, 'notes.txt' ), 'w' ) as f:
+            f.write( 'not an image' )
+        self.assertEqual( watcher.poll( 5 ), [image] )
+        # a new directory is watched (IN_ISDIR) - and scanned, for files that beat the watch
+        subdir = os.path.join( tmpdir, 'sub' )
+        os.makedirs( subdir )
+        early = os.path.join( subdir, 'early.jpg' )
+        open( early, 'wb' ).close()
+        self.assertIn( early, watcher.poll( 5 ) )
+        late = os.path.join( subdir, 'late.jpg' )
+        open( late, 'wb' ).close()
+        self.assertEqual( watcher.poll( 5 ), [late] )
+        self.assertEqual( watcher.poll( 0 ), [] )
+        # an overflowed queue means a rescan of the whole tree
+        open( os.path.join( tmpdir, 'c.jpg' ), 'wb' ).close()
+        overflow = watcher.EVENT.pack( -1, watcher.IN_Q_OVERFLOW, 0, 0 )
+        with mock.patch.object( picture_arranger.os, 'read', return_value=overflow ):
+            self.assertEqual( sorted( watcher.poll( 5 )), sorted( [ image, early, late, os.path.join( tmpdir, 'c.jpg' ) ] ))
+
+    def test_watch_rejects_plan_out(self):
+        sys.argv[1:] = ['-i', 'in', '-o', 'out', '--watch', '--plan-out', 'plan.jsonl']
+        self.assertRaises( SystemExit, picture_arranger.parse_options )
+
+    def test_placeholders_claim_against_other_runs(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup( shutil.rmtree, tmpdir )
+        image = os.path.join( os.getcwd(), 'tests', '1', 'IMG-20140626-00774.jpg')
+        # both runs list the directory before either has claimed anything
+        first = picture_arranger.TargetIndex( placeholders=True )
+        second = picture_arranger.TargetIndex( placeholders=True )
+        first.taken( tmpdir )
+        second.taken( tmpdir )
+        self.assertEqual( picture_arranger.create_target_file( tmpdir, image, index=first ), 'IMG-20140626-00774.jpg' )
+        self.assertEqual( picture_arranger.create_target_file( tmpdir, image, index=second ), 'IMG-20140626-00774(1).jpg' )
+        self.assertEqual( sorted( os.listdir( tmpdir ) ), ['IMG-20140626-00774(1).jpg', 'IMG-20140626-00774.jpg'] )
+        picture_arranger.move_file( image, os.path.join( tmpdir, 'IMG-20140626-00774.jpg' ), copy=True )
+        self.assertEqual( os.path.getsize( os.path.join( tmpdir, 'IMG-20140626-00774.jpg' ) ), 45440 )
+
+    def test_failed_transfer_releases_placeholder(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup( shutil.rmtree, tmpdir )
+        target = os.path.join( tmpdir, 'IMG.jpg' )
+        self.assertTrue( picture_arranger.create_placeholder( target ) )
+        self.assertFalse( picture_arranger.create_placeholder( target ) )
+        op = { "op": "copy", "src": os.path.join( tmpdir, 'missing.jpg' ), "target": target, "mode": "copy" }
+        self.assertRaises( OSError, picture_arranger.run_operation, op )
+        self.assertEqual( os.listdir( tmpdir ), [] )
+
+    def test_claims_left_by_a_crash_are_released(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup( shutil.rmtree, tmpdir )
+        outdir = os.path.join( tmpdir, 'out' )
+        os.makedirs( outdir )
+        journal_file = os.path.join( tmpdir, 'journal' )
+        with open( os.path.join( tmpdir, 'b.jpg' ), 'w' ) as f:
+            f.write( 'b' )
+        for resume in [ True, False ]:
+            # a run claims two names, starts one transfer and is killed
+            journal = picture_arranger.Journal( journal_file )
+            index = picture_arranger.TargetIndex( placeholders=True, journal=journal )
+            self.assertTrue( index.claim( outdir, 'a.jpg' ) )
+            self.assertTrue( index.claim( outdir, 'b.jpg' ) )
+            journal.record( "start", { "op": "copy", "src": os.path.join( tmpdir, 'b.jpg' ), 
+                                       "target": os.path.join( outdir, 'b.jpg' ), "mode": "auto" } )
+            open( os.path.join( outdir, '.b.jpg.4242.partial' ), 'w' ).close()
+            self.assertEqual( sorted( os.listdir( outdir ) ), [ '.b.jpg.4242.partial', 'a.jpg', 'b.jpg' ] )
+            recovered = picture_arranger.Journal( journal_file, resume=resume )
+            if resume:
+                recovered.recover()
+            self.assertEqual( os.listdir( outdir ), [] )
+            recovered.close()
+            journal.file.close()
+        # claims the run never got to transfer are released when it stops
+        journal = picture_arranger.Journal( journal_file )
+        index = picture_arranger.TargetIndex( placeholders=True, journal=journal )
+        self.assertTrue( index.claim( outdir, 'c.jpg' ) )
+        other = picture_arranger.Journal( os.path.join( tmpdir, 'other' ) )
+        self.assertFalse( picture_arranger.claim_placeholder( os.path.join( outdir, 'c.jpg' ), other ) )
+        other.close() # not its placeholder to remove
+        self.assertEqual( os.listdir( outdir ), [ 'c.jpg' ] )
+        journal.close()
+        self.assertEqual( os.listdir( outdir ), [] )
+
+    def test_dedup_index_shared_between_runs(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup( shutil.rmtree, tmpdir )
+        image = os.path.join( os.getcwd(), 'tests', '1', 'IMG-20140626-00774.jpg')
+        shutil.copy2( image, os.path.join( tmpdir, 'a.jpg' ) )
+        with mock.patch.object( picture_arranger, 'SQLITE_LOCK_TIMEOUT', 0.1 ):
+            first = picture_arranger.DedupIndex( os.path.join( tmpdir, 'dedup' ), tmpdir )
+            second = picture_arranger.DedupIndex( os.path.join( tmpdir, 'dedup' ), tmpdir )
+        self.addCleanup( first.close )
+        self.addCleanup( second.close )
+        # neither holds the write lock between calls
+        self.assertEqual( first.find_duplicate( image, os.path.getsize( image ) ), os.path.join( tmpdir, 'a.jpg' ) )
+        first.add( os.path.join( tmpdir, 'b.jpg' ), image, os.path.getsize( image ) )
+        second.add( os.path.join( tmpdir, 'c.jpg' ), image, os.path.getsize( image ) )
+        self.assertEqual( second.find_duplicate( image, os.path.getsize( image ) ), os.path.join( tmpdir, 'a.jpg' ) )
+        first.add( os.path.join( tmpdir, 'd.jpg' ), image, os.path.getsize( image ) )
+
+    def test_dedup_index_hashes_archive_files_once(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup( shutil.rmtree, tmpdir )
+        image = os.path.join( os.getcwd(), 'tests', '1', 'IMG-20140626-00774.jpg')
+        archived = os.path.join( tmpdir, 'a.jpg' )
+        shutil.copy2( image, archived )
+        index = picture_arranger.DedupIndex( os.path.join( tmpdir, 'dedup' ), tmpdir )
+        self.addCleanup( index.close )
+        hashed = []
+        real_full_hash = picture_arranger.full_hash
+        def full_hash( path ):
+            hashed.append( path )
+            return real_full_hash( path )
+        with mock.patch.object( picture_arranger.IndexWrites, 'FLUSH_INTERVAL', 3600 ), \
+                mock.patch.object( picture_arranger, 'full_hash', full_hash ):
+            for _ in range( 3 ): # a burst, with the hashes learnt still held back
+                self.assertEqual( index.find_duplicate( image, os.path.getsize( image ) ), archived )
+        self.assertEqual( hashed.count( archived ), 1 )
+
+    def _gradient_image(self, path, size=(640, 480), flip=False):
+        from PIL import Image
+        img = Image.new( 'L', size )
+        img.putdata( [ ( x * 255 // size[0] + ( y * 7 ) % 64 ) % 256 for y in range( size[1] ) for x in range( size[0] ) ] )
+        if flip:
+            img = img.transpose( Image.FLIP_LEFT_RIGHT )
+        img.convert( 'RGB' ).save( path, quality=90 )
+
+    def test_dhash_survives_resize_and_recompression(self):
+        from PIL import Image
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup( shutil.rmtree, tmpdir )
+        original = os.path.join( tmpdir, 'original.jpg' )
+        smaller = os.path.join( tmpdir, 'smaller.jpg' )
+        flipped = os.path.join( tmpdir, 'flipped.jpg' )
+        self._gradient_image( original )
+        self._gradient_image( flipped, flip=True )
+        with Image.open( original ) as img:
+            img.resize( ( 320, 240 ) ).save( smaller, quality=40 )
+        value = picture_arranger.dhash( original )
+        self.assertLessEqual( picture_arranger.hamming_distances( value, [ picture_arranger.dhash( smaller ) ] )[0], 4 )
+        self.assertGreater( picture_arranger.hamming_distances( value, [ picture_arranger.dhash( flipped ) ] )[0], 16 )
+
+    def test_near_dup_index_finds_within_distance(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup( shutil.rmtree, tmpdir )
+        index = picture_arranger.NearDupIndex( os.path.join( tmpdir, 'index' ), tmpdir, 6 )
+        self.addCleanup( index.close )
+        value = 0x0123456789abcdef
+        with mock.patch.object( picture_arranger.IndexWrites, 'FLUSH_INTERVAL', 3600 ):
+            index.add( os.path.join( tmpdir, 'a.jpg' ), value )
+            index.add( os.path.join( tmpdir, 'b.jpg' ), value ^ 0xffffffffffffffff )
+        # 6 bits off, spread so that no band matches exactly
+        near = value ^ ( 0b11 | 0b11 << 16 | 0b1 << 32 | 0b1 << 48 )
+        for held_back in ( True, False ):
+            self.assertEqual( bool( index.writes.writes ), held_back )
+            self.assertEqual( index.find( near ), ( os.path.join( tmpdir, 'a.jpg' ), 6 ) )
+            self.assertIsNone( index.find( near ^ 1 << 63 ) )
+            self.assertEqual( index.find( value ^ 0xffffffffffffffff ), ( os.path.join( tmpdir, 'b.jpg' ), 0 ) )
+            index.writes.flush()
+
+    def test_near_dupes_skip(self):
+        from PIL import Image
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup( shutil.rmtree, tmpdir )
+        indir = os.path.join( tmpdir, 'in' )
+        outdir = os.path.join( tmpdir, 'out' )
+        os.makedirs( indir )
+        os.makedirs( os.path.join( outdir, '2017' ) )
+        self._gradient_image( os.path.join( outdir, '2017', 'original.jpg' ) )
+        self._gradient_image( os.path.join( indir, 'other.jpg' ), flip=True )
+        with Image.open( os.path.join( outdir, '2017', 'original.jpg' ) ) as img:
+            img.resize( ( 320, 240 ) ).save( os.path.join( indir, 'export.jpg' ), quality=60 )
+        sys.argv[1:] = ['-i', indir, '-o', outdir, '-c', '--no-cache', '--near-dupes', 'skip']
+        with mock.patch.object( picture_arranger, 'get_image_creation_date', return_value="2018:04:01 22:15:00" ):
+            picture_arranger.main()
+        self.assertEqual( os.listdir( os.path.join( outdir, '2018', '04', '01' ) ), ['other.jpg'] )
+
+    def _tiff_with_date(self, date):
+        from PIL import Image
+        exif = Image.Exif()
+        exif.get_ifd( picture_arranger.EXIF_IFD_POINTER )[picture_arranger.EXIF_DATETIME_ORIGINAL] = date
+        return exif.tobytes()[6:] # without the Exif\0\0 prefix
+
+    def _box(self, box_type, payload):
+        return struct.pack( '>I4s', 8 + len( payload ), box_type ) + payload
+
+    def test_read_header_date_png_and_raw(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup( shutil.rmtree, tmpdir )
+        tiff = self._tiff_with_date( "2019:05:04 03:02:01" )
+        def chunk( chunk_type, data ):
+            return struct.pack( '>I4s', len( data ), chunk_type ) + data + struct.pack( '>I', zlib.crc32( chunk_type + data ) )
+        png = os.path.join( tmpdir, 'a.png' )
+        with open( png, 'wb' ) as f:
+            f.write( picture_arranger.PNG_SIGNATURE + chunk( b'IHDR', bytes( 13 )) + chunk( b'IDAT', bytes( 5000 )) 
+                     + chunk( b'eXIf', tiff ) + chunk( b'IEND', b'' ))
+        raw = os.path.join( tmpdir, 'a.cr2' )
+        with open( raw, 'wb' ) as f:
+            f.write( tiff )
+        self.assertEqual( picture_arranger.read_header_date( png ), "2019:05:04 03:02:01" )
+        self.assertEqual( picture_arranger.read_header_date( raw ), "2019:05:04 03:02:01" )
+
+    def test_read_header_date_video_skips_mdat(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup( shutil.rmtree, tmpdir )
+        created = datetime.datetime( 2020, 2, 29, 12, 30, 0 )
+        mvhd = struct.pack( '>II', 0, int( time.mktime( created.timetuple() )) + picture_arranger.BMFF_EPOCH_OFFSET ) + bytes( 92 )
+        video = os.path.join( tmpdir, 'clip.mp4' )
+        mdat_size = 4 * 1024 ** 2
+        with open( video, 'wb' ) as f:
+            f.write( self._box( b'ftyp', b'isom\x00\x00\x02\x00isom' ))
+            f.write( struct.pack( '>I4sQ', 1, b'mdat', mdat_size )) # 64 bit size, sparse contents
+            f.seek( mdat_size - 16, os.SEEK_CUR )
+            f.write( self._box( b'moov', self._box( b'mvhd', mvhd )))
+        real_open = open
+        reads = []
+        def counting_open( *args, **kwargs ):
+            f = real_open( *args, **kwargs )
+            read = f.read
+            f.read = lambda n=-1: reads.append( n ) or read( n )
+            return f
+        with mock.patch( 'builtins.open', counting_open ):
+            self.assertEqual( picture_arranger.read_header_date( video ), "2020:02:29 12:30:00" )
+        self.assertLess( sum( reads ), 4096 )
+
+    def test_read_header_date_bogus_movie_time(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup( shutil.rmtree, tmpdir )
+        mvhd = struct.pack( '>IQQ', 1 << 24, 2 ** 64 - 1, 0 ) + bytes( 96 ) # version 1, 64 bit times
+        video = os.path.join( tmpdir, 'clip.mov' )
+        with open( video, 'wb' ) as f:
+            f.write( self._box( b'ftyp', b'qt  \x00\x00\x02\x00qt  ' ) + self._box( b'moov', self._box( b'mvhd', mvhd )))
+        with self.assertRaises( ValueError ):
+            picture_arranger.read_header_date( video )
+        os.utime( video, ( 1500000000, 1500000000 ))
+        self.assertEqual( picture_arranger.read_image_creation_date( video )[1], "mtime" )
+
+    def test_corrupt_heic_named_jpg_skips_pil(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup( shutil.rmtree, tmpdir )
+        image = os.path.join( tmpdir, 'IMG_0002.jpg' )
+        with open( image, 'wb' ) as f:
+            f.write( self._box( b'ftyp', b'heic\x00\x00\x00\x00mif1heic' ) + struct.pack( '>I4s', 64, b'meta' ))
+        with mock.patch.object( picture_arranger, 'read_exif_date_pil' ) as pil:
+            self.assertEqual( picture_arranger.read_image_creation_date( image )[1], "mtime" )
+        pil.assert_not_called()
+
+    def test_read_header_date_heic_by_magic(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup( shutil.rmtree, tmpdir )
+        exif_item = struct.pack( '>I', 6 ) + b'Exif\x00\x00' + self._tiff_with_date( "2021:07:08 09:10:11" )
+        ftyp = self._box( b'ftyp', b'heic\x00\x00\x00\x00mif1heic' )
+        infe = self._box( b'infe', struct.pack( '>BxxxHH4s', 2, 7, 0, b'Exif' ))
+        iinf = self._box( b'iinf', struct.pack( '>IH', 0, 1 ) + infe )
+        def meta( offset ):
+            iloc = self._box( b'iloc', struct.pack( '>IBBHHHHII', 0, 0x44, 0x00, 1, 7, 0, 1, offset, len( exif_item )))
+            return self._box( b'meta', struct.pack( '>I', 0 ) + iinf + iloc )
+        offset = len( ftyp ) + len( meta( 0 )) + 8 # start of the mdat payload
+        image = os.path.join( tmpdir, 'IMG_0001.jpg' ) # phones do this
+        with open( image, 'wb' ) as f:
+            f.write( ftyp + meta( offset ) + self._box( b'mdat', exif_item ))
+        self.assertEqual( picture_arranger.date_reader( image, ftyp ).name, "bmff" )
+        self.assertEqual( picture_arranger.read_header_date( image ), "2021:07:08 09:10:11" )
+
+    def test_arranger_yields_results(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup( shutil.rmtree, tmpdir )
+        cards = []
+        for card in ['card1', 'card2']:
+            cards.append( os.path.join( tmpdir, card ) )
+            os.makedirs( cards[-1] )
+            shutil.copy2( os.path.join( os.getcwd(), 'tests', '1', 'IMG-20140626-00774.jpg'), cards[-1] )
+        outdir = os.path.join( tmpdir, 'out' )
+        arranger = picture_arranger.Arranger( outputdir=outdir, copy=True, skipsame=True, cache=False )
+        first = list( arranger.arrange( inputdir=cards[0] ) )
+        second = list( arranger.arrange( inputdir=cards[1] ) )
+        self.assertEqual( [ ( r.status, r.op ) for r in first ], [ ( 'done', 'copy' ) ] )
+        self.assertEqual( first[0].target, os.path.join( outdir, '2014', '06', '26', 'IMG-20140626-00774.jpg' ) )
+        self.assertEqual( [ ( r.status, r.reason, r.duplicate_of ) for r in second ], [ ( 'skipped', 'same', first[0].target ) ] )
+        self.assertEqual( arranger.stats.counters['files_transferred'], 1 )
+        self.assertRaises( AttributeError, setattr, first[0], 'extra', 1 ) # slotted
+        dryrun = picture_arranger.Arranger( outputdir=os.path.join( tmpdir, 'dry' ), dryrun=True, cache=False )
+        self.assertEqual( [ r.status for r in dryrun.arrange( images=[ os.path.join( cards[0], 'IMG-20140626-00774.jpg' ) ] ) ], 
+                          [ 'planned' ] )
+        self.assertFalse( os.path.exists( os.path.join( tmpdir, 'dry' ) ) )
+
+    def test_config_checks_settings(self):
+        self.assertRaises( TypeError, picture_arranger.Config, outdir='out' )
+        self.assertEqual( picture_arranger.Config( jobs=4 ).io_jobs, 1 )
+        arranger = picture_arranger.Arranger( outputdir='out', copy=True, transfer='rename' )
+        self.assertRaises( ValueError, arranger.arrange, inputdir='in' )
+        self.assertRaises( ValueError, picture_arranger.Arranger( outputdir='out' ).arrange )
+
+    def test_import_is_lazy(self):
+        code = "import sys, picture_arranger; print( sorted( m for m in ( 'PIL', 'sqlite3', 'cProfile', 'numpy' ) if m in sys.modules ))"
+        env = dict( os.environ, PYTHONPATH=os.pathsep.join( sys.path ))
+        output = subprocess.check_output( [ sys.executable, '-c', code ], env=env )
+        self.assertEqual( output.strip(), b'[]' )
+
+    def test_scheduler_limits_each_device(self):
+        running = collections.Counter()
+        most = collections.Counter()
+        lock = threading.Lock()
+        def transfer( op, journal=None, stats=None, throttle=None ):
+            with lock:
+                running[op['dev']] += 1
+                running['all'] += 1
+                most[op['dev']] = max( most[op['dev']], running[op['dev']] )
+                most['all'] = max( most['all'], running['all'] )
+            time.sleep( 0.02 )
+            with lock:
+                running[op['dev']] -= 1
+                running['all'] -= 1
+        scheduler = picture_arranger.TransferScheduler( device_jobs=1 )
+        ops = [ { 'dev': dev, 'src': 'src', 'target': os.path.join( 'out', str( i )) } for i in range( 4 ) for dev in ( 'card1', 'card2' ) ]
+        with mock.patch.object( picture_arranger, 'run_operation', side_effect=transfer ), \
+             mock.patch.object( scheduler, 'devices', side_effect=lambda op: frozenset( [ op['dev'] ] )), \
+             concurrent.futures.ThreadPoolExecutor( max_workers=4 ) as writers:
+            futures = [ scheduler.submit( writers, op ) for op in ops ]
+            for future in futures:
+                future.result()
+        self.assertEqual( ( most['card1'], most['card2'], most['all'] ), ( 1, 1, 2 ) )
+
+    def test_bwlimit_throttles_copies(self):
+        tmpdir, src = self._transfer_source()
+        self.assertEqual( picture_arranger.parse_rate( '40M' ), 40 * 1024 * 1024 )
+        self.assertEqual( picture_arranger.parse_rate( '1.5k' ), 1536 )
+        limit = picture_arranger.BandwidthLimit( 45440 * 10 ) # the source file 10 times a second
+        taken = []
+        def throttle( nbytes ):
+            taken.append( nbytes )
+            limit.take( nbytes )
+        start = time.monotonic()
+        for i in range( 4 ):
+            picture_arranger.move_file( src, os.path.join( tmpdir, '{0}.jpg'.format( i )), copy=True, mode='copy', throttle=throttle )
+        self.assertGreaterEqual( time.monotonic() - start, 0.29 ) # the first one is free
+        self.assertEqual( sum( taken ), 4 * 45440 )
+        with open( src, 'rb' ) as f1, open( os.path.join( tmpdir, '3.jpg' ), 'rb' ) as f2:
+            self.assertEqual( f1.read(), f2.read() )
+
+    def test_catalog_records_placed_files(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup( shutil.rmtree, tmpdir )
+        card = os.path.join( tmpdir, 'card' )
+        os.makedirs( card )
+        shutil.copy2( os.path.join( os.getcwd(), 'tests', '1', 'IMG-20140626-00774.jpg'), card )
+        outdir = os.path.join( tmpdir, 'out' )
+        arranger = picture_arranger.Arranger( outputdir=outdir, copy=True, cache=False )
+        first = list( arranger.arrange( inputdir=card ) )
+        second = list( arranger.arrange( inputdir=card ) )
+        daydir = os.path.join( outdir, '2014', '06', '26' )
+        self.assertEqual( second[0].target, os.path.join( daydir, 'IMG-20140626-00774(1).jpg' ) )
+        found = list( arranger.find_dates( '2014-06' ) )
+        self.assertEqual( sorted( path for date, path in found ), sorted( [ first[0].target, second[0].target ] ) )
+        self.assertTrue( found[0][0].startswith( '2014:06:26' ) )
+        self.assertEqual( list( arranger.find_dates( '2014-07', '2015' ) ), [] )
+        self.assertEqual( len( list( arranger.find_dates( '2013', '2014-06-26' ) ) ), 2 )
+        catalog = arranger.catalog()
+        self.addCleanup( catalog.close )
+        self.assertTrue( catalog.complete )
+        self.assertEqual( catalog.names( daydir ), { 'IMG-20140626-00774.jpg', 'IMG-20140626-00774(1).jpg' } )
+        self.assertEqual( catalog.db.execute( "SELECT DISTINCT source FROM files" ).fetchall(), 
+                          [ ( os.path.join( card, 'IMG-20140626-00774.jpg' ), ) ] )
+        # with the catalog complete, clash checks don't list the directory
+        index = picture_arranger.TargetIndex( catalog=catalog )
+        with mock.patch.object( picture_arranger.os, 'listdir', side_effect=AssertionError ):
+            self.assertIn( 'IMG-20140626-00774(1).jpg', index.taken( daydir ) )
+        self.assertRaises( ValueError, picture_arranger.date_bounds, '14-06' )
+
+    def test_verify_reports_missing_and_changed(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup( shutil.rmtree, tmpdir )
+        card = os.path.join( tmpdir, 'card' )
+        os.makedirs( card )
+        for name in [ 'a.jpg', 'b.jpg', 'c.jpg' ]:
+            shutil.copy2( os.path.join( os.getcwd(), 'tests', '1', 'IMG-20140626-00774.jpg'), os.path.join( card, name ) )
+        outdir = os.path.join( tmpdir, 'out' )
+        sys.argv[1:] = ['-i', card, '-o', outdir, '-c', '--no-cache', '--catalog-hash']
+        picture_arranger.main()
+        daydir = os.path.join( outdir, '2014', '06', '26' )
+        sys.argv[1:] = ['-o', outdir, '--verify', '--jobs', '2']
+        picture_arranger.main() # all there
+        os.unlink( os.path.join( daydir, 'a.jpg' ) )
+        with open( os.path.join( daydir, 'b.jpg' ), 'ab' ) as f:
+            f.write( b'more' )
+        statinfo = os.stat( os.path.join( daydir, 'c.jpg' ) )
+        with open( os.path.join( daydir, 'c.jpg' ), 'r+b' ) as f:
+            f.write( b'X' ) # same size, and the mtime put back
+        os.utime( os.path.join( daydir, 'c.jpg' ), ns=( statinfo.st_atime_ns, statinfo.st_mtime_ns ) )
+        arranger = picture_arranger.Arranger( outputdir=outdir, jobs=2 )
+        self.assertEqual( sorted( arranger.verify() ), [ ( os.path.join( daydir, 'a.jpg' ), 'missing' ), 
+                                                         ( os.path.join( daydir, 'b.jpg' ), 'changed' ), 
+                                                         ( os.path.join( daydir, 'c.jpg' ), 'corrupt' ) ] )
+        self.assertEqual( arranger.stats.counters['verify_missing'], 1 )
+        with self.assertRaises( SystemExit ) as raised:
+            picture_arranger.main()
+        self.assertEqual( raised.exception.code, 1 )
+
+    def test_rebuild_catalog(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup( shutil.rmtree, tmpdir )
+        outdir = os.path.join( tmpdir, 'out' )
+        daydir = os.path.join( outdir, '2014', '06', '26' )
+        os.makedirs( daydir )
+        shutil.copy2( os.path.join( os.getcwd(), 'tests', '1', 'IMG-20140626-00774.jpg'), os.path.join( daydir, 'old.jpg' ) )
+        arranger = picture_arranger.Arranger( outputdir=outdir )
+        catalog = arranger.catalog()
+        self.assertFalse( catalog.complete ) # old.jpg was there before it
+        self.assertTrue( picture_arranger.TargetIndex( catalog=catalog ).catalog is None )
+        catalog.close()
+        self.assertEqual( list( arranger.find_dates( '2014' ) ), [] )
+        sys.argv[1:] = ['-o', outdir, '--rebuild-catalog', '--find-dates', '2014-06-26']
+        picture_arranger.main()
+        found = list( arranger.find_dates( '2014' ) )
+        self.assertEqual( [ path for date, path in found ], [ os.path.join( daydir, 'old.jpg' ) ] )
+        self.assertTrue( found[0][0].startswith( '2014:06:26' ) )
+        os.rename( os.path.join( daydir, 'old.jpg' ), os.path.join( daydir, 'renamed.jpg' ) )
+        arranger.rebuild_catalog()
+        self.assertEqual( [ path for date, path in arranger.find_dates( '2014' ) ], [ os.path.join( daydir, 'renamed.jpg' ) ] )
+        self.assertEqual( list( arranger.verify() ), [] )
+        shutil.copy2( os.path.join( daydir, 'renamed.jpg' ), os.path.join( daydir, 'copied.jpg' ) )
+        self.assertEqual( list( arranger.verify() ), [ ( os.path.join( daydir, 'copied.jpg' ), 'untracked' ) ] )
+        # a run that dies leaves the catalog incomplete until the next rebuild
+        crashed = picture_arranger.Catalog( os.path.join( outdir, picture_arranger.Catalog.DEFAULT_NAME ), outdir, writing=True )
+        self.assertTrue( crashed.complete )
+        crashed.close( finished=False )
+        catalog = arranger.catalog()
+        self.assertFalse( catalog.complete )
+        catalog.rebuild()
+        catalog.close()
+        catalog = arranger.catalog()
+        self.assertTrue( catalog.complete )
+        catalog.close()
+        # so does one that places files without it
+        card = os.path.join( tmpdir, 'card' )
+        os.makedirs( card )
+        shutil.copy2( os.path.join( os.getcwd(), 'tests', '1', 'IMG-20140626-00774.jpg'), card )
+        list( picture_arranger.Arranger( outputdir=outdir, copy=True, cache=False, catalog=False ).arrange( inputdir=card ) )
+        catalog = arranger.catalog()
+        self.assertFalse( catalog.complete )
+        catalog.close()
+        self.assertIn( "--find-dates", picture_arranger.check_options( picture_arranger.Config( outputdir=outdir, find_dates=['2014-6'] ) ) )
+        self.assertIn( "--no-catalog", picture_arranger.check_options( picture_arranger.Config( outputdir=outdir, verify=True, catalog=False ) ) )
+
+    def test_index_writes_are_batched(self):
+        class FakeDb(object):
+            executed = 0
+            commits = 0
+            def execute( self, statement, parameters ):
+                self.executed += 1
+            def commit( self ):
+                self.commits += 1
+        db = FakeDb()
+        writes = picture_arranger.IndexWrites( db )
+        with mock.patch.object( picture_arranger.IndexWrites, 'FLUSH_INTERVAL', 3600 ):
+            for n in range( 250 ):
+                writes.add( "INSERT", ( n, ))
+        self.assertEqual( ( db.executed, db.commits ), ( 200, 2 ))
+        with mock.patch.object( picture_arranger.time, 'time', return_value=time.time() + 1 ):
+            writes.add( "INSERT", ( 250, )) # the oldest held back is too old now
+        self.assertEqual( ( db.executed, db.commits ), ( 251, 3 ))
+
+    def test_catalog_shared_between_runs(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup( shutil.rmtree, tmpdir )
+        for name in [ 'a.jpg', 'b.jpg', 'c.jpg' ]:
+            shutil.copy2( os.path.join( os.getcwd(), 'tests', '1', 'IMG-20140626-00774.jpg'), os.path.join( tmpdir, name ) )
+        path = os.path.join( tmpdir, 'catalog' )
+        with mock.patch.object( picture_arranger, 'SQLITE_LOCK_TIMEOUT', 0.1 ):
+            first = picture_arranger.Catalog( path, tmpdir, writing=True )
+            first.rebuild()
+            second = picture_arranger.Catalog( path, tmpdir, writing=True )
+            # neither holds the write lock between adds, or while the other reads
+            found = first.find( '2014' )
+            self.assertEqual( next( found )[1], os.path.join( tmpdir, 'a.jpg' ) )
+            second.add( os.path.join( tmpdir, 'b.jpg' ), "2014:06:26 16:45:58", "/card/b.jpg" )
+            first.add( os.path.join( tmpdir, 'c.jpg' ), "2014:06:26 16:45:58", "/card/c.jpg" )
+            second.add( os.path.join( tmpdir, 'a.jpg' ), "2014:06:26 16:45:58", "/card/a.jpg" )
+            found.close()
+        self.assertTrue( first.complete )
+        self.assertFalse( second.complete ) # can't tell the first run from one that died
+        first.close()
+        second.close()
+        catalog = picture_arranger.Catalog( path, tmpdir )
+        self.assertTrue( catalog.complete )
+        self.assertEqual( sorted( source for ( source, ) in catalog.rows( "source" ) ), [ "/card/a.jpg", "/card/b.jpg", "/card/c.jpg" ] )
+        catalog.close()
+
 def main():
     unittest.main()
 